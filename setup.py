@@ -26,6 +26,7 @@ setup(
     install_requires=_REQUIREMENTS,
     extras_require={
         'niced_processes': ['psutil'],
+        'fast_hashing': ['xxhash'],
         },
     classifiers=[
         'Intended Audience :: Developers',
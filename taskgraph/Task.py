@@ -1,11 +1,18 @@
 """Task graph framework."""
 from pkg_resources import get_distribution
+import abc
+import bz2
 import collections
+import concurrent.futures
+import functools
 import hashlib
+import heapq
 import inspect
+import itertools
 import logging
 import logging.handlers
-import math
+import lzma
+import mmap
 import multiprocessing
 import multiprocessing.pool
 import os
@@ -14,8 +21,14 @@ import pickle
 import pprint
 import queue
 import sqlite3
+import stat
+import struct
+import sys
 import threading
 import time
+import types
+import uuid
+import zlib
 
 import retrying
 
@@ -23,7 +36,16 @@ __version__ = get_distribution('taskgraph').version
 
 
 _VALID_PATH_TYPES = (str, pathlib.PurePath)
+# no filesystem accepts a longer path, longer strings aren't treated as paths
+_MAX_PATH_LENGTH = 32767
+# ``_normalize_path`` remembers this many of the paths it normalized
+_NORMALIZED_PATH_CACHE_SIZE = 2**16
 _TASKGRAPH_DATABASE_FILENAME = 'taskgraph_data.db'
+# a sharded TaskGraph database is split across files with these names, the
+# shard of a record is chosen by this many leading digits of its hash
+_TASKGRAPH_DATABASE_SHARD_FILENAME = (
+    'taskgraph_data_{shard_index}_of_{shard_count}.db')
+_TASKGRAPH_DATABASE_SHARD_PREFIX = 8
 
 try:
     import psutil
@@ -39,8 +61,205 @@ try:
 except ImportError:
     HAS_PSUTIL = False
 
+try:
+    import xxhash
+    HAS_XXHASH = True
+except ImportError:
+    HAS_XXHASH = False
+
+try:
+    # not available on Windows
+    import resource
+    HAS_RESOURCE = True
+except ImportError:
+    HAS_RESOURCE = False
+
+# hash_algorithm names that are not ``hashlib`` algorithms mapped to a
+# function that creates a new hash object. Change detection only needs
+# accidental collisions to be unlikely, so a short blake2b digest or a
+# non-cryptographic xxhash is enough.
+_FAST_HASH_ALGORITHM_MAP = {
+    'blake2b_128': lambda: hashlib.blake2b(digest_size=16),
+}
+# the 'headtail' hash_algorithm digests the size of a file and this many
+# samples of this many bytes evenly spaced from its start to its end, files
+# no larger than the samples are digested in full
+_HEADTAIL_SAMPLE_COUNT = 16
+_HEADTAIL_SAMPLE_SIZE = 2**16
+# these are only available if the optional ``xxhash`` package is installed
+_XXHASH_ALGORITHM_LIST = ['xxh64', 'xxh3_64', 'xxh3_128']
+if HAS_XXHASH:
+    for _algorithm in _XXHASH_ALGORITHM_LIST:
+        if hasattr(xxhash, _algorithm):
+            _FAST_HASH_ALGORITHM_MAP[_algorithm] = getattr(xxhash, _algorithm)
+
 LOGGER = logging.getLogger(__name__)
-_MAX_TIMEOUT = 5.0  # amount of time to wait for threads to terminate
+# completed Task records are committed to the database in batches of up to
+# this many records or after waiting this many seconds for more records
+_COMPLETION_RECORD_BATCH_SIZE = 256
+_COMPLETION_RECORD_BATCH_INTERVAL = 0.05
+
+# Stored results that are not plain pickles start with this marker followed
+# by a single byte identifying the format of the rest of the value. Pickles
+# always start with the PROTO opcode b'\x80' so they can't be confused with
+# it and results stored by older versions of TaskGraph remain readable.
+_RESULT_FORMAT_MARKER = b'\x00tg'
+# maps a ``result_compression`` value to its stored format byte and the
+# functions to compress and decompress a value with it
+_RESULT_COMPRESSION_MAP = {
+    'zlib': (b'z', zlib.compress, zlib.decompress),
+    'lzma': (b'x', lzma.compress, lzma.decompress),
+    'bz2': (b'b', bz2.compress, bz2.decompress),
+}
+# the ways a TaskGraph can order Tasks whose dependencies are satisfied
+_PRIORITY_MODE_SET = {'user', 'critical_path', 'runtime'}
+# The TaskGraph database schema version is stored in ``PRAGMA user_version``.
+# Version 1 is the schema made by this script, which is also every database
+# made before versions were recorded.
+_TASKGRAPH_DATABASE_SCHEMA_VERSION = 2
+_TASKGRAPH_DATABASE_V1_SCRIPT = (
+    """
+    PRAGMA auto_vacuum = INCREMENTAL;
+    CREATE TABLE taskgraph_data (
+        task_reexecution_hash TEXT NOT NULL,
+        target_path_stats BLOB NOT NULL,
+        result BLOB NOT NULL,
+        PRIMARY KEY (task_reexecution_hash)
+    );
+    CREATE TABLE global_variables (
+        key TEXT NOT NULL,
+        value BLOB,
+        PRIMARY KEY (key)
+    );
+    """)
+_TASKGRAPH_DATABASE_V1_TABLE_COLUMN_MAP = {
+    'taskgraph_data': [
+        'task_reexecution_hash', 'target_path_stats', 'result'],
+    'global_variables': ['key', 'value'],
+}
+# maps a schema version to the statements that upgrade it to the next one
+_TASKGRAPH_DATABASE_MIGRATION_MAP = {
+    # records when each completion record was last used and how many bytes
+    # it takes so the cache can be pruned
+    1: """
+        CREATE TABLE IF NOT EXISTS taskgraph_data_access (
+            task_reexecution_hash TEXT NOT NULL,
+            last_access_time REAL NOT NULL,
+            record_size INTEGER NOT NULL,
+            PRIMARY KEY (task_reexecution_hash)
+        );
+        CREATE INDEX IF NOT EXISTS taskgraph_data_access_time_index
+            ON taskgraph_data_access (last_access_time);
+        """,
+}
+
+# format byte of a stored result that is only a reference to a spill file
+_RESULT_SPILL_FORMAT = b's'
+# results too large to keep in the database are written to files in this
+# subdirectory of the TaskGraph cache directory
+_RESULT_SPILL_DIRNAME = 'taskgraph_results'
+# spill files start with this and a header of unsigned 64 bit integers:
+# the pickle length, the number of out-of-band buffers and the offset and
+# length of each buffer. Buffers are aligned so they can back arrays.
+_RESULT_SPILL_FILE_MAGIC = b'TGSPILL1'
+_RESULT_SPILL_BUFFER_ALIGNMENT = 64
+# spill files smaller than this are read into memory rather than mapped, a
+# mapped file can't be replaced or removed on Windows until it's unmapped
+_RESULT_SPILL_MMAP_THRESHOLD = 2**20
+# out-of-band buffers need pickle protocol 5 (Python 3.8+), older
+# interpreters still spill but copy the whole payload on load
+_RESULT_SPILL_PROTOCOL = max(pickle.DEFAULT_PROTOCOL, min(
+    5, pickle.HIGHEST_PROTOCOL))
+
+# the fields of a completion record that can be looked up in a cache backend
+_CACHE_RECORD_FIELD_LIST = ['target_path_stats', 'result']
+# the 'directory' cache backend writes one file per completion record in
+# this subdirectory of the TaskGraph cache directory
+_CACHE_RECORD_DIRNAME = 'taskgraph_records'
+# record files start with this and a header of unsigned 64 bit integers:
+# the length of the target path stats that follow and the record size. The
+# stored result fills the rest of the file.
+_CACHE_RECORD_FILE_MAGIC = b'TGRECRD1'
+_CACHE_RECORD_FILE_HEADER = struct.Struct('<8sQQ')
+# sqlite3 limits the number of parameters of a single query
+_SQLITE_MAX_LOOKUP_SIZE = 500
+
+# content digests of files are cached in this database in the TaskGraph
+# cache directory and reused until the file's identity or stats change
+_FILE_FINGERPRINT_DATABASE_FILENAME = 'taskgraph_fingerprints.db'
+_FILE_FINGERPRINT_DATABASE_SCRIPT = (
+    """
+    CREATE TABLE IF NOT EXISTS file_fingerprint (
+        path TEXT NOT NULL,
+        hash_algorithm TEXT NOT NULL,
+        device INTEGER NOT NULL,
+        inode INTEGER NOT NULL,
+        size INTEGER NOT NULL,
+        mtime_ns INTEGER NOT NULL,
+        digest TEXT NOT NULL,
+        PRIMARY KEY (path, hash_algorithm)
+    );
+    """)
+# runtime statistics of executed Tasks and their functions are kept in this
+# database in the TaskGraph cache directory. ``kind`` is 'task' for a row
+# keyed by a task id hash or 'function' for one keyed by a function name,
+# ``recent_runtimes`` are the last ``_RUNTIME_HISTORY_SAMPLE_COUNT`` runtimes
+# packed as little endian doubles
+_RUNTIME_HISTORY_DATABASE_FILENAME = 'taskgraph_runtime_history.db'
+_RUNTIME_HISTORY_DATABASE_SCRIPT = (
+    """
+    CREATE TABLE IF NOT EXISTS runtime_history (
+        kind TEXT NOT NULL,
+        key TEXT NOT NULL,
+        run_count INTEGER NOT NULL,
+        mean_runtime REAL NOT NULL,
+        peak_memory INTEGER,
+        recent_runtimes BLOB NOT NULL,
+        last_run_time REAL NOT NULL,
+        PRIMARY KEY (kind, key)
+    );
+    """)
+_RUNTIME_HISTORY_SAMPLE_COUNT = 32
+# the expected runtime in seconds of a Task whose function never executed
+# when the runtime history is empty
+_DEFAULT_EXPECTED_RUNTIME = 1.0
+# a file modified less than this many seconds ago could be modified again
+# without changing its mtime on a filesystem with coarse timestamps, its
+# digest is not cached until it's older
+_FILE_FINGERPRINT_MIN_AGE = 2.0
+# files found in a Task's arguments are digested concurrently by up to this
+# many threads shared by every Task, hashlib releases the GIL while hashing
+_FILE_HASH_THREAD_COUNT = min(32, (os.cpu_count() or 1) + 4)
+# created on first use by ``_get_file_hash_executor``, a worker process
+# forked after it was created inherits it without its threads so the pid
+# that created it is recorded too
+_FILE_HASH_EXECUTOR = None
+_FILE_HASH_EXECUTOR_PID = None
+_FILE_HASH_EXECUTOR_LOCK = threading.Lock()
+# a TaskGraph's ``_DirectoryListingCache`` keeps the listings of at most
+# this many directories
+_DIRECTORY_LISTING_CACHE_SIZE = 2**12
+# ``_get_code_digest`` and ``_get_code_global_names`` remember the results
+# of this many code objects, code objects don't change so they're never
+# invalidated but exec'd or generated functions would grow them forever
+_CODE_CACHE_SIZE = 2**12
+# flags that only depend on where a function is defined
+_CODE_FLAG_MASK = ~(inspect.CO_NESTED | getattr(inspect, 'CO_NOFREE', 0))
+# ``_update_hash_with_value`` feeds its hash object in chunks of this size
+_VALUE_HASH_BUFFER_SIZE = 2**16
+# ``_update_hash_with_value`` encodes values of these types by their ``repr``
+# and containers of only them by the ``repr`` of this many items at a time
+_REPR_HASH_TYPE_SET = frozenset([str, int, float, bool, type(None), bytes])
+_REPR_HASH_CHUNK_SIZE = 1024
+# the tags that ``_update_hash_with_value`` prefixes containers with
+_CONTAINER_HASH_TAG_MAP = {list: b'l', tuple: b't', dict: b'd'}
+_REPR_HASH_CONTAINER_TYPE_SET = _REPR_HASH_TYPE_SET.union(
+    _CONTAINER_HASH_TAG_MAP)
+# a container is walked item by item rather than encoded by its ``repr``
+# if it has more than this many nested items per item
+_REPR_HASH_NESTED_ITEM_RATIO = 16
+# each thread digests files through its own reused read buffer
+_FILE_HASH_BUFFER = threading.local()
 
 
 # We want our processing pool to be nondeamonic so that workers could use
@@ -134,7 +353,16 @@ def _logging_queue_monitor(logging_queue):
 
 
 def _create_taskgraph_table_schema(taskgraph_database_path):
-    """Create database exists and/or ensures it is compatible and recreate.
+    """Create database exists and/or ensures it is compatible and upgrade.
+
+    The schema version of the database is kept in ``PRAGMA user_version``.
+    A database at ``_TASKGRAPH_DATABASE_SCHEMA_VERSION`` is accepted with
+    that single query. An older database is upgraded in place with the
+    scripts in ``_TASKGRAPH_DATABASE_MIGRATION_MAP`` so its completion
+    records are kept. Databases made before schema versions were recorded
+    have a ``user_version`` of 0 and are upgraded from version 1 if their
+    tables match. Anything else is considered incompatible and is deleted
+    and created again.
 
     Args:
         taskgraph_database_path (str): path to an existing database or desired
@@ -144,68 +372,10 @@ def _create_taskgraph_table_schema(taskgraph_database_path):
         None.
 
     """
-    sql_create_projects_table_script = (
-        """
-        CREATE TABLE taskgraph_data (
-            task_reexecution_hash TEXT NOT NULL,
-            target_path_stats BLOB NOT NULL,
-            result BLOB NOT NULL,
-            PRIMARY KEY (task_reexecution_hash)
-        );
-        CREATE TABLE global_variables (
-            key TEXT NOT NULL,
-            value BLOB,
-            PRIMARY KEY (key)
-        );
-        """)
-
-    table_valid = True
-    expected_table_column_name_map = {
-        'taskgraph_data': [
-            'task_reexecution_hash', 'target_path_stats', 'result'],
-        'global_variables': ['key', 'value']}
     if os.path.exists(taskgraph_database_path):
         try:
-            # check that the tables exist and the column names are as expected
-            for expected_table_name in expected_table_column_name_map:
-                table_result = _execute_sqlite(
-                    '''
-                    SELECT name
-                    FROM sqlite_master
-                    WHERE type='table' AND name=?
-                    ''', taskgraph_database_path,
-                    argument_list=[expected_table_name],
-                    mode='read_only', execute='execute', fetch='all')
-                if not table_result:
-                    raise ValueError(f'missing table {expected_table_name}')
-
-                # this query returns a list of results of the form
-                # [(0, 'task_reexecution_hash', 'TEXT', 1, None, 1), ... ]
-                # we'll just check that the header names are the same, no
-                # need to be super aggressive, also need to construct the
-                # PRAGMA string directly since it doesn't take arguments
-                table_info_result = _execute_sqlite(
-                    f'PRAGMA table_info({expected_table_name})',
-                    taskgraph_database_path, mode='read_only',
-                    execute='execute', fetch='all')
-
-                expected_column_names = expected_table_column_name_map[
-                    expected_table_name]
-                header_count = 0
-                for header_line in table_info_result:
-                    column_name = header_line[1]
-                    if column_name not in expected_column_names:
-                        raise ValueError(
-                            f'expected {column_name} in table '
-                            f'{expected_table_name} but not found')
-                    header_count += 1
-                if header_count < len(expected_column_names):
-                    raise ValueError(
-                        f'found only {header_count} of an expected '
-                        f'{len(expected_column_names)} columns in table '
-                        f'{expected_table_name}')
-                if not table_info_result:
-                    raise ValueError(f'missing table {expected_table_name}')
+            if _upgrade_taskgraph_database(taskgraph_database_path):
+                return
         except Exception:
             # catch all "Exception"s because anything that goes wrong while
             # checking the database should be considered a bad database and we
@@ -213,24 +383,134 @@ def _create_taskgraph_table_schema(taskgraph_database_path):
             LOGGER.exception(
                 f'{taskgraph_database_path} exists, but is incompatible '
                 'somehow. Deleting and making a new one.')
-            os.remove(taskgraph_database_path)
-            table_valid = False
-    else:
-        # table does not exist
-        table_valid = False
+        else:
+            LOGGER.warning(
+                f'{taskgraph_database_path} exists, but is incompatible '
+                'somehow. Deleting and making a new one.')
+        for path in [taskgraph_database_path] + [
+                taskgraph_database_path + suffix
+                for suffix in ('-wal', '-shm', '-journal')]:
+            if os.path.exists(path):
+                os.remove(path)
+
+    # create the base tables and bring them up to the current version
+    _execute_sqlite(
+        _TASKGRAPH_DATABASE_V1_SCRIPT, taskgraph_database_path,
+        mode='modify', execute='script')
+    # set the database version
+    _execute_sqlite(
+        '''
+        INSERT OR REPLACE INTO global_variables
+        VALUES ("version", ?)
+        ''', taskgraph_database_path, mode='modify',
+        argument_list=(__version__,))
+    if not _upgrade_taskgraph_database(taskgraph_database_path):
+        raise RuntimeError(
+            f'could not create a TaskGraph database at '
+            f'{taskgraph_database_path}')
+
+
+def _is_sqlite_locked_error(exception):
+    """Return True if ``exception`` is SQLite reporting a locked database.
+
+    Only lock contention with another connection is worth retrying, other
+    errors such as a malformed database fail the same way every time.
 
-    if not table_valid:
-        # create the base table
-        _execute_sqlite(
-            sql_create_projects_table_script, taskgraph_database_path,
-            mode='modify', execute='script')
-        # set the database version
-        _execute_sqlite(
-            '''
-            INSERT OR REPLACE INTO global_variables
-            VALUES ("version", ?)
-            ''', taskgraph_database_path, mode='modify',
-            argument_list=(__version__,))
+    """
+    if not isinstance(exception, sqlite3.OperationalError):
+        return False
+    message = str(exception).lower()
+    return 'locked' in message or 'busy' in message
+
+
+@retrying.retry(
+    wait_exponential_multiplier=500, wait_exponential_max=3200,
+    stop_max_attempt_number=100,
+    retry_on_exception=_is_sqlite_locked_error)
+def _upgrade_taskgraph_database(taskgraph_database_path):
+    """Upgrade a TaskGraph database to the current schema version.
+
+    Args:
+        taskgraph_database_path (str): path to an existing database.
+
+    Returns:
+        True if the database is at, or was upgraded to,
+        ``_TASKGRAPH_DATABASE_SCHEMA_VERSION``. False if it's not a
+        database this version of TaskGraph can use.
+
+    """
+    connection = _connect_sqlite(taskgraph_database_path, 'modify')
+    # control transactions explicitly so the version check and the
+    # migrations happen atomically
+    connection.isolation_level = None
+    try:
+        user_version = connection.execute('PRAGMA user_version').fetchone()[0]
+        if user_version == _TASKGRAPH_DATABASE_SCHEMA_VERSION:
+            return True
+        if user_version > _TASKGRAPH_DATABASE_SCHEMA_VERSION:
+            LOGGER.warning(
+                f'{taskgraph_database_path} has schema version '
+                f'{user_version} which is from a newer version of TaskGraph '
+                f'that uses version {_TASKGRAPH_DATABASE_SCHEMA_VERSION}')
+            return False
+        # another process could be doing the same upgrade, this waits for
+        # it and then checks the version again
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            user_version = connection.execute(
+                'PRAGMA user_version').fetchone()[0]
+            if user_version == 0:
+                if not _is_taskgraph_database_v1(connection):
+                    connection.execute('ROLLBACK')
+                    return False
+                user_version = 1
+            while user_version < _TASKGRAPH_DATABASE_SCHEMA_VERSION:
+                LOGGER.info(
+                    f'upgrading {taskgraph_database_path} from schema '
+                    f'version {user_version} to {user_version+1}')
+                # executescript would commit, so run statements one by one
+                for statement in _TASKGRAPH_DATABASE_MIGRATION_MAP[
+                        user_version].split(';'):
+                    if statement.strip():
+                        connection.execute(statement)
+                user_version += 1
+            # PRAGMA doesn't take arguments but this is always an int
+            connection.execute(f'PRAGMA user_version = {int(user_version)}')
+            connection.execute(
+                '''
+                INSERT OR REPLACE INTO global_variables
+                VALUES ("version", ?)
+                ''', (__version__,))
+            connection.execute('COMMIT')
+        except Exception:
+            connection.execute('ROLLBACK')
+            raise
+        return True
+    finally:
+        connection.close()
+
+
+def _is_taskgraph_database_v1(connection):
+    """Return True if ``connection`` has the version 1 TaskGraph tables.
+
+    Version 1 is the schema used before versions were recorded in
+    ``PRAGMA user_version``. Extra tables are allowed.
+
+    """
+    # the pragma_table_info() table valued function needs SQLite 3.16 so
+    # each table is queried with the PRAGMA statement instead
+    for table_name, expected_column_names in (
+            _TASKGRAPH_DATABASE_V1_TABLE_COLUMN_MAP.items()):
+        # PRAGMA doesn't take arguments but the table names are constants
+        column_names = [
+            row[1] for row in connection.execute(
+                f'PRAGMA table_info("{table_name}")')]
+        if sorted(column_names) != sorted(expected_column_names):
+            LOGGER.warning(
+                f'expected columns {expected_column_names} in table '
+                f'{table_name} but found {column_names}')
+            return False
+    return True
 
 
 class TaskGraph(object):
@@ -238,7 +518,14 @@ class TaskGraph(object):
 
     def __init__(
             self, taskgraph_cache_dir_path, n_workers,
-            reporting_interval=None):
+            reporting_interval=None, result_compression=None,
+            result_compression_threshold=2**16, result_spill_threshold=None,
+            cache_max_bytes=None, cache_max_age=None,
+            cache_backend='sqlite', cache_shard_count=1,
+            cache_file_fingerprints=True, stat_memo_max_age=None,
+            hash_function_callees=True, priority_mode='user',
+            record_runtime_history=None, resource_capacity=None,
+            task_batch_size=32, batch_runtime_threshold=None):
         """Create a task graph.
 
         Creates an object for building task graphs, executing them,
@@ -255,8 +542,146 @@ class TaskGraph(object):
                 ``add_task`` will be a blocking call.
             reporting_interval (scalar): if not None, report status of task
                 graph every ``reporting_interval`` seconds.
+            result_compression (string): if not None, one of 'zlib', 'lzma',
+                or 'bz2'. Results of Tasks created with ``store_result=True``
+                are compressed with this algorithm before they are stored in
+                the TaskGraph database. Can be overridden per Task in
+                ``add_task``.
+            result_compression_threshold (int): results whose pickled size
+                is smaller than this number of bytes are stored uncompressed.
+            result_spill_threshold (int): if not None, stored results whose
+                pickled size is at least this many bytes are written to their
+                own file in the cache directory rather than to the TaskGraph
+                database and are memory mapped when loaded by ``Task.get``.
+                Large contiguous buffers such as NumPy arrays are stored out
+                of band and are not copied into memory on load.
+            cache_max_bytes (int): if not None, once the TaskGraph is closed
+                and all its Tasks are complete the least recently used
+                completion records are pruned from the cache until it's no
+                larger than this many bytes. See ``prune_cache``.
+            cache_max_age (float): if not None, once the TaskGraph is closed
+                and all its Tasks are complete any completion records not
+                used in this many seconds are pruned from the cache. See
+                ``prune_cache``.
+            cache_backend (string): where completion records are stored.
+                One of 'sqlite' for a SQLite database in the cache directory,
+                'directory' for one file per record in the
+                ``taskgraph_records`` subdirectory of the cache directory, or
+                'memory' to keep records only for the life of this
+                TaskGraph.
+            cache_shard_count (int): if greater than 1 the 'sqlite' cache
+                backend spreads completion records across this many database
+                files by the prefix of their hash so concurrent TaskGraph
+                processes sharing the cache directory rarely wait on each
+                other's writes. Records stored with a different shard count
+                are not found.
+            cache_file_fingerprints (bool): if True, digests of files hashed
+                with a ``hashlib`` ``hash_algorithm`` are cached in the cache
+                directory keyed by the file's path, device, inode, size, and
+                modification time so a file is only read again once it
+                changes. Set to False if the filesystem doesn't reliably
+                update these when a file's contents change. With the
+                'memory' ``cache_backend`` they're only kept in memory.
+            stat_memo_max_age (float): if not None, the ``os.stat`` of every
+                file found in Task arguments is shared by all Tasks of this
+                TaskGraph for up to this many seconds rather than only for a
+                single check of whether a Task is precalculated. The stats of
+                a Task's targets are refreshed once it executes. Only set
+                this if files are not modified outside of this TaskGraph
+                while it runs.
+            hash_function_callees (bool): if True, the fingerprint of a
+                Task function also covers the functions of the same module
+                it references, so a change to a helper function reexecutes
+                the Tasks that call it.
+            priority_mode (string): how Tasks whose dependencies are
+                satisfied are ordered for execution. One of 'user' to order
+                them by the ``priority`` passed to ``add_task``, or
+                'critical_path' to first execute the Tasks with the longest
+                chain of Tasks that depend on them, then order Tasks with
+                equally long chains by their ``priority``. If 'runtime' the
+                chains are measured in the expected runtime of their Tasks
+                from the runtime history rather than their number of Tasks,
+                so the ready Task with the most work left after it is
+                executed first. Tasks of equal priority are executed in the
+                order they became ready.
+            record_runtime_history (bool): if True, the runtime and peak
+                memory of every Task executed are recorded by task and by
+                function in the cache directory, see ``get_runtime_stats``.
+                Statistics of Tasks and functions that did not execute
+                within ``cache_max_age`` are removed with the rest of the
+                cache. If None, they're only recorded if ``priority_mode``
+                is 'runtime' or ``batch_runtime_threshold`` is set, which
+                use them. Can't be False if ``priority_mode`` is 'runtime'.
+            resource_capacity (dict): if not None, maps the names of
+                resources such as 'cpus' or 'memory_gb' to the amount of
+                them available to Tasks. A Task created with ``resources``
+                only starts once what it requires of each of these is free,
+                Tasks that fit are started in its place until then.
+            task_batch_size (int): if ``n_workers`` is greater than 0, up to
+                this many ready batchable Tasks are executed by one call to
+                a worker process to avoid a round trip to the worker pool for
+                each Task. See ``batchable`` in ``add_task``.
+            batch_runtime_threshold (float): if not None, a Task not
+                explicitly marked ``batchable`` is batchable if the runtime
+                history expects it to take less than this many seconds.
+
+        Raises:
+            ValueError if ``result_compression`` is not a known algorithm,
+                ``cache_backend`` is not a known backend,
+                ``cache_shard_count`` is greater than 1 for a backend other
+                than 'sqlite', or ``priority_mode`` is not a known mode.
 
         """
+        if result_compression not in _RESULT_COMPRESSION_MAP and (
+                result_compression is not None):
+            # there is nothing for ``__del__`` to clean up
+            self._terminated = True
+            raise ValueError(
+                f'Unknown result_compression: {result_compression}, expected '
+                f'one of {sorted(_RESULT_COMPRESSION_MAP)} or None')
+        if cache_backend not in _CACHE_BACKEND_MAP:
+            self._terminated = True
+            raise ValueError(
+                f'Unknown cache_backend: {cache_backend}, expected one of '
+                f'{sorted(_CACHE_BACKEND_MAP)}')
+        if cache_shard_count > 1 and cache_backend != 'sqlite':
+            self._terminated = True
+            raise ValueError(
+                f'cache_shard_count is {cache_shard_count} but only the '
+                f'sqlite cache backend can be sharded, not {cache_backend}')
+        if priority_mode not in _PRIORITY_MODE_SET:
+            self._terminated = True
+            raise ValueError(
+                f'Unknown priority_mode: {priority_mode}, expected one of '
+                f'{sorted(_PRIORITY_MODE_SET)}')
+        if record_runtime_history is None:
+            record_runtime_history = (
+                priority_mode == 'runtime' or
+                batch_runtime_threshold is not None)
+        if priority_mode == 'runtime' and not record_runtime_history:
+            self._terminated = True
+            raise ValueError(
+                'priority_mode is runtime but record_runtime_history is '
+                'False')
+        if task_batch_size < 1:
+            self._terminated = True
+            raise ValueError(
+                f'task_batch_size must be at least 1, not {task_batch_size}')
+        if resource_capacity is not None:
+            for resource_name, amount in resource_capacity.items():
+                if amount < 0:
+                    self._terminated = True
+                    raise ValueError(
+                        f'resource_capacity of {resource_name} is negative: '
+                        f'{amount}')
+        self._result_compression = result_compression
+        self._result_compression_threshold = result_compression_threshold
+        self._result_spill_threshold = result_spill_threshold
+        self._cache_max_bytes = cache_max_bytes
+        self._cache_max_age = cache_max_age
+        # used so the automatic pruning of the cache happens only once
+        self._cache_pruned = False
+
         try:
             os.makedirs(taskgraph_cache_dir_path)
         except OSError:
@@ -265,6 +690,8 @@ class TaskGraph(object):
                 taskgraph_cache_dir_path)
 
         self._taskgraph_cache_dir_path = taskgraph_cache_dir_path
+        self._result_spill_dir_path = os.path.join(
+            taskgraph_cache_dir_path, _RESULT_SPILL_DIRNAME)
 
         # this variable is used to print accurate representation of how many
         # tasks have been completed in the logging output.
@@ -308,14 +735,61 @@ class TaskGraph(object):
         # this might hold the threads to execute tasks if n_workers >= 0
         self._task_executor_thread_list = []
 
-        # executor threads wait on this event that gets set when new tasks are
-        # added to the queue. If the queue is empty an executor will clear
-        # the event to halt other executors
-        self._executor_ready_event = threading.Event()
+        # guards the ready heap and the dependency bookkeeping below, idle
+        # executor threads wait on it and are notified once for each Task
+        # pushed to the ready heap, or all at once when the graph closes or
+        # terminates
+        self._task_ready_condition = threading.Condition()
+
+        # a heap of ``(key, sequence number, task)`` tuples of tasks that
+        # have all their dependencies satisfied and can be executed
+        # immediately. A task is pushed again when its key changes, so an
+        # entry whose key isn't the one in ``_task_ready_key_map`` is stale
+        # and skipped
+        self._task_ready_heap = []
+        self._task_ready_sequence = itertools.count()
+
+        # a heap of the ready heap's entries for tasks whose resources
+        # weren't free when they were popped. They're only checked again
+        # once running tasks release resources, and the first one has the
+        # free resources reserved so smaller tasks can't keep it waiting
+        self._task_blocked_heap = []
+
+        # maps the names of the tasks in the ready and blocked heaps to
+        # their current key
+        self._task_ready_key_map = {}
+
+        self._priority_mode = priority_mode
+
+        # if priority_mode isn't 'user' this maps each task name to the sum
+        # of the weights of the tasks in the longest chain of tasks from it
+        # through the tasks that depend on it, a task's weight is 1 if the
+        # mode is 'critical_path' or its expected runtime if it's 'runtime'
+        self._critical_path_length_map = {}
+
+        # maps resource names to the amount of them Tasks can use at once
+        self._resource_capacity = dict(resource_capacity or {})
 
-        # tasks that have all their dependencies satisfied go in this queue
-        # and can be executed immediately
-        self._task_ready_priority_queue = queue.PriorityQueue()
+        # maps the names of ready tasks that require resources and of
+        # running tasks that hold them to ``{resource name: amount}``
+        self._task_resource_map = {}
+
+        # names of the running tasks that hold resources
+        self._resource_holder_name_set = set()
+
+        # maps resource names to the amount the running tasks hold
+        self._resource_usage_map = {}
+
+        self._task_batch_size = task_batch_size
+        self._batch_runtime_threshold = batch_runtime_threshold
+
+        # names of incomplete tasks that can be executed in a batch
+        self._batchable_task_name_set = set()
+
+        # if priority_mode isn't 'user' these map each task name to its
+        # weight and to the names of the tasks it depends on
+        self._task_weight_map = {}
+        self._task_dependency_name_map = {}
 
         # maps a list of task names that need to be executed before the key
         # task can
@@ -327,31 +801,77 @@ class TaskGraph(object):
         # tasks that complete are added to this set
         self._completed_task_names = set()
 
-        self._task_database_path = os.path.join(
-            self._taskgraph_cache_dir_path, _TASKGRAPH_DATABASE_FILENAME)
-
-        # create new table if needed
-        _create_taskgraph_table_schema(self._task_database_path)
+        # all Tasks store and look up their completion records here, each
+        # executor thread might read at once
+        if cache_shard_count > 1:
+            self._cache_backend = _ShardedSQLiteCacheBackend(
+                self._taskgraph_cache_dir_path, max(1, n_workers),
+                cache_shard_count)
+        else:
+            self._cache_backend = _CACHE_BACKEND_MAP[cache_backend](
+                self._taskgraph_cache_dir_path, max(1, n_workers))
+
+        # load the keys of every completion record once so a Task that was
+        # never completed is known not to be precalculated without a lookup
+        self._reexecution_hash_index = _ReexecutionHashIndex()
+        self._reexecution_hash_index.load(self._cache_backend)
+
+        self._hash_function_callees = hash_function_callees
+
+        # if not None, Tasks record how long they took to execute here
+        self._runtime_history = None
+        if record_runtime_history:
+            runtime_history_path = None
+            if cache_backend != 'memory':
+                runtime_history_path = os.path.join(
+                    self._taskgraph_cache_dir_path,
+                    _RUNTIME_HISTORY_DATABASE_FILENAME)
+            self._runtime_history = _RuntimeHistory(runtime_history_path)
+
+        # if not None, file stats are shared by all Tasks through this memo
+        self._stat_memo = None
+        if stat_memo_max_age is not None:
+            self._stat_memo = _StatMemo(stat_memo_max_age)
+
+        # listings of the directories fingerprinted by ``hash_directories``
+        # Tasks, shared by all Tasks
+        self._directory_listing_cache = _DirectoryListingCache(
+            _DIRECTORY_LISTING_CACHE_SIZE)
+
+        # if not None, file digests are looked up here before a file is read
+        self._file_fingerprint_cache = None
+        if cache_file_fingerprints:
+            # like the completion records the digests aren't persisted
+            # with the memory backend
+            fingerprint_database_path = None
+            if cache_backend != 'memory':
+                fingerprint_database_path = os.path.join(
+                    self._taskgraph_cache_dir_path,
+                    _FILE_FINGERPRINT_DATABASE_FILENAME)
+            self._file_fingerprint_cache = _FileFingerprintCache(
+                fingerprint_database_path, max(1, n_workers))
+        LOGGER.debug(
+            'loaded %d known task reexecution hashes',
+            len(self._reexecution_hash_index))
 
-        # check the version of the database and warn if a problem
-        local_version = _execute_sqlite(
-            '''
-            SELECT value
-            FROM global_variables
-            WHERE key=?
-            ''', self._task_database_path, mode='read_only',
-            fetch='one', argument_list=['version'])[0]
-        if local_version != __version__:
-            LOGGER.warning(
-                f'the database located at {self._task_database_path} was '
-                f'created with TaskGraph version {local_version} but the '
-                f'current version is {__version__}')
+        # if n_workers >= 0 this will be a _CompletionRecordWriter that
+        # batches Task completion records into fewer transactions, otherwise
+        # Tasks write their records directly
+        self._completion_record_writer = None
+        # the writer batches access times too, without one they're kept
+        # here until the TaskGraph is joined
+        self._access_time_buffer = None
 
         # no need to set up schedulers if n_workers is single threaded
         self._n_workers = n_workers
         if n_workers < 0:
+            self._access_time_buffer = _AccessTimeBuffer(self._cache_backend)
             return
 
+        self._completion_record_writer = _CompletionRecordWriter(
+            self._cache_backend,
+            _COMPLETION_RECORD_BATCH_SIZE, _COMPLETION_RECORD_BATCH_INTERVAL)
+
         # start concurrent reporting of taskgraph if reporting interval is set
         self._reporting_interval = reporting_interval
         if reporting_interval is not None:
@@ -407,110 +927,367 @@ class TaskGraph(object):
 
     def _task_executor(self):
         """Worker that executes Tasks that have satisfied dependencies."""
+        last_executor = False
         while True:
-            # this event blocks until the task graph has signaled it wants
-            # the executors to read the state of the queue or a stop event or
-            # a timeout exceeded just to protect against a worst case deadlock
-            self._executor_ready_event.wait(_MAX_TIMEOUT)
-            # this lock synchronizes changes between the queue and
-            # executor_ready_event
-            if self._terminated:
-                LOGGER.debug(
-                    "taskgraph is terminated, ending %s",
-                    threading.currentThread())
-                break
-            task = None
-            try:
-                task = self._task_ready_priority_queue.get_nowait()
-                self._task_waiting_count -= 1
-                task_name_time_tuple = (task.task_name, time.time())
-                self._active_task_list.append(task_name_time_tuple)
-            except queue.Empty:
-                # no tasks are waiting could be because the taskgraph is
-                # closed or because the queue is just empty.
-                if (self._closed and len(self._completed_task_names) ==
-                        self._added_task_count):
-                    # the graph is closed and there are as many completed tasks
-                    # as there are added tasks, so none left. The executor can
-                    # terminate.
+            with self._task_ready_condition:
+                task = None
+                while not self._terminated:
+                    task = self._pop_ready_task()
+                    if task is not None or self._all_tasks_complete():
+                        break
+                    self._task_ready_condition.wait()
+                if self._terminated:
+                    LOGGER.debug(
+                        "taskgraph is terminated, ending %s",
+                        threading.currentThread())
+                    break
+                if task is None:
+                    # the graph is closed and there are as many completed
+                    # tasks as there are added tasks, so none left. The
+                    # executor can terminate.
                     self._executor_thread_count -= 1
-                    if self._executor_thread_count == 0 and self._worker_pool:
-                        # only the last executor should terminate the worker
-                        # pool, because otherwise who knows if it's still
-                        # executing anything
-                        try:
-                            self._worker_pool.close()
-                            self._worker_pool.terminate()
-                            self._worker_pool = None
-                            self._terminate()
-                        except Exception:
-                            # there's the possibility for a race condition here
-                            # where another thread already closed the worker
-                            # pool, so just guard against it
-                            LOGGER.warning('worker pool was already closed')
+                    last_executor = self._executor_thread_count == 0
                     LOGGER.debug(
                         "no tasks are pending and taskgraph closed, normally "
                         "terminating executor %s." % threading.currentThread())
                     break
-                else:
-                    # there's still the possibility for work to be added or
-                    # still work in the pipeline
-                    self._executor_ready_event.clear()
-            if task is None:
-                continue
+                task_batch = [task]
+                if (self._worker_pool is not None and
+                        task.task_name in self._batchable_task_name_set):
+                    # leave a share of the ready tasks to the other
+                    # executors
+                    batch_limit = min(
+                        self._task_batch_size,
+                        1 + len(self._task_ready_key_map) // self._n_workers)
+                    while len(task_batch) < batch_limit:
+                        batch_task = self._pop_ready_task(batchable_only=True)
+                        if batch_task is None:
+                            break
+                        task_batch.append(batch_task)
+                self._task_waiting_count -= len(task_batch)
+                start_time = time.time()
+                task_name_time_list = [
+                    (batch_task.task_name, start_time)
+                    for batch_task in task_batch]
+                self._active_task_list.extend(task_name_time_list)
             try:
-                task._call()
-                task.task_done_executing_event.set()
+                if len(task_batch) == 1:
+                    task._call()
+                    task.task_done_executing_event.set()
+                else:
+                    self._call_task_batch(task_batch)
             except Exception as e:
-                # An error occurred on a call, terminate the taskgraph
-                task.exception_object = e
+                # An error occurred on a call, terminate the taskgraph. A
+                # batch has already marked the Task that failed.
+                failed_task = next((
+                    batch_task for batch_task in task_batch
+                    if batch_task.exception_object is not None), task)
+                failed_task.exception_object = e
                 LOGGER.exception(
                     'A taskgraph _task_executor failed on Task '
-                    '%s. Terminating taskgraph.', task.task_name)
+                    '%s. Terminating taskgraph.', failed_task.task_name)
                 self._terminate()
                 break
 
-            LOGGER.debug(
-                "task %s is complete, checking to see if any dependent "
-                "tasks can be executed now", task.task_name)
-            self._completed_task_names.add(task.task_name)
-            self._active_task_list.remove(task_name_time_tuple)
-            for waiting_task_name in (
-                    self._task_dependent_map[task.task_name]):
-                # remove `task` from the set of tasks that
-                # `waiting_task` was waiting on.
-                self._dependent_task_map[waiting_task_name].remove(
-                    task.task_name)
-                # if there aren't any left, we can push `waiting_task`
-                # to the work queue
-                if not self._dependent_task_map[waiting_task_name]:
-                    # if we removed the last task we can put it to the
-                    # work queue
-                    LOGGER.debug(
-                        "Task %s is ready for processing, sending to "
-                        "task_ready_priority_queue",
-                        waiting_task_name)
-                    del self._dependent_task_map[waiting_task_name]
-                    self._task_ready_priority_queue.put(
-                        self._task_name_map[waiting_task_name])
-                    self._task_waiting_count += 1
-                    # indicate to executors there is work to do
-                    self._executor_ready_event.set()
-            del self._task_dependent_map[task.task_name]
-            # this extra set ensures that recently emptied map won't get
-            # ignored by the executor if no work is left to do and the graph is
-            # closed
-            self._executor_ready_event.set()
-            LOGGER.debug("task %s done processing", task.task_name)
+            with self._task_ready_condition:
+                for batch_task, task_name_time_tuple in zip(
+                        task_batch, task_name_time_list):
+                    self._complete_task(batch_task, task_name_time_tuple)
+                if self._all_tasks_complete():
+                    # idle executors can shut down
+                    self._task_ready_condition.notify_all()
+        if last_executor and self._worker_pool:
+            # only the last executor should terminate the worker pool,
+            # because otherwise who knows if it's still executing anything
+            try:
+                self._worker_pool.close()
+                self._worker_pool.terminate()
+                self._worker_pool = None
+                self._terminate()
+            except Exception:
+                # there's the possibility for a race condition here where
+                # another thread already closed the worker pool, so just
+                # guard against it
+                LOGGER.warning('worker pool was already closed')
         LOGGER.debug("task executor shutting down")
 
+    def _complete_task(self, task, task_name_time_tuple):
+        """Release a Task's resources and queue the tasks waiting on it.
+
+        Must be called while holding ``self._task_ready_condition``.
+
+        Args:
+            task (Task): a Task that executed successfully.
+            task_name_time_tuple (tuple): the entry of ``task`` in
+                ``self._active_task_list``.
+
+        Returns:
+            None.
+
+        """
+        LOGGER.debug(
+            "task %s is complete, checking to see if any dependent "
+            "tasks can be executed now", task.task_name)
+        self._completed_task_names.add(task.task_name)
+        self._active_task_list.remove(task_name_time_tuple)
+        self._batchable_task_name_set.discard(task.task_name)
+        if task.task_name in self._resource_holder_name_set:
+            self._resource_holder_name_set.remove(task.task_name)
+            for resource_name, amount in self._task_resource_map.pop(
+                    task.task_name).items():
+                self._resource_usage_map[resource_name] -= amount
+            if not self._resource_holder_name_set:
+                # don't let released amounts leave rounding error behind
+                self._resource_usage_map.clear()
+            # this executor pops next, and wakes another one if the
+            # blocked task after that fits too
+        # critical paths don't extend through completed tasks
+        self._critical_path_length_map.pop(task.task_name, None)
+        self._task_weight_map.pop(task.task_name, None)
+        self._task_dependency_name_map.pop(task.task_name, None)
+        for waiting_task_name in self._task_dependent_map.pop(
+                task.task_name, ()):
+            # remove `task` from the set of tasks that
+            # `waiting_task` was waiting on.
+            self._dependent_task_map[waiting_task_name].remove(
+                task.task_name)
+            # if there aren't any left, we can push `waiting_task`
+            # to the work queue
+            if not self._dependent_task_map[waiting_task_name]:
+                LOGGER.debug(
+                    "Task %s is ready for processing, sending to "
+                    "task_ready_heap", waiting_task_name)
+                del self._dependent_task_map[waiting_task_name]
+                self._push_ready_task(
+                    self._task_name_map[waiting_task_name])
+        LOGGER.debug("task %s done processing", task.task_name)
+
+    def _call_task_batch(self, task_batch):
+        """Execute several Tasks with one call to the worker pool.
+
+        Precalculated Tasks are not sent to the worker. If a Task fails its
+        ``exception_object`` is set and the exception is raised, the Tasks
+        after it in the batch are not executed.
+
+        Args:
+            task_batch (list): Tasks whose dependencies are satisfied.
+
+        Returns:
+            None.
+
+        """
+        call_list = []
+        for task in task_batch:
+            try:
+                call_argument_list = task._prepare_call()
+            except Exception as e:
+                task.exception_object = e
+                raise
+            if call_argument_list is not None:
+                call_list.append((task, call_argument_list))
+        if not call_list:
+            return
+        LOGGER.debug("apply_async for a batch of %d tasks", len(call_list))
+        outcome_list = self._worker_pool.apply_async(
+            func=_call_batch_and_fingerprint_targets,
+            args=([
+                call_argument_list for _, call_argument_list in call_list],
+            )).get()
+        for (task, _), (exception, call_result) in zip(
+                call_list, outcome_list):
+            try:
+                if exception is not None:
+                    raise exception
+                task._finish_call(call_result)
+            except Exception as e:
+                task.exception_object = e
+                raise
+
+    def _push_ready_task(self, task):
+        """Push a Task to the ready heap and wake one idle executor.
+
+        Must be called while holding ``self._task_ready_condition``.
+
+        """
+        self._push_ready_entry(task)
+        self._task_waiting_count += 1
+        self._task_ready_condition.notify()
+
+    def _push_ready_entry(self, task):
+        """Push a heap entry for ``task`` with its current key."""
+        if self._priority_mode != 'user':
+            key = (
+                -self._critical_path_length_map[task.task_name],
+                task._priority)
+        else:
+            key = task._priority
+        self._task_ready_key_map[task.task_name] = key
+        heapq.heappush(
+            self._task_ready_heap,
+            (key, next(self._task_ready_sequence), task))
+
+    def _pop_ready_task(self, batchable_only=False):
+        """Pop the first ready Task whose resources are free.
+
+        Stale entries are skipped. A Task whose resources aren't free is
+        moved to the blocked heap. The first blocked Task has the free
+        resources reserved, so a lower priority Task is only popped if it
+        fits in what's left. The resources the Task requires are held until
+        it completes.
+
+        Must be called while holding ``self._task_ready_condition``.
+
+        Args:
+            batchable_only (bool): if True, only pop a Task that can be
+                executed in a batch.
+
+        Returns:
+            a Task or None if no ready Task fits the free resources.
+
+        """
+        skipped_entry_list = []
+        reserved_resource_map = None
+        task = None
+        while True:
+            ready_entry = self._peek_entry(self._task_ready_heap)
+            if reserved_resource_map is None:
+                blocked_entry = self._peek_entry(self._task_blocked_heap)
+                if blocked_entry is not None and (
+                        ready_entry is None or blocked_entry < ready_entry):
+                    if self._is_poppable(
+                            blocked_entry[2], batchable_only, None):
+                        task = heapq.heappop(self._task_blocked_heap)[2]
+                        break
+                    reserved_resource_map = self._task_resource_map[
+                        blocked_entry[2].task_name]
+                    continue
+            if ready_entry is None:
+                break
+            heapq.heappop(self._task_ready_heap)
+            candidate_task = ready_entry[2]
+            if self._is_poppable(
+                    candidate_task, batchable_only, reserved_resource_map):
+                task = candidate_task
+                break
+            if self._resources_fit(
+                    candidate_task.task_name, reserved_resource_map):
+                # it fits but can't be batched
+                skipped_entry_list.append(ready_entry)
+            else:
+                heapq.heappush(self._task_blocked_heap, ready_entry)
+        for entry in skipped_entry_list:
+            heapq.heappush(self._task_ready_heap, entry)
+        if task is None:
+            return None
+        del self._task_ready_key_map[task.task_name]
+        resource_map = self._task_resource_map.get(task.task_name)
+        if resource_map:
+            self._resource_holder_name_set.add(task.task_name)
+            for resource_name, amount in resource_map.items():
+                self._resource_usage_map[resource_name] = (
+                    self._resource_usage_map.get(resource_name, 0) + amount)
+        blocked_entry = self._peek_entry(self._task_blocked_heap)
+        if blocked_entry is not None and self._resources_fit(
+                blocked_entry[2].task_name):
+            # the resources this Task didn't take fit a blocked one
+            self._task_ready_condition.notify()
+        return task
+
+    def _peek_entry(self, task_heap):
+        """Return the first entry of ``task_heap`` that isn't stale."""
+        while task_heap:
+            key, _, task = task_heap[0]
+            if self._task_ready_key_map.get(task.task_name) == key:
+                return task_heap[0]
+            heapq.heappop(task_heap)
+        return None
+
+    def _is_poppable(self, task, batchable_only, reserved_resource_map):
+        """Return True if ``task`` fits and can be batched if required."""
+        return self._resources_fit(task.task_name, reserved_resource_map) and (
+            not batchable_only or
+            task.task_name in self._batchable_task_name_set)
+
+    def _resources_fit(self, task_name, reserved_resource_map=None):
+        """Return True if the resources a task requires are free.
+
+        Args:
+            task_name (str): name of a ready task.
+            reserved_resource_map (dict): if not None, resource amounts
+                reserved for a blocked task that ``task_name`` can't use.
+
+        Returns:
+            True if the task requires no resources or they fit.
+
+        """
+        resource_map = self._task_resource_map.get(task_name)
+        if not resource_map:
+            return True
+        for resource_name, amount in resource_map.items():
+            used_amount = self._resource_usage_map.get(resource_name, 0)
+            if reserved_resource_map:
+                used_amount += reserved_resource_map.get(resource_name, 0)
+            if used_amount + amount > self._resource_capacity[resource_name]:
+                return False
+        return True
+
+    def _extend_critical_paths(
+            self, task_name, dep_task_name_list, task_weight):
+        """Lengthen the critical paths of the tasks ``task_name`` needs.
+
+        ``task_name`` was just added so its own critical path is itself.
+        Every incomplete task it depends on, directly or not, whose path
+        becomes longer through it is updated, and ready tasks are pushed
+        again with their new key.
+
+        Must be called while holding ``self._task_ready_condition``.
+
+        Args:
+            task_name (str): name of a task just added to the graph.
+            dep_task_name_list (list): names of the incomplete tasks
+                ``task_name`` depends on.
+            task_weight (float): weight of ``task_name`` in the length of a
+                critical path.
+
+        Returns:
+            None.
+
+        """
+        self._critical_path_length_map[task_name] = task_weight
+        self._task_weight_map[task_name] = task_weight
+        self._task_dependency_name_map[task_name] = dep_task_name_list
+        update_stack = [
+            (dep_task_name, task_weight)
+            for dep_task_name in dep_task_name_list]
+        while update_stack:
+            dep_task_name, downstream_length = update_stack.pop()
+            if dep_task_name in self._completed_task_names:
+                continue
+            path_length = (
+                self._task_weight_map[dep_task_name] + downstream_length)
+            if path_length <= self._critical_path_length_map[dep_task_name]:
+                continue
+            self._critical_path_length_map[dep_task_name] = path_length
+            if dep_task_name in self._task_ready_key_map:
+                self._push_ready_entry(self._task_name_map[dep_task_name])
+            update_stack.extend(
+                (next_task_name, path_length)
+                for next_task_name in self._task_dependency_name_map[
+                    dep_task_name])
+
+    def _all_tasks_complete(self):
+        """Return True if the graph is closed and every Task completed."""
+        return self._closed and (
+            len(self._completed_task_names) == self._added_task_count)
+
     def add_task(
             self, func=None, args=None, kwargs=None, task_name=None,
             target_path_list=None, ignore_path_list=None,
             hash_target_files=True, dependent_task_list=None,
             ignore_directories=True, priority=0,
             hash_algorithm='sizetimestamp', transient_run=False,
-            store_result=False):
+            store_result=False, result_compression=None,
+            hash_directories=False, resources=None, batchable=None):
         """Add a task to the task graph.
 
         Args:
@@ -563,7 +1340,16 @@ class TaskGraph(object):
                 same base path files to determine equality. If it is a
                 ``hashlib`` algorithm only file contents will be considered.
                 If the value is 'exists' the only test for file equivalence
-                will be if it exists on disk (True) or not (False).
+                will be if it exists on disk (True) or not (False). Other
+                content hashes are 'blake2b_128', a 128 bit blake2b digest,
+                and if the ``xxhash`` package is installed the much faster
+                non-cryptographic 'xxh64', 'xxh3_64', and 'xxh3_128'. If the
+                value is 'headtail' only the size and a fixed number of
+                samples from the start, end, and evenly spaced offsets of a
+                file are digested. Its cost doesn't grow with file size and,
+                unlike 'sizetimestamp', it doesn't change when a file is
+                copied, but a change that misses every sample is not
+                detected.
             transient_run (bool): if True, this Task will be reexecuted
                 even if it was successfully executed in a previous TaskGraph
                 instance. If False, this Task will be skipped if it was
@@ -575,6 +1361,29 @@ class TaskGraph(object):
             store_result (bool): If True, the result of ``func`` will be stored
                 in the TaskGraph database and retrievable with a call to
                 ``.get()`` on a ``Task`` object.
+            result_compression (string): if not None, overrides the
+                ``result_compression`` of the TaskGraph for this Task's
+                stored result. One of 'zlib', 'lzma', 'bz2', or 'none' to
+                store it uncompressed.
+            hash_directories (bool): if True, directories found in args or
+                kwargs are fingerprinted by a Merkle tree of the digests of
+                the files under them, made with ``hash_algorithm``, so the
+                Task reexecutes when a file in a directory is added,
+                removed, or changed. Only files whose size or modified time
+                changed are digested again. ``ignore_directories`` doesn't
+                apply to these directories.
+            resources (dict): if not None, maps resource names in the
+                TaskGraph's ``resource_capacity`` to the amount of them this
+                Task uses while it executes, such as ``{'cpus': 4,
+                'memory_gb': 30}``. The Task only starts once that much of
+                each is free. Resources not named here or not in
+                ``resource_capacity`` are not limited.
+            batchable (bool): if True, this Task is short enough that it
+                may be executed by the same call to a worker process as
+                other ready batchable Tasks, see ``task_batch_size``. If
+                None it's batchable if the TaskGraph's
+                ``batch_runtime_threshold`` is set and the runtime history
+                expects the Task to take less time than that.
 
         Returns:
             Task which was just added to the graph or an existing Task that
@@ -586,6 +1395,10 @@ class TaskGraph(object):
                 are not Tasks.
             ValueError if ``add_task`` is invoked after the ``TaskGraph`` is
                 closed.
+            ValueError if ``result_compression`` is not a known algorithm.
+            ValueError if ``hash_algorithm`` is not available.
+            ValueError if ``resources`` requires a negative amount or more
+                of a resource than the TaskGraph's ``resource_capacity``.
             RuntimeError if ``add_task`` is invoked after ``TaskGraph`` has
                 reached a terminate state.
 
@@ -605,6 +1418,20 @@ class TaskGraph(object):
                 kwargs = {}
             if task_name is None:
                 task_name = 'UNNAMED TASK'
+            resource_map = {}
+            for resource_name, amount in (resources or {}).items():
+                if amount < 0:
+                    raise ValueError(
+                        f'Task {task_name} requires a negative amount of '
+                        f'{resource_name}: {amount}')
+                if resource_name not in self._resource_capacity:
+                    continue
+                if amount > self._resource_capacity[resource_name]:
+                    raise ValueError(
+                        f'Task {task_name} requires {amount} of '
+                        f'{resource_name} but the resource_capacity is '
+                        f'{self._resource_capacity[resource_name]}')
+                resource_map[resource_name] = amount
             if dependent_task_list is None:
                 dependent_task_list = []
             if target_path_list is None:
@@ -613,6 +1440,18 @@ class TaskGraph(object):
                 ignore_path_list = []
             if func is None:
                 func = _null_func
+            if result_compression is None:
+                result_compression = self._result_compression
+            elif result_compression == 'none':
+                result_compression = None
+            elif result_compression not in _RESULT_COMPRESSION_MAP:
+                raise ValueError(
+                    f'Unknown result_compression: {result_compression}, '
+                    f'expected one of {sorted(_RESULT_COMPRESSION_MAP)}, '
+                    '\'none\', or None')
+            if hash_algorithm not in ('sizetimestamp', 'exists', 'headtail'):
+                # raises a ValueError if the algorithm is not available
+                _new_hash(hash_algorithm)
 
             # this is a pretty common error to accidentally not pass a
             # Task to the dependent task list.
@@ -627,8 +1466,14 @@ class TaskGraph(object):
                 task_name, func, args, kwargs, target_path_list,
                 ignore_path_list, hash_target_files, ignore_directories,
                 transient_run, self._worker_pool,
-                priority, hash_algorithm, store_result,
-                self._task_database_path)
+                priority, hash_algorithm, store_result, self._cache_backend,
+                self._completion_record_writer, self._access_time_buffer,
+                self._reexecution_hash_index,
+                result_compression, self._result_compression_threshold,
+                self._result_spill_threshold, self._result_spill_dir_path,
+                self._file_fingerprint_cache, self._stat_memo,
+                self._hash_function_callees, hash_directories,
+                self._directory_listing_cache, self._runtime_history)
 
             self._task_name_map[new_task.task_name] = new_task
             # it may be this task was already created in an earlier call,
@@ -679,27 +1524,57 @@ class TaskGraph(object):
                 LOGGER.debug(
                     "multithreaded: %s sending to new task queue.",
                     task_name)
-                outstanding_dep_task_name_list = [
-                    dep_task.task_name for dep_task in dependent_task_list
-                    if dep_task.task_name
-                    not in self._completed_task_names]
-                if not outstanding_dep_task_name_list:
-                    LOGGER.debug(
-                        "sending task %s right away", new_task.task_name)
-                    self._task_ready_priority_queue.put(new_task)
-                    self._task_waiting_count += 1
-                    self._executor_ready_event.set()
-                else:
-                    # there are unresolved tasks that the waiting
-                    # process scheduler has not been notified of.
-                    # Record dependencies.
-                    for dep_task_name in outstanding_dep_task_name_list:
-                        # record tasks that are dependent on dep_task_name
-                        self._task_dependent_map[dep_task_name].add(
+                # the lock keeps a dependency from completing between
+                # checking it and recording it
+                if batchable is None:
+                    batchable = False
+                    if (self._batch_runtime_threshold is not None and
+                            self._runtime_history is not None):
+                        known_runtime = (
+                            self._runtime_history.get_known_runtime(
+                                new_task._task_id_hash,
+                                _get_function_name(func)))
+                        batchable = known_runtime is not None and (
+                            known_runtime < self._batch_runtime_threshold)
+                with self._task_ready_condition:
+                    if resource_map:
+                        self._task_resource_map[new_task.task_name] = (
+                            resource_map)
+                    if batchable:
+                        self._batchable_task_name_set.add(new_task.task_name)
+                    outstanding_dep_task_name_list = [
+                        dep_task.task_name
+                        for dep_task in dependent_task_list
+                        if dep_task.task_name
+                        not in self._completed_task_names]
+                    if self._priority_mode == 'critical_path':
+                        self._extend_critical_paths(
+                            new_task.task_name,
+                            outstanding_dep_task_name_list, 1)
+                    elif self._priority_mode == 'runtime':
+                        self._extend_critical_paths(
+                            new_task.task_name,
+                            outstanding_dep_task_name_list,
+                            self._runtime_history.get_expected_runtime(
+                                new_task._task_id_hash,
+                                _get_function_name(func)))
+                    if not outstanding_dep_task_name_list:
+                        LOGGER.debug(
+                            "sending task %s right away",
                             new_task.task_name)
-                        # record tasks that new_task depends on
-                        self._dependent_task_map[new_task.task_name].add(
-                            dep_task_name)
+                        self._push_ready_task(new_task)
+                    else:
+                        # there are unresolved tasks that the waiting
+                        # process scheduler has not been notified of.
+                        # Record dependencies.
+                        for dep_task_name in outstanding_dep_task_name_list:
+                            # record tasks that are dependent on
+                            # dep_task_name
+                            self._task_dependent_map[dep_task_name].add(
+                                new_task.task_name)
+                            # record tasks that new_task depends on
+                            self._dependent_task_map[
+                                new_task.task_name].add(dep_task_name)
             return new_task
 
         except Exception:
@@ -727,7 +1602,7 @@ class TaskGraph(object):
             if self._terminated:
                 break
             active_task_count = len(self._active_task_list)
-            queue_length = self._task_ready_priority_queue.qsize()
+            queue_length = len(self._task_ready_key_map)
             active_task_message = '\n'.join(
                 ['\t%s: executing for %.2fs' % (
                     task_name, time.time() - task_time)
@@ -742,7 +1617,7 @@ class TaskGraph(object):
             LOGGER.info(
                 "\n\ttaskgraph execution status: tasks added: %d \n"
                 "\ttasks complete: %d (%.1f%%) \n"
-                "\ttasks waiting for a free worker: %d (qsize: %d)\n"
+                "\ttasks waiting for a free worker: %d (ready: %d)\n"
                 "\ttasks executing (%d): graph is %s\n%s",
                 self._added_task_count, completed_tasks, percent_complete,
                 self._task_waiting_count, queue_length, active_task_count,
@@ -767,7 +1642,14 @@ class TaskGraph(object):
 
         """
         LOGGER.debug("joining taskgraph")
-        if self._n_workers < 0 or self._terminated:
+        if self._n_workers < 0:
+            self._access_time_buffer.flush()
+            if self._runtime_history is not None:
+                self._runtime_history.flush()
+            return True
+        if self._terminated:
+            # another thread might still be committing completion records
+            self._completion_record_writer.stop()
             return True
         try:
             LOGGER.debug("attempting to join threads")
@@ -782,9 +1664,12 @@ class TaskGraph(object):
                     LOGGER.info(
                         "task %s timed out in graph join", task.task_name)
                     return False
+            # make sure every completed Task is recorded in the database
+            self._completion_record_writer.flush()
+            if self._runtime_history is not None:
+                self._runtime_history.flush()
             if self._closed:
                 # Close down the taskgraph
-                self._executor_ready_event.set()
                 self._terminate()
             return True
         except Exception:
@@ -797,6 +1682,9 @@ class TaskGraph(object):
                 "exception terminated the task_graph. Check the log to see "
                 "if there are other exceptions.", task)
             self._terminate()
+            # the records of Tasks that did complete are committed even if
+            # another thread is the one terminating the TaskGraph
+            self._completion_record_writer.stop()
             raise
 
     def close(self):
@@ -805,11 +1693,123 @@ class TaskGraph(object):
         if self._closed:
             return
         self._closed = True
+        if self._n_workers < 0:
+            # every Task has already executed in the main thread
+            self._prune_cache_on_close()
         # this wakes up all the executors and any that wouldn't otherwise
         # have work to do will see there are no tasks left and terminate
-        self._executor_ready_event.set()
+        with self._task_ready_condition:
+            self._task_ready_condition.notify_all()
         LOGGER.debug("taskgraph closed")
 
+    def get_runtime_stats(self, task):
+        """Return the recorded runtime statistics of a Task.
+
+        Args:
+            task (Task): a Task returned by ``add_task``.
+
+        Returns:
+            a dict with the keys 'task' for the statistics of every run of
+            a Task with the same function and arguments as ``task``, and
+            'function' for those of every Task with the same function. Each
+            is None if no such Task executed since the runtime history was
+            pruned, otherwise a dict with the keys 'run_count',
+            'mean_runtime' and 'p95_runtime' in seconds, and
+            'peak_memory' in bytes or None if it was never measured. The
+            peak memory is the most resident memory of a process while it
+            executed one of the Tasks, it's only measured when that is
+            more than the process used before.
+
+        Raises:
+            ValueError if the TaskGraph doesn't record its runtime history,
+                see ``record_runtime_history``.
+
+        """
+        if self._runtime_history is None:
+            raise ValueError(
+                'runtime history is not recorded by this TaskGraph')
+        return {
+            'task': self._runtime_history.get_stats(
+                'task', task._task_id_hash),
+            'function': self._runtime_history.get_stats(
+                'function', _get_function_name(task._func)),
+        }
+
+    def prune_cache(self, max_bytes=None, max_age=None):
+        """Remove completion records from the TaskGraph cache.
+
+        Records of Tasks that were not used within ``max_age`` seconds are
+        removed first, then the least recently used records are removed
+        until the cache takes no more than ``max_bytes``. A record is used
+        when its Task executes or is found to be precalculated. Records of
+        Tasks added to this TaskGraph are never removed. A Task whose record
+        was removed is executed again the next time it's added to a
+        TaskGraph. The runtime history of Tasks and functions that did not
+        execute within ``max_age`` seconds is removed too, as are the cached
+        digests of files that changed or no longer exist.
+
+        Args:
+            max_bytes (int): if not None, the maximum number of bytes of
+                records and spilled results to keep in the cache.
+            max_age (float): if not None, remove records that have not been
+                used in this many seconds.
+
+        Returns:
+            number of records removed.
+
+        """
+        # make sure the access times and sizes are up to date
+        if self._completion_record_writer is not None:
+            self._completion_record_writer.flush()
+        if self._access_time_buffer is not None:
+            self._access_time_buffer.flush()
+        if self._file_fingerprint_cache is not None:
+            self._file_fingerprint_cache.prune()
+        if self._runtime_history is not None and max_age is not None:
+            self._runtime_history.prune(max_age)
+        protected_hash_set = set(
+            task._task_reexecution_hash
+            for task in list(self._task_hash_map.values()))
+        prune_hash_list, cache_size = self._cache_backend.prune(
+            max_bytes, max_age, protected_hash_set)
+        for task_reexecution_hash in prune_hash_list:
+            self._reexecution_hash_index.discard(task_reexecution_hash)
+        if not prune_hash_list:
+            return 0
+        # a result can be spilled to more than one file of its hash if a
+        # file couldn't be replaced, see ``_write_spill_file``
+        prune_hash_set = set(prune_hash_list)
+        try:
+            spill_filename_list = os.listdir(self._result_spill_dir_path)
+        except FileNotFoundError:
+            spill_filename_list = []
+        for spill_filename in spill_filename_list:
+            if spill_filename.split('.', 1)[0] not in prune_hash_set:
+                continue
+            try:
+                os.remove(os.path.join(
+                    self._result_spill_dir_path, spill_filename))
+            except FileNotFoundError:
+                pass
+            except PermissionError:
+                # still memory mapped by a loaded result on Windows
+                LOGGER.warning(
+                    f'could not remove {spill_filename}, it is in use')
+        LOGGER.info(
+            'pruned %d records from the TaskGraph cache, %d bytes remain',
+            len(prune_hash_list), cache_size)
+        return len(prune_hash_list)
+
+    def _prune_cache_on_close(self):
+        """Prune the cache once if ``cache_max_*`` was set on creation."""
+        if self._cache_pruned or (
+                self._cache_max_bytes is None and
+                self._cache_max_age is None):
+            return
+        self._cache_pruned = True
+        self.prune_cache(
+            max_bytes=self._cache_max_bytes, max_age=self._cache_max_age)
+
     def _terminate(self):
         """Immediately terminate remaining task graph computation."""
         LOGGER.debug(
@@ -819,10 +1819,10 @@ class TaskGraph(object):
         try:
             # it's possible the global state is not well defined, so just in
             # case we'll wrap it all up in a try/except
-            self._terminated = True
-            if self._executor_ready_event is not None:
+            with self._task_ready_condition:
+                self._terminated = True
                 # alert executors to check that _terminated is True
-                self._executor_ready_event.set()
+                self._task_ready_condition.notify_all()
             LOGGER.debug("shutting down workers")
             if self._worker_pool is not None:
                 self._worker_pool.close()
@@ -835,13 +1835,31 @@ class TaskGraph(object):
 
             # This will cause all 'join'ed Tasks to join.
             if self._n_workers >= 0:
-                self._executor_ready_event.set()
                 if self._reporting_interval is not None:
                     self._execution_monitor_wait_event.set()
                 for task in self._task_hash_map.values():
                     # shortcut to get the tasks to mark as joined
                     task.task_done_executing_event.set()
 
+            if self._n_workers >= 0 and self._closed and (
+                    len(self._completed_task_names) ==
+                    self._added_task_count):
+                # this is a normal shutdown once every Task is complete
+                self._prune_cache_on_close()
+
+            # commit records of the Tasks that did complete, then release
+            # the cache backend's file handles, a Task still finishing up will
+            # transparently reopen them if it needs to
+            if self._completion_record_writer is not None:
+                self._completion_record_writer.stop()
+            if self._access_time_buffer is not None:
+                self._access_time_buffer.flush()
+            if self._runtime_history is not None:
+                self._runtime_history.flush()
+            self._cache_backend.close()
+            if self._file_fingerprint_cache is not None:
+                self._file_fingerprint_cache.close()
+
             LOGGER.debug('taskgraph terminated')
         except Exception:
             LOGGER.exception(
@@ -855,7 +1873,12 @@ class Task(object):
             self, task_name, func, args, kwargs, target_path_list,
             ignore_path_list, hash_target_files, ignore_directories,
             transient_run, worker_pool, priority, hash_algorithm,
-            store_result, task_database_path):
+            store_result, cache_backend, completion_record_writer,
+            access_time_buffer, reexecution_hash_index, result_compression,
+            result_compression_threshold, result_spill_threshold,
+            result_spill_dir_path, file_fingerprint_cache, stat_memo,
+            hash_function_callees, hash_directories, directory_listing_cache,
+            runtime_history):
         """Make a Task.
 
         Args:
@@ -899,20 +1922,52 @@ class Task(object):
                 the digest will only use the normed path, size, and timestamp
                 of any files found in the arguments. If 'exists' will be
                 considered the same file only if a file with the same filename
-                exists on disk.
+                exists on disk. If 'headtail' the digest only uses the size
+                and samples of the contents of the files.
             store_result (bool): If true, the result of ``func`` will be
                 stored in the TaskGraph database and retrievable with a call
                 to ``.get()`` on the Task object.
-            task_database_path (str): path to an SQLITE database that has
-                table named "taskgraph_data" with the three fields:
-                    task_hash TEXT NOT NULL,
-                    target_path_stats BLOB NOT NULL
-                    result BLOB NOT NULL
-                If a call is successful its hash is inserted/updated in the
-                table, the target_path_stats stores the base/target stats
-                for the target files created by the call and listed in
-                ``target_path_list``, and the result of ``func`` is stored in
-                ``result``.
+            cache_backend (_CacheBackend): store of completion records.
+                If a call is successful a record is put under its hash with
+                the base/target stats for the target files created by the
+                call and listed in ``target_path_list``, and the result of
+                ``func``.
+            completion_record_writer (_CompletionRecordWriter): if not None,
+                completion records are submitted to this writer to be
+                committed in a batch rather than put by ``_call``.
+            access_time_buffer (_AccessTimeBuffer): if
+                ``completion_record_writer`` is None, the last access time
+                of a precalculated record is kept here until it's flushed.
+            reexecution_hash_index (_ReexecutionHashIndex): index of the
+                task reexecution hashes that have a completion record. A hash
+                missing from the index is not precalculated and the cache
+                backend is not queried for it. ``_call`` adds this Task's hash
+                when it's recorded.
+            result_compression (string): if not None, one of the algorithms
+                in ``_RESULT_COMPRESSION_MAP`` used to compress the stored
+                result.
+            result_compression_threshold (int): stored results that pickle
+                to fewer bytes than this are not compressed.
+            result_spill_threshold (int): if not None, stored results that
+                pickle to at least this many bytes are written to a file in
+                ``result_spill_dir_path`` and only referenced in the
+                completion record.
+            result_spill_dir_path (str): directory for spilled results.
+            file_fingerprint_cache (_FileFingerprintCache): if not None,
+                digests of files hashed with a ``hashlib`` algorithm are
+                looked up and stored here.
+            stat_memo (_StatMemo): if not None, file stats are looked up in
+                this memo shared with other Tasks, otherwise each check of
+                whether the Task is precalculated uses its own memo.
+            hash_function_callees (bool): passed to
+                ``_get_function_fingerprint`` for ``func`` and any functions
+                in ``args`` and ``kwargs``.
+            hash_directories (bool): if True, directories in ``args`` and
+                ``kwargs`` are fingerprinted with ``_hash_directory``.
+            directory_listing_cache (_DirectoryListingCache): if not None,
+                passed to ``_hash_directory`` to reuse directory listings.
+            runtime_history (_RuntimeHistory): if not None, the runtime of
+                ``func`` is recorded here each time it's called.
 
         """
         # it is a common error to accidentally pass a non string as to the
@@ -936,9 +1991,21 @@ class Task(object):
             _normalize_path(path) for path in ignore_path_list]
         self._hash_target_files = hash_target_files
         self._ignore_directories = ignore_directories
+        self._hash_directories = hash_directories
+        self._directory_listing_cache = directory_listing_cache
+        self._runtime_history = runtime_history
         self._transient_run = transient_run
         self._worker_pool = worker_pool
-        self._task_database_path = task_database_path
+        self._cache_backend = cache_backend
+        self._completion_record_writer = completion_record_writer
+        self._access_time_buffer = access_time_buffer
+        self._reexecution_hash_index = reexecution_hash_index
+        self._result_compression = result_compression
+        self._result_compression_threshold = result_compression_threshold
+        self._result_spill_threshold = result_spill_threshold
+        self._result_spill_dir_path = result_spill_dir_path
+        self._file_fingerprint_cache = file_fingerprint_cache
+        self._stat_memo = stat_memo
         self._hash_algorithm = hash_algorithm
         self._store_result = store_result
         self.exception_object = None
@@ -954,21 +2021,14 @@ class Task(object):
 
         # These are used to store and later access the result of the call.
         self._result = None
+        # True if the Task was precalculated and ``_result`` has not been
+        # loaded from the database yet, the lock guards the load in ``get``
+        self._result_needs_load = False
+        self._result_lock = threading.Lock()
 
         # Calculate a hash based only on argument inputs.
-        try:
-            if not hasattr(Task, 'func_source_map'):
-                Task.func_source_map = {}
-            # memoize func source code because it's likely we'll import
-            # the same func many times and reflection is slow
-            if self._func not in Task.func_source_map:
-                Task.func_source_map[self._func] = (
-                    inspect.getsource(self._func))
-            source_code = Task.func_source_map[self._func]
-        except (IOError, TypeError):
-            # many reasons for this, for example, frozen Python code won't
-            # have source code, so just leave blank
-            source_code = ''
+        func_fingerprint = _get_function_fingerprint(
+            self._func, hash_function_callees)
 
         if not hasattr(self._func, '__name__'):
             LOGGER.warning(
@@ -977,11 +2037,16 @@ class Task(object):
                 "been changed with another function without __name__.")
             self._func.__name__ = ''
 
+        # each argument is digested on its own so one that can't be hashed
+        # is skipped without affecting the others
+        target_path_set = frozenset(self._target_path_list)
         args_clean = []
+        arg_digest_list = []
         for index, arg in enumerate(self._args):
             try:
-                scrubbed_value = _scrub_task_args(arg, self._target_path_list)
-                _ = pickle.dumps(scrubbed_value)
+                scrubbed_value = _scrub_task_args(
+                    arg, target_path_set, hash_function_callees)
+                arg_digest_list.append(_get_value_digest(scrubbed_value))
                 args_clean.append(scrubbed_value)
             except TypeError:
                 LOGGER.warning(
@@ -991,12 +2056,14 @@ class Task(object):
                     "on a successive run.", index, arg)
 
         kwargs_clean = {}
+        kwarg_digest_map = {}
         # iterate through sorted order so we get the same hash result with the
         # same set of kwargs irrespective of the item dict order.
         for key, arg in sorted(self._kwargs.items()):
             try:
-                scrubbed_value = _scrub_task_args(arg, self._target_path_list)
-                _ = pickle.dumps(scrubbed_value)
+                scrubbed_value = _scrub_task_args(
+                    arg, target_path_set, hash_function_callees)
+                kwarg_digest_map[key] = _get_value_digest(scrubbed_value)
                 kwargs_clean[key] = scrubbed_value
             except TypeError:
                 LOGGER.warning(
@@ -1009,16 +2076,15 @@ class Task(object):
             'func_name': self._func.__name__,
             'args_clean': args_clean,
             'kwargs_clean': kwargs_clean,
-            'source_code_hash': hashlib.sha1(
-                source_code.encode('utf-8')).hexdigest(),
+            'func_fingerprint': func_fingerprint,
         }
 
-        argument_hash_string = ':'.join([
-            repr(self._reexecution_info[key])
-            for key in sorted(self._reexecution_info.keys())])
-
-        self._task_id_hash = hashlib.sha1(
-            argument_hash_string.encode('utf-8')).hexdigest()
+        task_id_hash = hashlib.sha1()
+        _update_hash_with_value(task_id_hash, (
+            self._reexecution_info['func_name'],
+            self._reexecution_info['func_fingerprint'],
+            arg_digest_list, kwarg_digest_map))
+        self._task_id_hash = task_id_hash.hexdigest()
 
         # this will get calculated when ``is_precalculated`` is invoked.
         self._task_reexecution_hash = None
@@ -1070,55 +2136,113 @@ class Task(object):
                 function call is complete.
 
         """
-        LOGGER.debug("_call check if precalculated %s", self.task_name)
-        if not self._transient_run and self.is_precalculated():
-            self.task_done_executing_event.set()
+        call_argument_list = self._prepare_call()
+        if call_argument_list is None:
             return
-        LOGGER.debug("not precalculated %s", self.task_name)
-
         if self._worker_pool is not None:
+            # the worker that made the targets fingerprints them too so
+            # target hashing is spread across the pool
             result = self._worker_pool.apply_async(
-                func=self._func, args=self._args, kwds=self._kwargs)
+                func=_call_and_fingerprint_targets, args=call_argument_list)
             # the following blocks and raises an exception if result
             # raised an exception
             LOGGER.debug("apply_async for task %s", self.task_name)
-            payload = result.get()
+            call_result = result.get()
         else:
             LOGGER.debug("direct _func for task %s", self.task_name)
-            payload = self._func(*self._args, **self._kwargs)
-        if self._store_result:
-            self._result = payload
+            call_result = _call_and_fingerprint_targets(
+                *call_argument_list,
+                fingerprint_cache=self._file_fingerprint_cache)
+        self._finish_call(call_result)
+
+    def _prepare_call(self):
+        """Return the ``_call_and_fingerprint_targets`` arguments to execute.
+
+        Returns:
+            None if the Task is precalculated, in which case
+            ``self.task_done_executing_event`` is set. Otherwise the list of
+            the ``func``, ``args``, ``kwargs``, ``target_path_list``, and
+            ``target_hash_algorithm`` arguments.
+
+        """
+        LOGGER.debug("_call check if precalculated %s", self.task_name)
+        if not self._transient_run and self.is_precalculated():
+            self.task_done_executing_event.set()
+            return None
+        LOGGER.debug("not precalculated %s", self.task_name)
 
-        # check that the target paths exist and record stats for later
         if not self._hash_target_files:
             target_hash_algorithm = 'exists'
         else:
             target_hash_algorithm = self._hash_algorithm
-        result_target_path_stats = list(
-            _get_file_stats(
-                self._target_path_list, target_hash_algorithm, [], False))
-        result_target_path_set = set(
-            [x[0] for x in result_target_path_stats])
-        target_path_set = set(self._target_path_list)
-        if target_path_set != result_target_path_set:
-            raise RuntimeError(
-                "In Task: %s\nMissing expected target path results.\n"
-                "Expected: %s\nObserved: %s\n" % (
-                    self.task_name, self._target_path_list,
-                    result_target_path_set))
+        return [
+            self._func, self._args, self._kwargs, self._target_path_list,
+            target_hash_algorithm]
 
-        # this step will only record the run if there is an expected
-        # target file. Otherwise we infer the result of this call is
-        # transient between taskgraph executions and we should expect to
-        # run it again.
-        if not self._transient_run:
-            _execute_sqlite(
-                "INSERT OR REPLACE INTO taskgraph_data VALUES (?, ?, ?)",
-                self._task_database_path, mode='modify',
-                argument_list=(
-                    self._task_reexecution_hash,
-                    pickle.dumps(result_target_path_stats),
-                    pickle.dumps(self._result)))
+    def _finish_call(self, call_result):
+        """Record the outcome of calling the Task function.
+
+        Sets the ``self.task_done_executing_event`` flag.
+
+        Args:
+            call_result (tuple): the value ``_call_and_fingerprint_targets``
+                returned for the arguments from ``_prepare_call``.
+
+        Returns:
+            None.
+
+        Raises:
+            RuntimeError if any target paths are not generated after the
+                function call is complete.
+
+        """
+        payload, result_target_path_stats, (runtime, peak_memory) = (
+            call_result)
+        if self._runtime_history is not None:
+            self._runtime_history.record(
+                self._task_id_hash, _get_function_name(self._func), runtime,
+                peak_memory)
+        if self._store_result:
+            self._result = payload
+        if self._stat_memo is not None:
+            # ``func`` just changed these files
+            self._stat_memo.invalidate(self._target_path_list)
+
+        # check that the target paths exist and record stats for later
+        result_target_path_set = set(
+            [x[0] for x in result_target_path_stats])
+        target_path_set = set(self._target_path_list)
+        if target_path_set != result_target_path_set:
+            raise RuntimeError(
+                "In Task: %s\nMissing expected target path results.\n"
+                "Expected: %s\nObserved: %s\n" % (
+                    self.task_name, self._target_path_list,
+                    result_target_path_set))
+
+        # this step will only record the run if there is an expected
+        # target file. Otherwise we infer the result of this call is
+        # transient between taskgraph executions and we should expect to
+        # run it again.
+        if not self._transient_run:
+            pickled_target_path_stats = pickle.dumps(result_target_path_stats)
+            stored_result = _serialize_result(
+                self._result, self._result_compression,
+                self._result_compression_threshold,
+                self._result_spill_threshold, self._result_spill_dir_path,
+                self._task_reexecution_hash)
+            record_size = len(pickled_target_path_stats) + len(stored_result)
+            spill_file_path = _get_spill_file_path(
+                stored_result, self._result_spill_dir_path)
+            if spill_file_path is not None:
+                record_size += os.path.getsize(spill_file_path)
+            completion_record = (
+                self._task_reexecution_hash, pickled_target_path_stats,
+                stored_result, record_size)
+            if self._completion_record_writer is not None:
+                self._completion_record_writer.submit(*completion_record)
+            else:
+                self._cache_backend.put(*completion_record)
+            self._reexecution_hash_index.add(self._task_reexecution_hash)
         self.task_done_executing_event.set()
         LOGGER.debug("successful run on task %s", self.task_name)
 
@@ -1144,18 +2268,25 @@ class Task(object):
             target_hash_algorithm = 'exists'
         else:
             target_hash_algorithm = self._hash_algorithm
+        # every path is stat'd at most once while checking
+        stat_memo = self._stat_memo
+        if stat_memo is None:
+            stat_memo = _StatMemo()
+        target_path_set = frozenset(self._target_path_list)
+        ignore_path_set = frozenset(self._ignore_path_list)
         file_stat_list = list(_get_file_stats(
             [self._args, self._kwargs],
             target_hash_algorithm,
-            self._target_path_list+self._ignore_path_list,
-            self._ignore_directories))
+            target_path_set | ignore_path_set,
+            self._ignore_directories, self._file_fingerprint_cache,
+            stat_memo, self._hash_directories, self._directory_listing_cache))
 
         other_arguments = _filter_non_files(
             [self._reexecution_info['args_clean'],
              self._reexecution_info['kwargs_clean']],
-            self._target_path_list,
-            self._ignore_path_list,
-            self._ignore_directories)
+            target_path_set,
+            ignore_path_set,
+            self._ignore_directories, stat_memo)
 
         LOGGER.debug("file_stat_list: %s", file_stat_list)
         LOGGER.debug("other_arguments: %s", other_arguments)
@@ -1166,35 +2297,40 @@ class Task(object):
         self._reexecution_info['file_stat_list'] = file_stat_list
         self._reexecution_info['other_arguments'] = other_arguments
 
-        reexecution_string = '%s:%s:%s:%s:%s' % (
+        task_reexecution_hash = hashlib.sha1()
+        _update_hash_with_value(task_reexecution_hash, (
             self._reexecution_info['func_name'],
-            self._reexecution_info['source_code_hash'],
+            self._reexecution_info['func_fingerprint'],
             self._reexecution_info['other_arguments'],
             self._store_result,
             # the x[1] is to only take the digest part of the 'file_stat'
-            str([x[1] for x in file_stat_list]))
-
-        self._task_reexecution_hash = hashlib.sha1(
-            reexecution_string.encode('utf-8')).hexdigest()
+            [x[1] for x in file_stat_list]))
+        self._task_reexecution_hash = task_reexecution_hash.hexdigest()
+        if self._task_reexecution_hash not in self._reexecution_hash_index:
+            LOGGER.debug(
+                "not precalculated, Task hash does not "
+                "exist (%s)", self.task_name)
+            LOGGER.debug("is_precalculated full task info: %s", self)
+            return False
         try:
-            database_result = _execute_sqlite(
-                """SELECT target_path_stats, result from taskgraph_data
-                    WHERE (task_reexecution_hash == ?)""",
-                self._task_database_path, mode='read_only',
-                argument_list=(self._task_reexecution_hash,), fetch='one')
-            if database_result is None:
+            # only the stats are needed here, a stored result is loaded
+            # when ``get`` asks for it
+            target_path_stats = self._select_completion_record(
+                'target_path_stats')
+            if target_path_stats is None:
                 LOGGER.debug(
                     "not precalculated, Task hash does not "
                     "exist (%s)", self.task_name)
                 LOGGER.debug("is_precalculated full task info: %s", self)
                 return False
-            result_target_path_stats = pickle.loads(database_result[0])
+            result_target_path_stats = pickle.loads(target_path_stats)
             mismatched_target_file_list = []
             for path, hash_string in result_target_path_stats:
                 if path not in self._target_path_list:
                     mismatched_target_file_list.append(
                         'Recorded path not in target path list %s' % path)
-                if not os.path.exists(path):
+                target_stat = stat_memo.stat(path)
+                if target_stat is None:
                     mismatched_target_file_list.append(
                         'Path not found: %s' % path)
                     continue
@@ -1209,22 +2345,25 @@ class Task(object):
                         mismatched_target_file_list.append(
                             "Path names don't match\n"
                             "cached: (%s)\nactual (%s)" % (path, actual_path))
-                    target_modified_time = os.path.getmtime(path)
-                    if not math.isclose(
-                            float(modified_time), target_modified_time):
+                    # compare exactly as ``_hash_file`` formats the time
+                    target_modified_time = '%f' % target_stat.st_mtime
+                    if modified_time != target_modified_time:
                         mismatched_target_file_list.append(
                             "Modified times don't match "
-                            "cached: (%f) actual: (%f)" % (
-                                float(modified_time), target_modified_time))
+                            "cached: (%s) actual: (%s)" % (
+                                modified_time, target_modified_time))
                         continue
-                    target_size = os.path.getsize(path)
+                    target_size = target_stat.st_size
                     if float(size) != target_size:
                         mismatched_target_file_list.append(
                             "File sizes don't match "
                             "cached: (%s) actual: (%s)" % (
                                 size, target_size))
                 else:
-                    target_hash = _hash_file(path, target_hash_algorithm)
+                    target_hash = _hash_file(
+                        path, target_hash_algorithm,
+                        fingerprint_cache=self._file_fingerprint_cache,
+                        stat_memo=stat_memo)
                     if hash_string != target_hash:
                         mismatched_target_file_list.append(
                             "File hashes are different. cached: (%s) "
@@ -1236,13 +2375,39 @@ class Task(object):
                     self.task_name, '\n'.join(mismatched_target_file_list))
                 return False
             if self._store_result:
-                self._result = pickle.loads(database_result[1])
+                self._result_needs_load = True
+            # keep the record from being pruned as least recently used
+            if self._completion_record_writer is not None:
+                self._completion_record_writer.touch(
+                    self._task_reexecution_hash)
+            else:
+                self._access_time_buffer.touch(self._task_reexecution_hash)
             LOGGER.debug("precalculated (%s)" % self)
             return True
         except EOFError:
             LOGGER.exception("not precalculated %s, EOFError", self.task_name)
             return False
 
+    def _select_completion_record(self, column):
+        """Return one column of this Task's completion record.
+
+        Args:
+            column (str): either 'target_path_stats' or 'result'.
+
+        Returns:
+            the pickled value of ``column`` or None if there is no record
+            for this Task's reexecution hash.
+
+        """
+        column_index = _check_cache_record_field(column)
+        if self._completion_record_writer is not None:
+            # this Task's record might not be committed yet
+            pending_record = self._completion_record_writer.get_pending(
+                self._task_reexecution_hash)
+            if pending_record is not None:
+                return pending_record[column_index]
+        return self._cache_backend.lookup(self._task_reexecution_hash, column)
+
     def join(self, timeout=None):
         """Block until task is complete, raise exception if runtime failed."""
         LOGGER.debug(
@@ -1280,14 +2445,131 @@ class Task(object):
         timeout = not self.join(timeout)
         if timeout:
             raise RuntimeError('call to get timed out')
+        with self._result_lock:
+            if self._result_needs_load:
+                # the Task was precalculated, load its result only now that
+                # it's actually asked for
+                result = self._select_completion_record('result')
+                if result is None:
+                    raise RuntimeError(
+                        f'the stored result of {self.task_name} is no longer '
+                        'in the TaskGraph cache')
+                self._result = _deserialize_result(
+                    result, self._result_spill_dir_path)
+                self._result_needs_load = False
         return self._result
 
 
+def _call_and_fingerprint_targets(
+        func, args, kwargs, target_path_list, target_hash_algorithm,
+        fingerprint_cache=None):
+    """Call ``func`` then fingerprint the targets it was expected to make.
+
+    Runs in the worker process that executes a Task so the targets are
+    hashed there rather than one after another in the TaskGraph process.
+
+    Args:
+        func (callable): the Task function.
+        args (list): positional arguments for ``func``.
+        kwargs (dict): keyword arguments for ``func``.
+        target_path_list (list): paths ``func`` is expected to create.
+        target_hash_algorithm (str): ``hash_algorithm`` the targets are
+            fingerprinted with.
+        fingerprint_cache (_FileFingerprintCache): if not None, passed to
+            ``_get_file_stats``. Only used when ``func`` is called in the
+            TaskGraph process since the cache can't be pickled.
+
+    Returns:
+        tuple of the value returned by ``func``, the list of
+        ``_get_file_stats`` tuples of the targets that exist, and a
+        ``(runtime, peak_memory)`` tuple of the seconds ``func`` took and
+        the peak memory of the process while it ran. The peak memory is
+        None if the process used more memory before ``func`` was called,
+        such as for an earlier Task in the same worker, since it can't be
+        told apart from what ``func`` used.
+
+    """
+    peak_memory_before = _get_peak_memory()
+    start_time = time.perf_counter()
+    payload = func(*args, **kwargs)
+    runtime = time.perf_counter() - start_time
+    peak_memory = _get_peak_memory()
+    if peak_memory is not None and peak_memory <= peak_memory_before:
+        # ``func`` didn't raise the high-water mark, so it's not its peak
+        peak_memory = None
+    return payload, list(_get_file_stats(
+        target_path_list, target_hash_algorithm, [], False,
+        fingerprint_cache)), (runtime, peak_memory)
+
+
+def _call_batch_and_fingerprint_targets(call_argument_list_list):
+    """Call ``_call_and_fingerprint_targets`` for each Task of a batch.
+
+    Runs in a worker process so a batch of small Tasks takes one round trip
+    to the worker pool rather than one per Task.
+
+    Args:
+        call_argument_list_list (list): the ``Task._prepare_call`` argument
+            list of each Task in the batch.
+
+    Returns:
+        list of ``(exception, call_result)`` tuples in the order of
+        ``call_argument_list_list``. ``exception`` is None and
+        ``call_result`` is the value ``_call_and_fingerprint_targets``
+        returned, or ``exception`` is what it raised and ``call_result`` is
+        None. The list ends at the first exception since the TaskGraph
+        terminates once a Task fails.
+
+    """
+    outcome_list = []
+    for call_argument_list in call_argument_list_list:
+        try:
+            outcome_list.append(
+                (None, _call_and_fingerprint_targets(*call_argument_list)))
+        except Exception as e:
+            outcome_list.append((e, None))
+            break
+    return outcome_list
+
+
+def _get_peak_memory():
+    """Return the peak resident memory of this process in bytes.
+
+    This is the most memory the process used since it started, so for a
+    process that executes several Tasks it's only the peak of a Task that
+    raised it, see ``_call_and_fingerprint_targets``.
+
+    Returns:
+        number of bytes or None if it can't be measured on this platform.
+
+    """
+    if not HAS_RESOURCE:
+        return None
+    peak_memory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return peak_memory
+    # every other platform reports kilobytes
+    return peak_memory * 1024
+
+
+def _get_function_name(func):
+    """Return the module qualified name runtimes of ``func`` are kept by."""
+    if isinstance(func, functools.partial):
+        func = func.func
+    return '%s.%s' % (
+        getattr(func, '__module__', None),
+        getattr(func, '__qualname__', type(func).__qualname__))
+
+
 def _get_file_stats(
         base_value, hash_algorithm, ignore_list,
-        ignore_directories):
+        ignore_directories, fingerprint_cache=None, stat_memo=None,
+        hash_directories=False, directory_listing_cache=None):
     """Return fingerprints of any filepaths in ``base_value``.
 
+    If more than one file is digested with a ``hashlib`` algorithm the files
+    are digested concurrently by a thread pool shared by all Tasks.
+
     Args:
         base_value: any python value. Any file paths in ``base_value``
             should be processed with `_normalize_path`.
@@ -1308,7 +2590,15 @@ def _get_file_stats(
             "os.path.norm"ed.
         ignore_directories (boolean): If True directories are not
             considered for filestats.
-
+        fingerprint_cache (_FileFingerprintCache): if not None, passed to
+            ``_hash_file`` to reuse digests of unchanged files.
+        stat_memo (_StatMemo): if not None, file stats are looked up here
+            rather than each path being stat'd again.
+        hash_directories (bool): if True, directories are included even if
+            ``ignore_directories`` is True and digested with
+            ``_hash_directory``.
+        directory_listing_cache (_DirectoryListingCache): if not None,
+            passed to ``_hash_directory`` to reuse directory listings.
 
     Return:
         list of (path, digest) tuples for any filepaths found in
@@ -1316,18 +2606,63 @@ def _get_file_stats(
             ignored by the input parameters where digest is created by
             the hash algorithm specified in ``hash_algorithm``.
 
+    """
+    if stat_memo is None:
+        stat_memo = _StatMemo()
+    path_list = list(_iter_file_stat_paths(
+        base_value, ignore_list, ignore_directories and not hash_directories,
+        stat_memo))
+    if hash_algorithm == 'exists':
+        for norm_path in path_list:
+            yield (norm_path, 'exists')
+        return
+    if hash_algorithm == 'sizetimestamp' or len(path_list) < 2:
+        # a stat is cheaper than handing it off to another thread
+        digest_iterator = (
+            _hash_file_or_none(
+                norm_path, hash_algorithm, fingerprint_cache, stat_memo,
+                hash_directories, directory_listing_cache)
+            for norm_path in path_list)
+    else:
+        # ``map`` returns digests in the same order as ``path_list``
+        digest_iterator = _get_file_hash_executor().map(
+            _hash_file_or_none, path_list,
+            [hash_algorithm] * len(path_list),
+            [fingerprint_cache] * len(path_list),
+            [stat_memo] * len(path_list),
+            [hash_directories] * len(path_list),
+            [directory_listing_cache] * len(path_list))
+    for norm_path, digest in zip(path_list, digest_iterator):
+        if digest is not None:
+            yield (norm_path, digest)
+
+
+def _iter_file_stat_paths(
+        base_value, ignore_list, ignore_directories, stat_memo):
+    """Yield the normalized paths ``_get_file_stats`` should digest.
+
+    Args:
+        base_value: any python value, see ``_get_file_stats``.
+        ignore_list (list): paths in this list are not yielded.
+        ignore_directories (boolean): If True directories are not yielded.
+        stat_memo (_StatMemo): memo the stats of the paths are looked up in.
+
+    Yields:
+        normalized paths to existing files or directories in ``base_value``
+        in the order they are found.
+
     """
     if isinstance(base_value, _VALID_PATH_TYPES):
+        if not _could_be_path(base_value):
+            return
         try:
             norm_path = _normalize_path(base_value)
-            if norm_path not in ignore_list and (
-                    not os.path.isdir(norm_path) or
-                    not ignore_directories) and os.path.exists(norm_path):
-                if hash_algorithm == 'exists':
-                    yield (norm_path, 'exists')
-                else:
-                    yield (
-                        norm_path, _hash_file(norm_path, hash_algorithm))
+            if norm_path not in ignore_list:
+                file_stat = stat_memo.stat(norm_path)
+                if file_stat is not None and not (
+                        ignore_directories and
+                        stat.S_ISDIR(file_stat.st_mode)):
+                    yield norm_path
         except (OSError, ValueError):
             # I ran across a ValueError when one of the os.path functions
             # interpreted the value as a path that was too long.
@@ -1339,18 +2674,131 @@ def _get_file_stats(
     elif isinstance(base_value, dict):
         for key in base_value.keys():
             value = base_value[key]
-            for stat in _get_file_stats(
-                    value, hash_algorithm, ignore_list, ignore_directories):
-                yield stat
+            for norm_path in _iter_file_stat_paths(
+                    value, ignore_list, ignore_directories, stat_memo):
+                yield norm_path
     elif isinstance(base_value, (list, set, tuple)):
         for value in base_value:
-            for stat in _get_file_stats(
-                    value, hash_algorithm, ignore_list, ignore_directories):
-                yield stat
+            for norm_path in _iter_file_stat_paths(
+                    value, ignore_list, ignore_directories, stat_memo):
+                yield norm_path
+
+
+def _hash_file_or_none(
+        norm_path, hash_algorithm, fingerprint_cache, stat_memo,
+        hash_directories=False, directory_listing_cache=None):
+    """Return ``_hash_file`` of a path or None if it can't be digested.
+
+    If ``hash_directories`` is True a directory is digested with
+    ``_hash_directory`` using ``directory_listing_cache``.
+
+    """
+    try:
+        if hash_directories:
+            path_stat = stat_memo.stat(norm_path)
+            if path_stat is not None and stat.S_ISDIR(path_stat.st_mode):
+                return _hash_directory(
+                    norm_path, hash_algorithm, fingerprint_cache,
+                    directory_listing_cache)
+        return _hash_file(
+            norm_path, hash_algorithm, fingerprint_cache=fingerprint_cache,
+            stat_memo=stat_memo)
+    except (OSError, ValueError):
+        LOGGER.exception(
+            "base_value couldn't be analyzed somehow '%s'", norm_path)
+        return None
+
+
+def _hash_directory(
+        dir_path, hash_algorithm, fingerprint_cache,
+        directory_listing_cache=None):
+    """Return a Merkle tree digest of the files under ``dir_path``.
+
+    The digest of a directory is the digest of the sorted names of its
+    entries along with the ``_hash_file`` digest of each file and the
+    ``_hash_directory`` digest of each subdirectory, so any file added,
+    removed, renamed, or changed anywhere under ``dir_path`` changes it.
+    Symbolic links to directories are included by name only so cycles
+    can't occur.
+
+    Files are stat'd on every call since changing a file doesn't change the
+    modified time of its directory, but ``fingerprint_cache`` keeps them
+    from being read again unless their size or modified time changed.
+
+    Args:
+        dir_path (str): normalized path to a directory.
+        hash_algorithm (str): the ``_hash_file`` algorithm files under
+            ``dir_path`` are digested with.
+        fingerprint_cache (_FileFingerprintCache): passed to ``_hash_file``.
+        directory_listing_cache (_DirectoryListingCache): if not None, the
+            listings of ``dir_path`` and its subdirectories are looked up
+            here rather than each directory being scanned again.
+
+    Returns:
+        a sha1 hex digest string.
+
+    Raises:
+        OSError if ``dir_path`` or a file under it can't be read.
+
+    """
+    if directory_listing_cache is None:
+        entry_list = _list_directory(dir_path)
+    else:
+        entry_list = directory_listing_cache.get_entry_list(dir_path)
+    node_list = []
+    for name, is_dir, is_file in entry_list:
+        entry_path = os.path.join(dir_path, name)
+        if is_dir:
+            node_list.append((name, 'dir', _hash_directory(
+                entry_path, hash_algorithm, fingerprint_cache,
+                directory_listing_cache)))
+        elif is_file:
+            node_list.append((name, 'file', _hash_file(
+                entry_path, hash_algorithm,
+                fingerprint_cache=fingerprint_cache)))
+        else:
+            node_list.append((name, 'other', None))
+    hash_object = hashlib.sha1()
+    _update_hash_with_value(hash_object, node_list)
+    return hash_object.hexdigest()
+
+
+def _list_directory(dir_path):
+    """Return the sorted ``(name, is_dir, is_file)`` entries of a directory.
+
+    Symbolic links to directories are not directories here.
+
+    """
+    with os.scandir(dir_path) as entry_iterator:
+        return sorted(
+            (entry.name, entry.is_dir(follow_symlinks=False),
+             entry.is_file())
+            for entry in entry_iterator)
+
+
+def _get_file_hash_executor():
+    """Return the thread pool shared by all Tasks to digest files."""
+    global _FILE_HASH_EXECUTOR
+    global _FILE_HASH_EXECUTOR_PID
+    global _FILE_HASH_EXECUTOR_LOCK
+    if _FILE_HASH_EXECUTOR_PID not in (None, os.getpid()):
+        # forked from the process that made the executor, the lock may
+        # have been held by one of its threads at the time of the fork
+        _FILE_HASH_EXECUTOR_LOCK = threading.Lock()
+        _FILE_HASH_EXECUTOR = None
+        _FILE_HASH_EXECUTOR_PID = None
+    with _FILE_HASH_EXECUTOR_LOCK:
+        if _FILE_HASH_EXECUTOR is None:
+            _FILE_HASH_EXECUTOR = concurrent.futures.ThreadPoolExecutor(
+                max_workers=_FILE_HASH_THREAD_COUNT,
+                thread_name_prefix='taskgraph_file_hash')
+            _FILE_HASH_EXECUTOR_PID = os.getpid()
+        return _FILE_HASH_EXECUTOR
 
 
 def _filter_non_files(
-        base_value, keep_list, ignore_list, keep_directories):
+        base_value, keep_list, ignore_list, keep_directories,
+        stat_memo=None):
     """Remove any values that are files not in ignore list or directories.
 
     Args:
@@ -1362,6 +2810,8 @@ def _filter_non_files(
         ignore_list (list): any paths found in this list are filtered.
         keep_directories (boolean): If True directories are not filtered
             out.
+        stat_memo (_StatMemo): if not None, file stats are looked up here
+            rather than each path being stat'd again.
 
     Return:
         original ``base_value`` with any nested file paths for files that
@@ -1370,14 +2820,26 @@ def _filter_non_files(
     """
     if isinstance(base_value, _VALID_PATH_TYPES):
         try:
-            norm_path = _normalize_path(base_value)
-            if norm_path not in ignore_list and (
-                    norm_path in keep_list or ((
-                        os.path.isdir(norm_path) and keep_directories) or (
-                        not os.path.isfile(norm_path) and
-                        not os.path.isdir(norm_path)))):
+            # ``_scrub_task_args`` already made every path absolute and
+            # normalizing is idempotent, the strings it made up itself, such
+            # as the target path placeholder, are normalized here
+            norm_path = os.fspath(base_value)
+            if not os.path.isabs(norm_path):
+                norm_path = _normalize_path(norm_path)
+            if norm_path in ignore_list:
+                return None
+            if norm_path in keep_list or not _could_be_path(norm_path):
                 return norm_path
-            return None
+            if stat_memo is None:
+                stat_memo = _StatMemo()
+            file_stat = stat_memo.stat(norm_path)
+            if file_stat is None:
+                return norm_path
+            if stat.S_ISDIR(file_stat.st_mode):
+                return norm_path if keep_directories else None
+            if stat.S_ISREG(file_stat.st_mode):
+                return None
+            return norm_path
         except (OSError, ValueError):
             # I ran across a ValueError when one of the os.path functions
             # interpreted the value as a path that was too long.
@@ -1389,19 +2851,20 @@ def _filter_non_files(
     elif isinstance(base_value, dict):
         return {
             key: _filter_non_files(
-                value, keep_list, ignore_list, keep_directories)
+                value, keep_list, ignore_list, keep_directories, stat_memo)
             for key, value in base_value.items()
         }
     elif isinstance(base_value, (list, set, tuple)):
         return type(base_value)([
             _filter_non_files(
-                value, keep_list, ignore_list, keep_directories)
+                value, keep_list, ignore_list, keep_directories, stat_memo)
             for value in base_value])
     else:
         return base_value
 
 
-def _scrub_task_args(base_value, target_path_list):
+def _scrub_task_args(
+        base_value, target_path_list, hash_function_callees=False):
     """Attempt to convert ``base_value`` to canonical values.
 
     Any paths in ``base_value`` are normalized, any paths that are also in
@@ -1416,6 +2879,8 @@ def _scrub_task_args(base_value, target_path_list):
         base_value: any python value
         target_path_list (list): a list of strings that if found in
             ``base_value`` should be replaced with 'in_target_path' so
+        hash_function_callees (bool): passed to
+            ``_get_function_fingerprint`` for functions in ``base_value``.
 
     Returns:
         base_value with any functions replaced as strings and paths in
@@ -1423,31 +2888,20 @@ def _scrub_task_args(base_value, target_path_list):
 
     """
     if callable(base_value):
-        try:
-            if not hasattr(Task, 'func_source_map'):
-                Task.func_source_map = {}
-            # memoize func source code because it's likely we'll import
-            # the same func many times and reflection is slow
-            if base_value not in Task.func_source_map:
-                Task.func_source_map[base_value] = (
-                    inspect.getsource(base_value)).replace(
-                        ' ', '').replace('\t', '')
-            source_code = Task.func_source_map[base_value]
-        except (IOError, TypeError):
-            # many reasons for this, for example, frozen Python code won't
-            # have source code, so just leave blank
-            source_code = ''
-        return '%s:%s' % (base_value.__name__, source_code)
+        return '%s:%s' % (
+            getattr(base_value, '__name__', type(base_value).__name__),
+            _get_function_fingerprint(base_value, hash_function_callees))
     elif isinstance(base_value, dict):
         result_dict = {}
         for key in base_value.keys():
             result_dict[key] = _scrub_task_args(
-                base_value[key], target_path_list)
+                base_value[key], target_path_list, hash_function_callees)
         return result_dict
     elif isinstance(base_value, (list, set, tuple)):
         result_list = []
         for value in base_value:
-            result_list.append(_scrub_task_args(value, target_path_list))
+            result_list.append(_scrub_task_args(
+                value, target_path_list, hash_function_callees))
         return type(base_value)(result_list)
     elif isinstance(base_value, _VALID_PATH_TYPES):
         normalized_path = _normalize_path(base_value)
@@ -1459,20 +2913,340 @@ def _scrub_task_args(base_value, target_path_list):
         return base_value
 
 
-def _hash_file(file_path, hash_algorithm, buf_size=2**20):
+def _get_function_fingerprint(func, hash_callees):
+    """Return a hex digest of what ``func`` does.
+
+    Functions are fingerprinted from their code objects rather than their
+    source so functions without source, like frozen code, are covered too
+    and comments or formatting don't count as a change. The fingerprint
+    covers the bytecode, constants, and names of the code, default
+    argument values, and the values of closure variables. Methods are
+    fingerprinted by their function and classes by their functions. Other
+    callables, like builtins, only by their name.
+
+    Args:
+        func (callable): the function to fingerprint.
+        hash_callees (bool): if True the functions defined in the same
+            module as ``func`` that it references by a global name are
+            fingerprinted too, and so on for the functions they reference.
+
+    Returns:
+        a sha1 hex digest string.
+
+    """
+    hash_object = hashlib.sha1()
+    _update_hash_with_function(hash_object, func, hash_callees, set())
+    return hash_object.hexdigest()
+
+
+def _update_hash_with_function(
+        hash_object, func, hash_callees, visited_function_set):
+    """Feed the ``_get_function_fingerprint`` of ``func`` to a hash.
+
+    Args:
+        hash_object: a ``hashlib`` hash object.
+        func (callable): the function to fingerprint.
+        hash_callees (bool): see ``_get_function_fingerprint``.
+        visited_function_set (set): functions already fed to
+            ``hash_object``, only their name is fed again so recursive
+            functions terminate.
+
+    Returns:
+        None.
+
+    """
+    if isinstance(func, types.MethodType):
+        func = func.__func__
+    if isinstance(func, type):
+        hash_object.update(b'C%d:' % len(vars(func)))
+        for name, value in sorted(vars(func).items()):
+            if isinstance(value, (staticmethod, classmethod)):
+                value = value.__func__
+            if isinstance(value, types.FunctionType):
+                _update_hash_with_value(hash_object, name)
+                _update_hash_with_function(
+                    hash_object, value, hash_callees, visited_function_set)
+        return
+    name = getattr(func, '__qualname__', type(func).__qualname__)
+    code = getattr(func, '__code__', None)
+    if not isinstance(code, types.CodeType) or (
+            func in visited_function_set):
+        _update_hash_with_value(hash_object, name)
+        return
+    visited_function_set.add(func)
+    hash_object.update(b'F')
+    hash_object.update(_get_code_digest(code))
+
+    # values the code sees besides its arguments
+    closure_values = []
+    for cell in func.__closure__ or ():
+        try:
+            closure_values.append(cell.cell_contents)
+        except ValueError:
+            # the variable isn't assigned yet
+            closure_values.append(None)
+    for value in [func.__defaults__ or (), func.__kwdefaults__ or {},
+                  closure_values]:
+        if isinstance(value, dict):
+            value = sorted(value.items())
+        for item in value:
+            if isinstance(item, tuple):
+                # a keyword default, hash the name then the value
+                _update_hash_with_value(hash_object, item[0])
+                item = item[1]
+            if isinstance(item, (types.FunctionType, types.MethodType)):
+                _update_hash_with_function(
+                    hash_object, item, hash_callees, visited_function_set)
+                continue
+            try:
+                _update_hash_with_value(hash_object, item)
+            except Exception:
+                # can't be pickled, all that's known is the type
+                _update_hash_with_value(hash_object, type(item).__qualname__)
+
+    if not hash_callees:
+        return
+    module_name = getattr(func, '__module__', None)
+    func_globals = func.__globals__
+    for global_name in _get_code_global_names(code):
+        callee = func_globals.get(global_name)
+        if isinstance(callee, types.FunctionType) and (
+                callee.__module__ == module_name):
+            _update_hash_with_value(hash_object, global_name)
+            _update_hash_with_function(
+                hash_object, callee, hash_callees, visited_function_set)
+
+
+@functools.lru_cache(maxsize=_CODE_CACHE_SIZE)
+def _get_code_digest(code):
+    """Return a digest of a code object and the code objects it contains.
+
+    Line numbers, file names, and local variable names other than those of
+    the arguments aren't included so moving or reformatting a function
+    doesn't change its digest. Digests of recently used code objects are
+    cached.
+
+    Args:
+        code (types.CodeType): the code object to digest.
+
+    Returns:
+        a sha1 digest as bytes.
+
+    """
+    hash_object = hashlib.sha1()
+    argument_count = (
+        code.co_argcount + code.co_kwonlyargcount +
+        bool(code.co_flags & inspect.CO_VARARGS) +
+        bool(code.co_flags & inspect.CO_VARKEYWORDS))
+    _update_hash_with_value(hash_object, (
+        code.co_code, code.co_flags & _CODE_FLAG_MASK, code.co_argcount,
+        code.co_kwonlyargcount, code.co_varnames[:argument_count],
+        code.co_names, code.co_freevars, code.co_cellvars))
+    for const in code.co_consts:
+        if isinstance(const, types.CodeType):
+            hash_object.update(_get_code_digest(const))
+            continue
+        try:
+            _update_hash_with_value(hash_object, const)
+        except Exception:
+            _update_hash_with_value(hash_object, repr(const))
+    return hash_object.digest()
+
+
+@functools.lru_cache(maxsize=_CODE_CACHE_SIZE)
+def _get_code_global_names(code):
+    """Return the names ``code`` and the code objects it contains use."""
+    name_set = set(code.co_names)
+    for const in code.co_consts:
+        if isinstance(const, types.CodeType):
+            name_set.update(_get_code_global_names(const))
+    return tuple(sorted(name_set))
+
+
+def _update_hash_with_value(hash_object, value):
+    """Feed a canonical encoding of ``value`` to ``hash_object``.
+
+    The encoding is written to the hash in chunks as ``value`` is walked
+    rather than rendering the whole value to one ``repr`` string. Strings,
+    numbers, bools, None, and bytes are encoded by their ``repr``, which is
+    distinct for each type, and so are lists, tuples, and dicts nesting
+    only those. Containers are prefixed with a tag for their type and their
+    length. Dicts are encoded in their iteration order like ``repr`` does
+    while set items are ordered by their digest since the order of a set of
+    strings changes from one Python process to the next. A subclass of one
+    of these types, such as a namedtuple or an IntEnum, is encoded as its
+    base type prefixed with its qualified name. Values of any other type
+    are pickled.
+
+    Args:
+        hash_object: a ``hashlib`` hash object.
+        value: any python value ``_scrub_task_args`` returns.
+
+    Returns:
+        None.
+
+    Raises:
+        TypeError if ``value`` contains an object that can't be pickled.
+
+    """
+    buffer = bytearray()
+    _encode_value(value, buffer, hash_object)
+    hash_object.update(buffer)
+
+
+def _encode_value(value, buffer, hash_object):
+    """Append the ``_update_hash_with_value`` encoding of ``value``.
+
+    Args:
+        value: any python value.
+        buffer (bytearray): the encoding is appended here, it's fed to
+            ``hash_object`` and emptied when it grows past
+            ``_VALUE_HASH_BUFFER_SIZE``.
+        hash_object: a ``hashlib`` hash object.
+
+    Returns:
+        None.
+
+    """
+    value_type = type(value)
+    if value_type in _REPR_HASH_TYPE_SET:
+        buffer += repr(value).encode('utf-8', 'surrogatepass')
+    elif value_type is list or value_type is tuple or value_type is dict:
+        buffer += b'%s%d:' % (
+            _CONTAINER_HASH_TAG_MAP[value_type], len(value))
+        nested_item_count = _count_repr_hashable_items(value)
+        if nested_item_count is not None and (
+                nested_item_count <=
+                _REPR_HASH_NESTED_ITEM_RATIO * max(1, len(value))):
+            # each chunk starts with '[', '(', or '{' which an item
+            # encoded on its own never does
+            _encode_repr_chunks(value, buffer, hash_object)
+            return
+        item_iterator = value.items() if value_type is dict else value
+        for item in item_iterator:
+            if value_type is dict:
+                _encode_value(item[0], buffer, hash_object)
+                buffer += b':'
+                item = item[1]
+            _encode_value(item, buffer, hash_object)
+            buffer += b','
+            if len(buffer) >= _VALUE_HASH_BUFFER_SIZE:
+                hash_object.update(buffer)
+                del buffer[:]
+    elif value_type is set or value_type is frozenset:
+        buffer += b'S%d:' % len(value)
+        for item_digest in sorted(
+                _get_value_digest(item) for item in value):
+            buffer += item_digest
+    else:
+        for base_type in (
+                str, int, float, bytes, list, tuple, dict, set, frozenset):
+            if isinstance(value, base_type):
+                # a subclass is hashed as the type it's derived from, named
+                # so it doesn't hash the same as an instance of that type
+                type_name = ('%s.%s' % (
+                    value_type.__module__, value_type.__qualname__)).encode(
+                        'utf-8', 'surrogatepass')
+                buffer += b'C%d:%s' % (len(type_name), type_name)
+                _encode_value(base_type(value), buffer, hash_object)
+                return
+        pickled_value = pickle.dumps(value, protocol=4)
+        buffer += b'P%d:' % len(pickled_value)
+        buffer += pickled_value
+
+
+def _encode_repr_chunks(value, buffer, hash_object):
+    """Encode a list, tuple, or dict by its ``repr`` a slice at a time.
+
+    Only the ``repr`` of ``_REPR_HASH_CHUNK_SIZE`` items is held in memory
+    at once however long ``value`` is. Arguments are as for
+    ``_encode_value``.
+
+    """
+    if len(value) <= _REPR_HASH_CHUNK_SIZE:
+        buffer += repr(value).encode('utf-8', 'surrogatepass')
+        return
+    hash_object.update(buffer)
+    del buffer[:]
+    value_type = type(value)
+    item_iterator = iter(value.items() if value_type is dict else value)
+    while True:
+        chunk = value_type(
+            itertools.islice(item_iterator, _REPR_HASH_CHUNK_SIZE))
+        if not chunk:
+            break
+        hash_object.update(repr(chunk).encode('utf-8', 'surrogatepass'))
+
+
+def _count_repr_hashable_items(value):
+    """Count the items nested in ``value`` if its ``repr`` can be hashed.
+
+    The nested lists, tuples, and dicts are scanned a level at a time with
+    ``map`` so there's no Python function call per item.
+
+    Args:
+        value (list, tuple, or dict): the container to scan.
+
+    Returns:
+        the number of items, dict keys, and dict values nested in ``value``
+        or None if any of them is not of a ``_REPR_HASH_TYPE_SET`` type or
+        a list, tuple, or dict.
+
+    """
+    item_count = 0
+    container_list = [value]
+    while True:
+        if len(container_list) == 1 and type(container_list[0]) is not dict:
+            item_list = container_list[0]
+        else:
+            item_list = []
+            for container in container_list:
+                if type(container) is dict:
+                    item_list.extend(container.keys())
+                    item_list.extend(container.values())
+                else:
+                    item_list.extend(container)
+        item_count += len(item_list)
+        if _REPR_HASH_TYPE_SET.issuperset(map(type, item_list)):
+            # no containers nested any deeper
+            return item_count
+        if not _REPR_HASH_CONTAINER_TYPE_SET.issuperset(
+                map(type, item_list)):
+            return None
+        container_list = [
+            item for item in item_list
+            if type(item) in _CONTAINER_HASH_TAG_MAP]
+
+
+def _get_value_digest(value):
+    """Return the sha1 digest of ``_update_hash_with_value`` of a value."""
+    hash_object = hashlib.sha1()
+    _update_hash_with_value(hash_object, value)
+    return hash_object.digest()
+
+
+def _hash_file(
+        file_path, hash_algorithm, buf_size=2**20, fingerprint_cache=None,
+        stat_memo=None):
     """Return a hex digest of ``file_path``.
 
     Args:
         file_path (string): path to file to hash.
         hash_algorithm (string): a hash function id that exists in
-            hashlib.algorithms_available or 'sizetimestamp'. If function id
-            is in hashlib.algorithms_available, the file contents are hashed
-            with that function and the fingerprint is returned. If value is
+            hashlib.algorithms_available or ``_FAST_HASH_ALGORITHM_MAP``,
+            'headtail', or 'sizetimestamp'. If it's a hash function id, the
+            file contents are hashed with that function and the fingerprint
+            is returned. If value is 'headtail' the size and samples of the
+            contents are digested, see ``_hash_file_samples``. If value is
             'sizetimestamp' the size and timestamp of the file are returned
-            in a string of the form
-            '[sizeinbytes]:[lastmodifiedtime]'.
+            in a string of the form '[sizeinbytes]:[lastmodifiedtime]'.
         buf_size (int): number of bytes to read from ``file_path`` at a time
             for digesting.
+        fingerprint_cache (_FileFingerprintCache): if not None, a digest of
+            the file cached here is returned without reading the file if the
+            file hasn't changed since, otherwise the new digest is cached.
+        stat_memo (_StatMemo): if not None, the stat of the file is looked
+            up here rather than the file being stat'd again.
 
     Returns:
         a hash hex digest computed with hash algorithm ``hash_algorithm``
@@ -1481,20 +3255,364 @@ def _hash_file(file_path, hash_algorithm, buf_size=2**20):
     """
     if hash_algorithm == 'sizetimestamp':
         norm_path = _normalize_path(file_path)
+        file_stat = _stat_file(norm_path, stat_memo)
         return '%d::%f::%s' % (
-            os.path.getsize(norm_path), os.path.getmtime(norm_path),
-            norm_path)
-    hash_func = hashlib.new(hash_algorithm)
-    with open(file_path, 'rb') as f:
-        binary_data = f.read(buf_size)
-        while binary_data:
-            hash_func.update(binary_data)
-            binary_data = f.read(buf_size)
+            file_stat.st_size, file_stat.st_mtime, norm_path)
+    if fingerprint_cache is not None:
+        file_stat = _stat_file(file_path, stat_memo)
+        digest = fingerprint_cache.get_digest(
+            file_path, hash_algorithm, file_stat)
+        if digest is not None:
+            return digest
+    if hash_algorithm == 'headtail':
+        digest = _hash_file_samples(
+            file_path, _HEADTAIL_SAMPLE_COUNT, _HEADTAIL_SAMPLE_SIZE)
+    else:
+        hash_func = _new_hash(hash_algorithm)
+        # read straight into a reused buffer rather than allocating a new
+        # bytes object for every chunk
+        buffer_view = _get_file_hash_buffer(buf_size)
+        with open(file_path, 'rb', buffering=0) as f:
+            n_bytes = f.readinto(buffer_view)
+            while n_bytes:
+                hash_func.update(buffer_view[:n_bytes])
+                n_bytes = f.readinto(buffer_view)
+        digest = hash_func.hexdigest()
+    if fingerprint_cache is not None:
+        fingerprint_cache.put_digest(
+            file_path, hash_algorithm, file_stat, digest)
+    return digest
+
+
+def _hash_file_samples(file_path, sample_count, sample_size):
+    """Return a hex digest of the size and samples of a file's contents.
+
+    ``sample_count`` samples of ``sample_size`` bytes are read at offsets
+    evenly spaced from the start of the file to the end so the first and
+    last bytes are always included. A file no larger than all the samples
+    together is digested in full.
+
+    Args:
+        file_path (string): path to file to hash.
+        sample_count (int): number of samples, at least 2.
+        sample_size (int): number of bytes in each sample.
+
+    Returns:
+        a blake2b hex digest of the file size and the samples.
+
+    """
+    hash_func = hashlib.blake2b(digest_size=16)
+    buffer_view = _get_file_hash_buffer(sample_size)
+    with open(file_path, 'rb', buffering=0) as f:
+        file_size = os.fstat(f.fileno()).st_size
+        hash_func.update(struct.pack('<Q', file_size))
+        if file_size <= sample_count * sample_size:
+            offset_list = range(0, file_size, sample_size)
+        else:
+            offset_list = [
+                (file_size - sample_size) * index // (sample_count - 1)
+                for index in range(sample_count)]
+        for offset in offset_list:
+            f.seek(offset)
+            n_bytes = f.readinto(buffer_view)
+            hash_func.update(buffer_view[:n_bytes])
     return hash_func.hexdigest()
 
 
+def _stat_file(file_path, stat_memo):
+    """Return the stat of a file, from ``stat_memo`` if it's not None.
+
+    Raises:
+        FileNotFoundError if the file can't be stat'd.
+
+    """
+    if stat_memo is None:
+        return os.stat(file_path)
+    file_stat = stat_memo.stat(file_path)
+    if file_stat is None:
+        raise FileNotFoundError(f'could not stat {file_path}')
+    return file_stat
+
+
+def _new_hash(hash_algorithm):
+    """Return a new hash object for ``hash_algorithm``.
+
+    Args:
+        hash_algorithm (str): a name in ``_FAST_HASH_ALGORITHM_MAP`` or
+            ``hashlib.algorithms_available``.
+
+    Raises:
+        ValueError if ``hash_algorithm`` is not available.
+
+    """
+    if hash_algorithm in _FAST_HASH_ALGORITHM_MAP:
+        return _FAST_HASH_ALGORITHM_MAP[hash_algorithm]()
+    if hash_algorithm in _XXHASH_ALGORITHM_LIST:
+        raise ValueError(
+            f'hash_algorithm {hash_algorithm} needs a version of the xxhash '
+            'package that provides it to be installed')
+    return hashlib.new(hash_algorithm)
+
+
+def _get_file_hash_buffer(buf_size):
+    """Return a writable ``buf_size`` memoryview reused by this thread."""
+    buffer_view = getattr(_FILE_HASH_BUFFER, 'view', None)
+    if buffer_view is None or len(buffer_view) != buf_size:
+        buffer_view = memoryview(bytearray(buf_size))
+        _FILE_HASH_BUFFER.view = buffer_view
+    return buffer_view
+
+
+def _serialize_result(
+        result, compression, compression_threshold, spill_threshold,
+        spill_dir_path, spill_key):
+    """Convert a Task result to the bytes stored in the database.
+
+    Args:
+        result: picklable result of a Task.
+        compression (string): if not None, a key in
+            ``_RESULT_COMPRESSION_MAP`` naming the algorithm used to
+            compress the pickled result.
+        compression_threshold (int): the pickled result is only compressed
+            if it's at least this many bytes.
+        spill_threshold (int): if not None and the pickled result is at
+            least this many bytes it is written to a file in
+            ``spill_dir_path`` instead and not compressed.
+        spill_dir_path (str): directory to write spill files to.
+        spill_key (str): unique name of the spill file for this result,
+            an existing spill file of the same name is replaced.
+
+    Returns:
+        the pickled ``result``, or if it was compressed or spilled,
+        ``_RESULT_FORMAT_MARKER`` followed by a format byte and the
+        compressed pickle or spill file name. Readable with
+        ``_deserialize_result``.
+
+    """
+    if spill_threshold is not None:
+        buffer_list = []
+        if _RESULT_SPILL_PROTOCOL >= 5:
+            pickled_result = pickle.dumps(
+                result, protocol=_RESULT_SPILL_PROTOCOL,
+                buffer_callback=buffer_list.append)
+            buffer_list = [buffer.raw() for buffer in buffer_list]
+        else:
+            pickled_result = pickle.dumps(result)
+        if len(pickled_result) + sum(
+                buffer.nbytes for buffer in buffer_list) >= spill_threshold:
+            spill_filename = os.path.basename(_write_spill_file(
+                os.path.join(spill_dir_path, _get_spill_filename(spill_key)),
+                pickled_result, buffer_list))
+            return b''.join([
+                _RESULT_FORMAT_MARKER, _RESULT_SPILL_FORMAT,
+                spill_filename.encode('utf-8')])
+        if buffer_list:
+            # too small to spill, needs to be pickled with the buffers in it
+            pickled_result = pickle.dumps(result)
+    else:
+        pickled_result = pickle.dumps(result)
+    if compression is None or len(pickled_result) < compression_threshold:
+        return pickled_result
+    format_byte, compress_func, _ = _RESULT_COMPRESSION_MAP[compression]
+    compressed_result = b''.join([
+        _RESULT_FORMAT_MARKER, format_byte, compress_func(pickled_result)])
+    if len(compressed_result) >= len(pickled_result):
+        # incompressible, don't pay for decompression on every load
+        return pickled_result
+    return compressed_result
+
+
+def _deserialize_result(stored_result, spill_dir_path):
+    """Convert bytes made by ``_serialize_result`` back to a result.
+
+    Args:
+        stored_result (bytes): value returned by ``_serialize_result``.
+        spill_dir_path (str): directory the result might have been spilled
+            to.
+
+    Returns:
+        the Task result.
+
+    """
+    if not stored_result.startswith(_RESULT_FORMAT_MARKER):
+        return pickle.loads(stored_result)
+    spill_file_path = _get_spill_file_path(stored_result, spill_dir_path)
+    if spill_file_path is not None:
+        return _read_spill_file(spill_file_path)
+    format_index = len(_RESULT_FORMAT_MARKER)
+    format_byte = stored_result[format_index:format_index+1]
+    for stored_format_byte, _, decompress_func in (
+            _RESULT_COMPRESSION_MAP.values()):
+        if format_byte == stored_format_byte:
+            return pickle.loads(
+                decompress_func(stored_result[format_index+1:]))
+    raise ValueError(f'Unknown stored result format: {format_byte}')
+
+
+def _get_spill_filename(spill_key):
+    """Return the name of the spill file of a result keyed by a hash.
+
+    If that file can't be replaced the result is written to
+    ``{spill_key}.{unique suffix}.pickle`` instead, so every spill file of a
+    key starts with ``{spill_key}.``.
+
+    """
+    return f'{spill_key}.pickle'
+
+
+def _get_spill_file_path(stored_result, spill_dir_path):
+    """Return the spill file a stored result refers to.
+
+    Args:
+        stored_result (bytes): value returned by ``_serialize_result``.
+        spill_dir_path (str): directory spill files are written to.
+
+    Returns:
+        path to the spill file or None if ``stored_result`` was not spilled.
+
+    """
+    spill_prefix = _RESULT_FORMAT_MARKER + _RESULT_SPILL_FORMAT
+    if not stored_result.startswith(spill_prefix):
+        return None
+    return os.path.join(
+        spill_dir_path, stored_result[len(spill_prefix):].decode('utf-8'))
+
+
+def _write_spill_file(spill_file_path, pickled_result, buffer_list):
+    """Write a pickle and its out-of-band buffers to a spill file.
+
+    The file is written to a temporary path and moved into place so a
+    reader never sees a partially written file. On Windows a file that is
+    still memory mapped by an earlier ``_read_spill_file`` can't be
+    replaced, the result is then moved to a unique path next to it.
+
+    Args:
+        spill_file_path (str): path to the spill file to create or replace.
+        pickled_result (bytes): the in-band pickle stream.
+        buffer_list (list): ``memoryview``s of the out-of-band buffers in
+            the order the pickle references them.
+
+    Returns:
+        the path the spill file was written to.
+
+    """
+    os.makedirs(os.path.dirname(spill_file_path), exist_ok=True)
+    header_format = '<QQ' + 'QQ' * len(buffer_list)
+    offset = (
+        len(_RESULT_SPILL_FILE_MAGIC) + struct.calcsize(header_format) +
+        len(pickled_result))
+    buffer_location_list = []
+    for buffer in buffer_list:
+        offset += -offset % _RESULT_SPILL_BUFFER_ALIGNMENT
+        buffer_location_list.extend([offset, buffer.nbytes])
+        offset += buffer.nbytes
+    temp_file_path = '%s.%d.%d.tmp' % (
+        spill_file_path, os.getpid(), threading.get_ident())
+    with open(temp_file_path, 'wb') as spill_file:
+        spill_file.write(_RESULT_SPILL_FILE_MAGIC)
+        spill_file.write(struct.pack(
+            header_format, len(pickled_result), len(buffer_list),
+            *buffer_location_list))
+        spill_file.write(pickled_result)
+        for buffer_offset, buffer in zip(
+                buffer_location_list[::2], buffer_list):
+            spill_file.write(b'\0' * (buffer_offset - spill_file.tell()))
+            spill_file.write(buffer)
+    try:
+        os.replace(temp_file_path, spill_file_path)
+    except PermissionError:
+        unique_file_path = '%s.%s.pickle' % (
+            os.path.splitext(spill_file_path)[0], uuid.uuid4().hex)
+        LOGGER.debug(
+            f'{spill_file_path} is in use, writing {unique_file_path} '
+            f'instead')
+        os.replace(temp_file_path, unique_file_path)
+        spill_file_path = unique_file_path
+    return spill_file_path
+
+
+def _read_spill_file(spill_file_path):
+    """Load a result written by ``_write_spill_file``.
+
+    Files of at least ``_RESULT_SPILL_MMAP_THRESHOLD`` bytes are memory
+    mapped copy-on-write and their out-of-band buffers are handed to
+    ``pickle.loads`` as views of the mapping, so objects such as NumPy
+    arrays are backed by the file rather than copied into memory. Smaller
+    files are read into memory so they aren't held open.
+
+    Args:
+        spill_file_path (str): path to the spill file.
+
+    Returns:
+        the unpickled result.
+
+    """
+    with open(spill_file_path, 'rb') as spill_file:
+        if os.fstat(spill_file.fileno()).st_size < (
+                _RESULT_SPILL_MMAP_THRESHOLD):
+            # writable like the copy-on-write mapping
+            spill_mmap = bytearray(spill_file.read())
+        else:
+            spill_mmap = mmap.mmap(
+                spill_file.fileno(), 0, access=mmap.ACCESS_COPY)
+    spill_view = memoryview(spill_mmap)
+    magic_length = len(_RESULT_SPILL_FILE_MAGIC)
+    if bytes(spill_view[:magic_length]) != _RESULT_SPILL_FILE_MAGIC:
+        raise ValueError(f'{spill_file_path} is not a result spill file')
+    pickle_length, n_buffers = struct.unpack_from(
+        '<QQ', spill_view, magic_length)
+    header_format = '<QQ' + 'QQ' * n_buffers
+    buffer_location_list = struct.unpack_from(
+        header_format, spill_view, magic_length)[2:]
+    pickle_offset = magic_length + struct.calcsize(header_format)
+    buffer_list = [
+        spill_view[offset:offset+length]
+        for offset, length in zip(
+            buffer_location_list[::2], buffer_location_list[1::2])]
+    pickle_view = spill_view[pickle_offset:pickle_offset+pickle_length]
+    if buffer_list:
+        return pickle.loads(pickle_view, buffers=buffer_list)
+    # without out-of-band buffers nothing needs to keep the mapping alive
+    result = pickle.loads(pickle_view)
+    pickle_view.release()
+    spill_view.release()
+    if isinstance(spill_mmap, mmap.mmap):
+        spill_mmap.close()
+    return result
+
+
+def _could_be_path(value):
+    """Return False if the str or path ``value`` can't name a file.
+
+    A cheap test to skip stat'ing strings such as a large serialized
+    document that are passed as Task arguments. A stat of such a string
+    always fails so the result is the same as if it was stat'd.
+
+    """
+    if isinstance(value, str):
+        return len(value) <= _MAX_PATH_LENGTH and '\x00' not in value
+    return True
+
+
 def _normalize_path(path):
-    """Convert ``path`` into normalized, normcase, absolute filepath."""
+    """Convert ``path`` into normalized, normcase, absolute filepath.
+
+    The same paths are normalized many times while Tasks are added and
+    checked so results are memoized. A relative path is memoized along
+    with the working directory it was made absolute in. Strings that
+    can't be paths aren't memoized so a large document isn't kept alive.
+
+    """
+    if not _could_be_path(path):
+        return _normalize_path_in_dir.__wrapped__(path, None)
+    if os.path.isabs(path):
+        return _normalize_path_in_dir(path, None)
+    return _normalize_path_in_dir(path, os.getcwd())
+
+
+@functools.lru_cache(maxsize=_NORMALIZED_PATH_CACHE_SIZE)
+def _normalize_path_in_dir(path, working_dir):
+    """Normalize ``path``, ``working_dir`` is only part of the memo key."""
     norm_path = os.path.normpath(path)
     try:
         abs_path = os.path.abspath(norm_path)
@@ -1507,53 +3625,1494 @@ def _normalize_path(path):
     return os.path.normcase(abs_path)
 
 
-@retrying.retry(
+def _connect_sqlite(database_path, mode, check_same_thread=True):
+    """Open a new SQLite connection to ``database_path``.
+
+    Args:
+        database_path (str): path to the SQLite database to connect to.
+        mode (str): must be either 'read_only' or 'modify'.
+        check_same_thread (bool): passed to ``sqlite3.connect``, set to False
+            if the connection will be shared between threads.
+
+    Returns:
+        a ``sqlite3.Connection`` object.
+
+    """
+    if mode == 'read_only':
+        ro_uri = r'%s?mode=ro' % pathlib.Path(
+            os.path.abspath(database_path)).as_uri()
+        LOGGER.debug(
+            '%s exists: %s', ro_uri, os.path.exists(os.path.abspath(
+                database_path)))
+        return sqlite3.connect(
+            ro_uri, uri=True, check_same_thread=check_same_thread)
+    elif mode == 'modify':
+        return sqlite3.connect(
+            database_path, check_same_thread=check_same_thread)
+    raise ValueError('Unknown mode: %s' % mode)
+
+
+class _SQLiteConnectionPool(object):
+    """Long lived SQLite connections shared by all Tasks of a TaskGraph.
+
+    The pool holds a single writer connection that is serialized with a lock
+    and up to ``n_readers`` read only connections that can be used
+    concurrently. The database is switched to write-ahead logging so readers
+    do not block the writer and vice versa. Connections are created lazily
+    and ``close`` only releases them, a later request will open new ones.
+
+    """
+
+    def __init__(self, database_path, n_readers):
+        """Create a connection pool.
+
+        Args:
+            database_path (str): path to an existing SQLite database.
+            n_readers (int): maximum number of read only connections to keep
+                open at once. Requests beyond this block until a reader is
+                returned to the pool.
+
+        """
+        self.database_path = database_path
+        self._n_readers = max(1, n_readers)
+        # guards the writer connection and the reader bookkeeping
+        self._writer_lock = threading.Lock()
+        self._writer_connection = None
+        self._reader_lock = threading.Lock()
+        self._reader_connection_list = []
+        self._idle_reader_queue = queue.LifoQueue()
+        self._reader_semaphore = threading.BoundedSemaphore(self._n_readers)
+
+    def _get_writer(self):
+        """Return the writer connection, opening it if necessary."""
+        if self._writer_connection is None:
+            self._writer_connection = _connect_sqlite(
+                self.database_path, 'modify', check_same_thread=False)
+            # WAL lets the read only connections proceed while a write is
+            # in progress, it is a persistent property of the database
+            self._writer_connection.execute('PRAGMA journal_mode=WAL')
+        return self._writer_connection
+
+    def acquire(self, mode):
+        """Borrow a connection from the pool.
+
+        Args:
+            mode (str): must be either 'read_only' or 'modify'. A 'modify'
+                connection is exclusive to the caller until ``release``.
+
+        Returns:
+            a ``sqlite3.Connection`` that must be passed to ``release`` when
+            the caller is done with it.
+
+        """
+        if mode == 'modify':
+            self._writer_lock.acquire()
+            try:
+                return self._get_writer()
+            except Exception:
+                self._writer_lock.release()
+                raise
+        elif mode == 'read_only':
+            self._reader_semaphore.acquire()
+            try:
+                return self._idle_reader_queue.get_nowait()
+            except queue.Empty:
+                pass
+            try:
+                connection = _connect_sqlite(
+                    self.database_path, 'read_only', check_same_thread=False)
+            except Exception:
+                self._reader_semaphore.release()
+                raise
+            with self._reader_lock:
+                self._reader_connection_list.append(connection)
+            return connection
+        raise ValueError('Unknown mode: %s' % mode)
+
+    def release(self, connection, mode, discard=False):
+        """Return a connection from ``acquire`` to the pool.
+
+        Args:
+            connection (sqlite3.Connection): connection returned by
+                ``acquire``.
+            mode (str): the same mode passed to ``acquire``.
+            discard (bool): if True the connection is closed rather than
+                reused, use this if the connection may be in a bad state.
+
+        Returns:
+            None.
+
+        """
+        if mode == 'modify':
+            try:
+                if discard:
+                    self._writer_connection = None
+                    connection.close()
+            finally:
+                self._writer_lock.release()
+            return
+        with self._reader_lock:
+            known_reader = connection in self._reader_connection_list
+            if discard and known_reader:
+                self._reader_connection_list.remove(connection)
+        if discard or not known_reader:
+            # a reader that ``close`` forgot about is no longer pooled
+            connection.close()
+        else:
+            self._idle_reader_queue.put(connection)
+        self._reader_semaphore.release()
+
+    def close(self):
+        """Close all open connections held by the pool."""
+        with self._writer_lock:
+            if self._writer_connection is not None:
+                self._writer_connection.close()
+                self._writer_connection = None
+        with self._reader_lock:
+            while True:
+                try:
+                    connection = self._idle_reader_queue.get_nowait()
+                except queue.Empty:
+                    break
+                self._reader_connection_list.remove(connection)
+                connection.close()
+            # any readers still on loan are closed when they are released
+            self._reader_connection_list = []
+
+
+class _CacheBackend(abc.ABC):
+    """Interface of a store of Task completion records.
+
+    A completion record is keyed by a task reexecution hash and holds the
+    pickled target path stats, the stored result, the time the record was
+    last used, and the number of bytes it takes in the cache. Backends must
+    be safe to use from multiple threads. The constructor of a backend takes
+    the TaskGraph cache directory and the number of threads that might read
+    at once.
+
+    """
+
+    @abc.abstractmethod
+    def keys(self):
+        """Return a list of the hashes of every record."""
+
+    def lookup(self, task_reexecution_hash, field):
+        """Return one field of a record.
+
+        Args:
+            task_reexecution_hash (str): key of the record.
+            field (str): either 'target_path_stats' or 'result'.
+
+        Returns:
+            the value of ``field`` or None if there is no record for
+            ``task_reexecution_hash``.
+
+        """
+        return self.lookup_many([task_reexecution_hash], field).get(
+            task_reexecution_hash)
+
+    @abc.abstractmethod
+    def lookup_many(self, task_reexecution_hash_list, field):
+        """Return one field of several records.
+
+        Args:
+            task_reexecution_hash_list (list): keys of the records.
+            field (str): either 'target_path_stats' or 'result'.
+
+        Returns:
+            dict mapping the hashes in ``task_reexecution_hash_list`` that
+            have a record to the value of their ``field``.
+
+        """
+
+    def put(
+            self, task_reexecution_hash, target_path_stats, result,
+            record_size):
+        """Insert or replace a record, its last access time is now.
+
+        Args:
+            task_reexecution_hash (str): key of the record.
+            target_path_stats (bytes): pickled target path stats.
+            result (bytes): stored result of the Task.
+            record_size (int): number of bytes the record takes in the
+                cache.
+
+        Returns:
+            None.
+
+        """
+        self.put_many([(
+            task_reexecution_hash, target_path_stats, result, record_size)])
+
+    @abc.abstractmethod
+    def put_many(self, record_list, access_list=()):
+        """Insert or replace records and update last access times at once.
+
+        Args:
+            record_list (list): list of ``(task_reexecution_hash,
+                target_path_stats, result, record_size)`` tuples as
+                described in ``put``.
+            access_list (list): list of ``(last_access_time,
+                task_reexecution_hash)`` tuples of existing records to
+                update, hashes without a record are ignored.
+
+        Returns:
+            None.
+
+        """
+
+    def touch(self, task_reexecution_hash):
+        """Set the last access time of a record to now."""
+        self.put_many([], [(time.time(), task_reexecution_hash)])
+
+    @abc.abstractmethod
+    def get_access_list(self):
+        """Return a ``(task_reexecution_hash, last_access_time,
+        record_size)`` tuple for every record, least recently used first.
+
+        """
+
+    @abc.abstractmethod
+    def delete_many(self, task_reexecution_hash_list):
+        """Remove records, hashes without a record are ignored."""
+
+    def prune(self, max_bytes=None, max_age=None, protected_hash_set=()):
+        """Remove expired and least recently used records.
+
+        Args:
+            max_bytes (int): if not None, remove the least recently used
+                records until the records take no more than this many bytes.
+            max_age (float): if not None, remove records that have not been
+                used in this many seconds.
+            protected_hash_set (set): hashes of records that are never
+                removed.
+
+        Returns:
+            a tuple of the list of removed hashes and the number of bytes
+            the remaining records take.
+
+        """
+        now = time.time()
+        access_list = self.get_access_list()
+        cache_size = sum(record_size for _, _, record_size in access_list)
+        prune_hash_list = []
+        for task_reexecution_hash, last_access_time, record_size in (
+                access_list):
+            if task_reexecution_hash in protected_hash_set:
+                continue
+            expired = (
+                max_age is not None and last_access_time < now - max_age)
+            oversized = max_bytes is not None and cache_size > max_bytes
+            if not (expired or oversized):
+                # the list is oldest first so nothing else will be pruned
+                break
+            prune_hash_list.append(task_reexecution_hash)
+            cache_size -= record_size
+        if prune_hash_list:
+            self.delete_many(prune_hash_list)
+        return prune_hash_list, cache_size
+
+    def close(self):
+        """Release any file handles, the backend may still be used after."""
+        pass
+
+
+class _SQLiteCacheBackend(_CacheBackend):
+    """Completion records in the ``taskgraph_data`` table of a database.
+
+    All Tasks share the connections of a ``_SQLiteConnectionPool`` rather
+    than opening a new one for every access.
+
+    """
+
+    def __init__(
+            self, taskgraph_cache_dir_path, n_readers,
+            database_filename=_TASKGRAPH_DATABASE_FILENAME):
+        """Open the TaskGraph database, creating or upgrading it if needed.
+
+        Args:
+            taskgraph_cache_dir_path (str): the TaskGraph cache directory.
+            n_readers (int): maximum number of read only connections.
+            database_filename (str): name of the database file in
+                ``taskgraph_cache_dir_path``.
+
+        """
+        database_path = os.path.join(
+            taskgraph_cache_dir_path, database_filename)
+        _create_taskgraph_table_schema(database_path)
+
+        # check the version of the database and warn if a problem
+        local_version = _execute_sqlite(
+            '''
+            SELECT value
+            FROM global_variables
+            WHERE key=?
+            ''', database_path, mode='read_only',
+            fetch='one', argument_list=['version'])[0]
+        if local_version != __version__:
+            LOGGER.warning(
+                f'the database located at {database_path} was '
+                f'created with TaskGraph version {local_version} but the '
+                f'current version is {__version__}')
+        self._connection_pool = _SQLiteConnectionPool(
+            database_path, n_readers)
+
+    def keys(self):
+        """Return a list of the hashes of every record."""
+        hash_list = _execute_sqlite(
+            'SELECT task_reexecution_hash FROM taskgraph_data',
+            self._connection_pool.database_path, mode='read_only',
+            fetch='all', connection_pool=self._connection_pool)
+        return [task_reexecution_hash for (task_reexecution_hash,) in (
+            hash_list)]
+
+    def lookup(self, task_reexecution_hash, field):
+        """Return one field of a record, see ``_CacheBackend.lookup``."""
+        _check_cache_record_field(field)
+        database_result = _execute_sqlite(
+            f'''SELECT {field} from taskgraph_data
+                WHERE (task_reexecution_hash == ?)''',
+            self._connection_pool.database_path, mode='read_only',
+            argument_list=(task_reexecution_hash,), fetch='one',
+            connection_pool=self._connection_pool)
+        if database_result is None:
+            return None
+        return database_result[0]
+
+    def lookup_many(self, task_reexecution_hash_list, field):
+        """Return fields of records, see ``_CacheBackend.lookup_many``."""
+        _check_cache_record_field(field)
+        task_reexecution_hash_list = list(task_reexecution_hash_list)
+        result_map = {}
+        for index in range(
+                0, len(task_reexecution_hash_list), _SQLITE_MAX_LOOKUP_SIZE):
+            hash_list = task_reexecution_hash_list[
+                index:index+_SQLITE_MAX_LOOKUP_SIZE]
+            result_map.update(_execute_sqlite(
+                f'''SELECT task_reexecution_hash, {field} from taskgraph_data
+                    WHERE task_reexecution_hash IN
+                    ({', '.join(['?'] * len(hash_list))})''',
+                self._connection_pool.database_path, mode='read_only',
+                argument_list=hash_list, fetch='all',
+                connection_pool=self._connection_pool))
+        return result_map
+
+    def put_many(self, record_list, access_list=()):
+        """Store records in one transaction, see ``_CacheBackend``."""
+        if not record_list and not access_list:
+            return
+        _execute_sqlite_transaction(
+            _task_record_command_list(record_list, access_list),
+            self._connection_pool)
+
+    def get_access_list(self):
+        """Return the access time and size of every record, oldest first."""
+        # records made by an earlier version of TaskGraph have no access
+        # information, start tracking them as if they were just used
+        _execute_sqlite(
+            '''
+            INSERT OR IGNORE INTO taskgraph_data_access
+            SELECT
+                task_reexecution_hash, ?,
+                length(target_path_stats) + length(result)
+            FROM taskgraph_data
+            ''', self._connection_pool.database_path, mode='modify',
+            argument_list=(time.time(),),
+            connection_pool=self._connection_pool)
+        return _execute_sqlite(
+            '''
+            SELECT task_reexecution_hash, last_access_time, record_size
+            FROM taskgraph_data_access
+            ORDER BY last_access_time ASC
+            ''', self._connection_pool.database_path, mode='read_only',
+            fetch='all', connection_pool=self._connection_pool)
+
+    def delete_many(self, task_reexecution_hash_list):
+        """Remove records and return their pages to the filesystem."""
+        argument_list = [
+            (task_reexecution_hash,)
+            for task_reexecution_hash in task_reexecution_hash_list]
+        _execute_sqlite_transaction([
+            ('DELETE FROM taskgraph_data WHERE task_reexecution_hash = ?',
+             argument_list, 'many'),
+            ('DELETE FROM taskgraph_data_access '
+             'WHERE task_reexecution_hash = ?', argument_list, 'many')],
+            self._connection_pool)
+        # this does nothing for a database created before incremental
+        # vacuuming was enabled
+        _execute_sqlite(
+            'PRAGMA incremental_vacuum', self._connection_pool.database_path,
+            mode='modify', fetch='all', connection_pool=self._connection_pool)
+
+    def close(self):
+        """Close the pooled connections."""
+        self._connection_pool.close()
+
+
+class _ShardedSQLiteCacheBackend(_CacheBackend):
+    """Completion records spread across several SQLite databases.
+
+    A record is stored in the shard chosen by the leading digits of its
+    hash so concurrent writers, usually other TaskGraph processes sharing
+    the cache directory, mostly lock different database files. Each shard
+    is a ``_SQLiteCacheBackend`` with its own connection pool.
+
+    """
+
+    def __init__(self, taskgraph_cache_dir_path, n_readers, shard_count):
+        """Open every shard, creating or upgrading them if needed.
+
+        Args:
+            taskgraph_cache_dir_path (str): the TaskGraph cache directory.
+            n_readers (int): maximum number of read only connections per
+                shard.
+            shard_count (int): number of database files to spread records
+                across, they are named after
+                ``_TASKGRAPH_DATABASE_SHARD_FILENAME``.
+
+        """
+        self._shard_list = [
+            _SQLiteCacheBackend(
+                taskgraph_cache_dir_path, n_readers,
+                _TASKGRAPH_DATABASE_SHARD_FILENAME.format(
+                    shard_index=shard_index, shard_count=shard_count))
+            for shard_index in range(shard_count)]
+
+    def _get_shard(self, task_reexecution_hash):
+        """Return the shard that holds the record of a hash."""
+        try:
+            shard_key = int(
+                task_reexecution_hash[:_TASKGRAPH_DATABASE_SHARD_PREFIX], 16)
+        except ValueError:
+            # not something TaskGraph wrote, but it still needs a shard
+            shard_key = zlib.crc32(task_reexecution_hash.encode('utf-8'))
+        return self._shard_list[shard_key % len(self._shard_list)]
+
+    def _group_by_shard(self, item_list, get_hash=lambda item: item):
+        """Group items by the shard of the hash ``get_hash`` returns."""
+        shard_item_map = collections.defaultdict(list)
+        for item in item_list:
+            shard_item_map[self._get_shard(get_hash(item))].append(item)
+        return shard_item_map
+
+    def keys(self):
+        """Return a list of the hashes of every record."""
+        return [
+            task_reexecution_hash for shard in self._shard_list
+            for task_reexecution_hash in shard.keys()]
+
+    def lookup(self, task_reexecution_hash, field):
+        """Return one field of a record, see ``_CacheBackend.lookup``."""
+        return self._get_shard(task_reexecution_hash).lookup(
+            task_reexecution_hash, field)
+
+    def lookup_many(self, task_reexecution_hash_list, field):
+        """Return fields of records, see ``_CacheBackend.lookup_many``."""
+        result_map = {}
+        for shard, hash_list in self._group_by_shard(
+                task_reexecution_hash_list).items():
+            result_map.update(shard.lookup_many(hash_list, field))
+        return result_map
+
+    def put_many(self, record_list, access_list=()):
+        """Store records, one transaction per shard that has any."""
+        shard_record_map = self._group_by_shard(
+            record_list, lambda record: record[0])
+        shard_access_map = self._group_by_shard(
+            access_list, lambda access: access[1])
+        for shard in set(shard_record_map).union(shard_access_map):
+            shard.put_many(
+                shard_record_map.get(shard, []),
+                shard_access_map.get(shard, []))
+
+    def get_access_list(self):
+        """Return the access time and size of every record, oldest first."""
+        return sorted([
+            access for shard in self._shard_list
+            for access in shard.get_access_list()],
+            key=lambda access: access[1])
+
+    def delete_many(self, task_reexecution_hash_list):
+        """Remove records, hashes without a record are ignored."""
+        for shard, hash_list in self._group_by_shard(
+                task_reexecution_hash_list).items():
+            shard.delete_many(hash_list)
+
+    def close(self):
+        """Close the pooled connections of every shard."""
+        for shard in self._shard_list:
+            shard.close()
+
+
+class _MemoryCacheBackend(_CacheBackend):
+    """Completion records kept in a dictionary for the life of a TaskGraph.
+
+    Nothing is written to disk so every Task is executed again by a later
+    TaskGraph.
+
+    """
+
+    def __init__(self, taskgraph_cache_dir_path, n_readers):
+        """Create an empty backend, the arguments are not used."""
+        # maps task reexecution hashes to ``[target_path_stats, result,
+        # last_access_time, record_size]`` lists
+        self._record_map = {}
+        self._lock = threading.Lock()
+
+    def keys(self):
+        """Return a list of the hashes of every record."""
+        with self._lock:
+            return list(self._record_map)
+
+    def lookup_many(self, task_reexecution_hash_list, field):
+        """Return fields of records, see ``_CacheBackend.lookup_many``."""
+        field_index = _check_cache_record_field(field)
+        with self._lock:
+            return {
+                task_reexecution_hash: (
+                    self._record_map[task_reexecution_hash][field_index])
+                for task_reexecution_hash in task_reexecution_hash_list
+                if task_reexecution_hash in self._record_map}
+
+    def put_many(self, record_list, access_list=()):
+        """Store records, see ``_CacheBackend.put_many``."""
+        now = time.time()
+        with self._lock:
+            for (task_reexecution_hash, target_path_stats, result,
+                 record_size) in record_list:
+                self._record_map[task_reexecution_hash] = [
+                    target_path_stats, result, now, record_size]
+            for last_access_time, task_reexecution_hash in access_list:
+                if task_reexecution_hash in self._record_map:
+                    self._record_map[task_reexecution_hash][2] = (
+                        last_access_time)
+
+    def get_access_list(self):
+        """Return the access time and size of every record, oldest first."""
+        with self._lock:
+            return sorted([
+                (task_reexecution_hash, last_access_time, record_size)
+                for task_reexecution_hash, (_, _, last_access_time,
+                                            record_size) in
+                self._record_map.items()], key=lambda access: access[1])
+
+    def delete_many(self, task_reexecution_hash_list):
+        """Remove records, hashes without a record are ignored."""
+        with self._lock:
+            for task_reexecution_hash in task_reexecution_hash_list:
+                self._record_map.pop(task_reexecution_hash, None)
+
+
+class _DirectoryCacheBackend(_CacheBackend):
+    """Completion records stored one file per record.
+
+    Record files are named after their task reexecution hash in a
+    subdirectory of ``_CACHE_RECORD_DIRNAME`` named after the first two
+    characters of the hash so no single directory gets too large. A file
+    is written to a temporary name and renamed into place so readers never
+    see a partial record. The modification time of a file is the last
+    access time of its record.
+
+    """
+
+    def __init__(self, taskgraph_cache_dir_path, n_readers):
+        """Create the record directory if needed.
+
+        Args:
+            taskgraph_cache_dir_path (str): the TaskGraph cache directory.
+            n_readers (int): not used, files are opened per access.
+
+        """
+        self._record_dir_path = os.path.join(
+            taskgraph_cache_dir_path, _CACHE_RECORD_DIRNAME)
+        os.makedirs(self._record_dir_path, exist_ok=True)
+
+    def _get_record_path(self, task_reexecution_hash):
+        """Return the path of the file of a record."""
+        return os.path.join(
+            self._record_dir_path, task_reexecution_hash[:2],
+            task_reexecution_hash)
+
+    def _iter_record_entries(self):
+        """Yield an ``os.DirEntry`` for every record file."""
+        with os.scandir(self._record_dir_path) as prefix_iterator:
+            prefix_dir_list = [
+                entry.path for entry in prefix_iterator if entry.is_dir()]
+        for prefix_dir_path in prefix_dir_list:
+            with os.scandir(prefix_dir_path) as record_iterator:
+                for entry in record_iterator:
+                    # skip records that are still being written
+                    if not entry.name.endswith('.tmp'):
+                        yield entry
+
+    def keys(self):
+        """Return a list of the hashes of every record."""
+        return [entry.name for entry in self._iter_record_entries()]
+
+    def lookup(self, task_reexecution_hash, field):
+        """Return one field of a record, see ``_CacheBackend.lookup``."""
+        _check_cache_record_field(field)
+        record_path = self._get_record_path(task_reexecution_hash)
+        try:
+            with open(record_path, 'rb') as record_file:
+                magic, stats_length, _ = _CACHE_RECORD_FILE_HEADER.unpack(
+                    record_file.read(_CACHE_RECORD_FILE_HEADER.size))
+                if magic != _CACHE_RECORD_FILE_MAGIC:
+                    raise ValueError(f'{record_path} is not a record file')
+                if field == 'target_path_stats':
+                    return record_file.read(stats_length)
+                record_file.seek(stats_length, os.SEEK_CUR)
+                return record_file.read()
+        except FileNotFoundError:
+            return None
+        except (ValueError, struct.error):
+            LOGGER.warning('ignoring malformed record file %s', record_path)
+            return None
+
+    def lookup_many(self, task_reexecution_hash_list, field):
+        """Return fields of records, see ``_CacheBackend.lookup_many``."""
+        result_map = {}
+        for task_reexecution_hash in task_reexecution_hash_list:
+            value = self.lookup(task_reexecution_hash, field)
+            if value is not None:
+                result_map[task_reexecution_hash] = value
+        return result_map
+
+    def put_many(self, record_list, access_list=()):
+        """Write record files, see ``_CacheBackend.put_many``."""
+        for (task_reexecution_hash, target_path_stats, result,
+             record_size) in record_list:
+            record_path = self._get_record_path(task_reexecution_hash)
+            os.makedirs(os.path.dirname(record_path), exist_ok=True)
+            temporary_path = (
+                f'{record_path}.{os.getpid()}.{threading.get_ident()}.tmp')
+            with open(temporary_path, 'wb') as record_file:
+                record_file.write(_CACHE_RECORD_FILE_HEADER.pack(
+                    _CACHE_RECORD_FILE_MAGIC, len(target_path_stats),
+                    record_size))
+                record_file.write(target_path_stats)
+                record_file.write(result)
+            os.replace(temporary_path, record_path)
+        for last_access_time, task_reexecution_hash in access_list:
+            try:
+                os.utime(
+                    self._get_record_path(task_reexecution_hash),
+                    (last_access_time, last_access_time))
+            except FileNotFoundError:
+                pass
+
+    def get_access_list(self):
+        """Return the access time and size of every record, oldest first."""
+        access_list = []
+        for entry in self._iter_record_entries():
+            try:
+                with open(entry.path, 'rb') as record_file:
+                    _, _, record_size = _CACHE_RECORD_FILE_HEADER.unpack(
+                        record_file.read(_CACHE_RECORD_FILE_HEADER.size))
+                access_list.append(
+                    (entry.name, entry.stat().st_mtime, record_size))
+            except FileNotFoundError:
+                # removed by another process since it was listed
+                continue
+            except struct.error:
+                LOGGER.warning(
+                    'ignoring malformed record file %s', entry.path)
+        return sorted(access_list, key=lambda access: access[1])
+
+    def delete_many(self, task_reexecution_hash_list):
+        """Remove record files, hashes without a record are ignored."""
+        for task_reexecution_hash in task_reexecution_hash_list:
+            try:
+                os.remove(self._get_record_path(task_reexecution_hash))
+            except FileNotFoundError:
+                pass
+
+
+# maps the ``cache_backend`` names accepted by ``TaskGraph`` to backends
+_CACHE_BACKEND_MAP = {
+    'sqlite': _SQLiteCacheBackend,
+    'memory': _MemoryCacheBackend,
+    'directory': _DirectoryCacheBackend,
+}
+
+
+def _check_cache_record_field(field):
+    """Return the index of a completion record field.
+
+    Raises:
+        ValueError if ``field`` is not in ``_CACHE_RECORD_FIELD_LIST``.
+
+    """
+    try:
+        return _CACHE_RECORD_FIELD_LIST.index(field)
+    except ValueError:
+        raise ValueError(
+            f'Unknown completion record field: {field}, expected one of '
+            f'{_CACHE_RECORD_FIELD_LIST}')
+
+
+class _FileFingerprintCache(object):
+    """Persistent cache of file content digests.
+
+    A digest is keyed by the path and hash algorithm and is only returned
+    while the device, inode, size, and nanosecond modification time of the
+    file are the same as when it was hashed. Digests are kept in a SQLite
+    database so they're reused by every Task and later TaskGraphs, and are
+    memoized in memory for the life of the cache.
+
+    """
+
+    def __init__(self, database_path, n_readers):
+        """Open the fingerprint database, creating it if needed.
+
+        Args:
+            database_path (str): path to the fingerprint database or None to
+                keep the digests in memory only.
+            n_readers (int): maximum number of read only connections.
+
+        """
+        # maps ``(path, hash_algorithm)`` to ``(file_identity, digest)``
+        self._digest_map = {}
+        self._connection_pool = None
+        if database_path is None:
+            return
+        _execute_sqlite(
+            _FILE_FINGERPRINT_DATABASE_SCRIPT, database_path, mode='modify',
+            execute='script')
+        self._connection_pool = _SQLiteConnectionPool(
+            database_path, n_readers)
+
+    @staticmethod
+    def _file_identity(file_stat):
+        """Return the ``(device, inode, size, mtime_ns)`` of a file stat."""
+        # sqlite stores signed 64 bit integers, but some filesystems report
+        # unsigned device and inode numbers
+        return tuple(
+            value - 2**64 if value >= 2**63 else value for value in (
+                file_stat.st_dev, file_stat.st_ino, file_stat.st_size,
+                file_stat.st_mtime_ns))
+
+    def get_digest(self, path, hash_algorithm, file_stat):
+        """Return the cached digest of a file or None if it's not cached.
+
+        Args:
+            path (str): normalized path to the file.
+            hash_algorithm (str): the algorithm of the digest.
+            file_stat (os.stat_result): current stat of the file.
+
+        Returns:
+            the digest of the file if it was cached for this exact file
+            identity, otherwise None.
+
+        """
+        file_identity = self._file_identity(file_stat)
+        memo = self._digest_map.get((path, hash_algorithm))
+        if memo is not None and memo[0] == file_identity:
+            return memo[1]
+        if self._connection_pool is None:
+            return None
+        database_result = _execute_sqlite(
+            '''
+            SELECT device, inode, size, mtime_ns, digest
+            FROM file_fingerprint
+            WHERE path = ? AND hash_algorithm = ?
+            ''', self._connection_pool.database_path, mode='read_only',
+            argument_list=(path, hash_algorithm), fetch='one',
+            connection_pool=self._connection_pool)
+        if database_result is None or (
+                tuple(database_result[:4]) != file_identity):
+            return None
+        digest = database_result[4]
+        self._digest_map[(path, hash_algorithm)] = (file_identity, digest)
+        return digest
+
+    def put_digest(self, path, hash_algorithm, file_stat, digest):
+        """Cache the digest of a file.
+
+        The digest is not cached if the file changed since ``file_stat``
+        was taken, or it was modified so recently it could change again
+        without its stats changing.
+
+        Args:
+            path (str): normalized path to the file.
+            hash_algorithm (str): the algorithm of the digest.
+            file_stat (os.stat_result): stat of the file taken before it was
+                read to compute ``digest``.
+            digest (str): digest of the file's contents.
+
+        Returns:
+            None.
+
+        """
+        file_identity = self._file_identity(file_stat)
+        try:
+            if self._file_identity(os.stat(path)) != file_identity:
+                return
+        except OSError:
+            return
+        if file_stat.st_mtime_ns > (
+                time.time() - _FILE_FINGERPRINT_MIN_AGE) * 1e9:
+            return
+        self._digest_map[(path, hash_algorithm)] = (file_identity, digest)
+        if self._connection_pool is None:
+            return
+        _execute_sqlite(
+            '''
+            INSERT OR REPLACE INTO file_fingerprint
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+            ''', self._connection_pool.database_path, mode='modify',
+            argument_list=(path, hash_algorithm) + file_identity + (digest,),
+            connection_pool=self._connection_pool)
+
+    def prune(self):
+        """Remove the digests of files that changed or no longer exist.
+
+        Such a digest can never be returned again.
+
+        Returns:
+            number of digests removed.
+
+        """
+        if self._connection_pool is None:
+            fingerprint_list = [
+                key + memo[0] for key, memo in list(self._digest_map.items())]
+        else:
+            fingerprint_list = _execute_sqlite(
+                '''
+                SELECT path, hash_algorithm, device, inode, size, mtime_ns
+                FROM file_fingerprint
+                ''', self._connection_pool.database_path, mode='read_only',
+                fetch='all', connection_pool=self._connection_pool)
+        stale_key_list = []
+        for path, hash_algorithm, *file_identity in fingerprint_list:
+            try:
+                current_identity = self._file_identity(os.stat(path))
+            except OSError:
+                current_identity = None
+            if current_identity != tuple(file_identity):
+                stale_key_list.append((path, hash_algorithm))
+        for stale_key in stale_key_list:
+            self._digest_map.pop(stale_key, None)
+        if stale_key_list and self._connection_pool is not None:
+            _execute_sqlite(
+                '''
+                DELETE FROM file_fingerprint
+                WHERE path = ? AND hash_algorithm = ?
+                ''', self._connection_pool.database_path, mode='modify',
+                argument_list=stale_key_list, execute='many',
+                connection_pool=self._connection_pool)
+        return len(stale_key_list)
+
+    def close(self):
+        """Close the pooled connections, the cache can still be used."""
+        if self._connection_pool is not None:
+            self._connection_pool.close()
+
+
+class _StatMemo(object):
+    """Memo of ``os.stat`` results so each path is stat'd only once.
+
+    Network filesystems make every stat a round trip. A memo with no
+    ``max_age`` lives for a single check of whether a Task is precalculated,
+    one with a ``max_age`` can be shared by every Task of a TaskGraph and
+    stats older than that are refreshed. Safe to use from multiple threads.
+
+    """
+
+    def __init__(self, max_age=None):
+        """Create an empty memo.
+
+        Args:
+            max_age (float): if not None, the number of seconds a stat is
+                reused before the path is stat'd again.
+
+        """
+        self._max_age = max_age
+        # maps paths to ``(stat_time, os.stat_result or None)``
+        self._stat_map = {}
+
+    def stat(self, path):
+        """Return ``os.stat(path)`` or None if the path can't be stat'd."""
+        now = time.time()
+        memo = self._stat_map.get(path)
+        if memo is not None and (
+                self._max_age is None or now - memo[0] <= self._max_age):
+            return memo[1]
+        try:
+            file_stat = os.stat(path)
+        except (OSError, ValueError):
+            # the same cases ``os.path.exists`` reports as not existing
+            file_stat = None
+        self._stat_map[path] = (now, file_stat)
+        return file_stat
+
+    def invalidate(self, path_list):
+        """Forget the stats of the paths in ``path_list``."""
+        for path in path_list:
+            self._stat_map.pop(path, None)
+
+
+class _DirectoryListingCache(object):
+    """Least recently used cache of directory listings.
+
+    A directory's listing is reused until its modified time changes, which
+    happens when an entry is added, removed, or renamed. Safe to use from
+    multiple threads.
+
+    """
+
+    def __init__(self, max_size):
+        """Create an empty cache.
+
+        Args:
+            max_size (int): maximum number of directory listings kept, the
+                least recently used is dropped to make room for another.
+
+        """
+        self._max_size = max_size
+        # maps directory paths to ``(st_mtime_ns, entry_list)`` with the
+        # most recently used last
+        self._listing_map = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_entry_list(self, dir_path):
+        """Return ``_list_directory(dir_path)``, from the cache if current.
+
+        Raises:
+            OSError if ``dir_path`` can't be stat'd or listed.
+
+        """
+        dir_stat = os.stat(dir_path)
+        with self._lock:
+            listing = self._listing_map.get(dir_path)
+            if listing is not None and listing[0] == dir_stat.st_mtime_ns:
+                self._listing_map.move_to_end(dir_path)
+                return listing[1]
+        entry_list = _list_directory(dir_path)
+        # an entry added within the timestamp resolution could leave the
+        # modified time unchanged
+        if dir_stat.st_mtime_ns <= (
+                time.time() - _FILE_FINGERPRINT_MIN_AGE) * 1e9:
+            with self._lock:
+                self._listing_map[dir_path] = (
+                    dir_stat.st_mtime_ns, entry_list)
+                self._listing_map.move_to_end(dir_path)
+                while len(self._listing_map) > self._max_size:
+                    self._listing_map.popitem(last=False)
+        return entry_list
+
+
+class _RuntimeHistory(object):
+    """Runtime statistics of executed Tasks by task id and by function.
+
+    The statistics of a key are its number of runs, mean runtime, the
+    runtimes of its most recent runs for percentiles, and the most peak
+    memory reported. They're loaded from the runtime history database once
+    and kept in memory, ``flush`` writes the ones that changed. If several
+    TaskGraph processes share a cache directory the last one to flush a key
+    wins. Safe to use from multiple threads.
+
+    """
+
+    def __init__(self, database_path):
+        """Load the runtime history, creating its database if needed.
+
+        Args:
+            database_path (str): path to the runtime history database or
+                None to keep the history in memory only.
+
+        """
+        self._database_path = database_path
+        self._lock = threading.Lock()
+        # maps ``(kind, key)`` to ``[run_count, mean_runtime, peak_memory,
+        # recent_runtime_list, last_run_time]`` lists
+        self._stats_map = {}
+        self._dirty_key_set = set()
+        if database_path is None:
+            return
+        _execute_sqlite(
+            _RUNTIME_HISTORY_DATABASE_SCRIPT, database_path, mode='modify',
+            execute='script')
+        for (kind, key, run_count, mean_runtime, peak_memory,
+             recent_runtimes, last_run_time) in _execute_sqlite(
+                'SELECT * FROM runtime_history', database_path,
+                mode='read_only', fetch='all'):
+            self._stats_map[(kind, key)] = [
+                run_count, mean_runtime, peak_memory,
+                list(struct.unpack(
+                    '<%dd' % (len(recent_runtimes) // 8), recent_runtimes)),
+                last_run_time]
+
+    def record(self, task_id_hash, function_name, runtime, peak_memory):
+        """Add a run to the statistics of a task id and of its function.
+
+        Args:
+            task_id_hash (str): the ``_task_id_hash`` of the Task.
+            function_name (str): ``_get_function_name`` of the Task
+                function.
+            runtime (float): seconds the function took.
+            peak_memory (int): peak memory in bytes of the process that
+                called the function or None if unknown.
+
+        Returns:
+            None.
+
+        """
+        now = time.time()
+        with self._lock:
+            for stats_key in [
+                    ('task', task_id_hash), ('function', function_name)]:
+                stats = self._stats_map.setdefault(
+                    stats_key, [0, 0.0, None, [], now])
+                stats[0] += 1
+                stats[1] += (runtime - stats[1]) / stats[0]
+                if peak_memory is not None:
+                    stats[2] = max(peak_memory, stats[2] or 0)
+                stats[3] = (stats[3] + [runtime])[
+                    -_RUNTIME_HISTORY_SAMPLE_COUNT:]
+                stats[4] = now
+                self._dirty_key_set.add(stats_key)
+
+    def get_stats(self, kind, key):
+        """Return the statistics of a key.
+
+        Args:
+            kind (str): 'task' or 'function'.
+            key (str): a task id hash or function name.
+
+        Returns:
+            None if ``key`` has no runtime history, otherwise a dict with
+            the keys 'run_count', 'mean_runtime', 'p95_runtime', and
+            'peak_memory'.
+
+        """
+        with self._lock:
+            stats = self._stats_map.get((kind, key))
+            if stats is None:
+                return None
+            run_count, mean_runtime, peak_memory, recent_runtime_list, _ = (
+                stats)
+            recent_runtime_list = sorted(recent_runtime_list)
+        # nearest rank percentile
+        p95_index = max(0, -(-95 * len(recent_runtime_list) // 100) - 1)
+        return {
+            'run_count': run_count,
+            'mean_runtime': mean_runtime,
+            'p95_runtime': recent_runtime_list[p95_index],
+            'peak_memory': peak_memory,
+        }
+
+    def get_known_runtime(self, task_id_hash, function_name):
+        """Return the mean runtime of a task id or of its function.
+
+        Returns:
+            the mean runtime in seconds of the task id if it ran before,
+            otherwise that of its function, otherwise None.
+
+        """
+        with self._lock:
+            for stats_key in [
+                    ('task', task_id_hash), ('function', function_name)]:
+                stats = self._stats_map.get(stats_key)
+                if stats is not None:
+                    return stats[1]
+        return None
+
+    def get_expected_runtime(self, task_id_hash, function_name):
+        """Return the expected runtime of a Task in seconds.
+
+        This is ``get_known_runtime`` if it's not None, otherwise the mean
+        of the mean runtimes of every function in the history, otherwise
+        ``_DEFAULT_EXPECTED_RUNTIME``.
+
+        """
+        known_runtime = self.get_known_runtime(task_id_hash, function_name)
+        if known_runtime is not None:
+            return known_runtime
+        with self._lock:
+            function_mean_list = [
+                stats[1] for (kind, _), stats in self._stats_map.items()
+                if kind == 'function']
+        if not function_mean_list:
+            return _DEFAULT_EXPECTED_RUNTIME
+        return sum(function_mean_list) / len(function_mean_list)
+
+    def flush(self):
+        """Write the statistics that changed since the last flush."""
+        if self._database_path is None:
+            return
+        with self._lock:
+            row_list = [
+                stats_key + (
+                    stats[0], stats[1], stats[2],
+                    struct.pack('<%dd' % len(stats[3]), *stats[3]),
+                    stats[4])
+                for stats_key, stats in (
+                    (stats_key, self._stats_map[stats_key])
+                    for stats_key in self._dirty_key_set)]
+            self._dirty_key_set.clear()
+        if not row_list:
+            return
+        _execute_sqlite(
+            'INSERT OR REPLACE INTO runtime_history '
+            'VALUES (?, ?, ?, ?, ?, ?, ?)', self._database_path,
+            mode='modify', execute='many', argument_list=row_list)
+
+    def prune(self, max_age):
+        """Remove the statistics of keys not run in ``max_age`` seconds."""
+        expire_time = time.time() - max_age
+        with self._lock:
+            for stats_key in [
+                    stats_key for stats_key, stats in self._stats_map.items()
+                    if stats[4] < expire_time]:
+                del self._stats_map[stats_key]
+                self._dirty_key_set.discard(stats_key)
+        if self._database_path is not None:
+            _execute_sqlite(
+                'DELETE FROM runtime_history WHERE last_run_time < ?',
+                self._database_path, mode='modify',
+                argument_list=(expire_time,))
+
+
+class _ReexecutionHashIndex(object):
+    """In memory set of task reexecution hashes with a completion record.
+
+    Hashes are kept as raw digest bytes rather than hex strings to keep the
+    index compact when there are hundreds of thousands of records. Adding
+    and testing membership is safe from multiple threads.
+
+    """
+
+    def __init__(self):
+        """Create an empty index."""
+        self._digest_set = set()
+
+    @staticmethod
+    def _key(task_reexecution_hash):
+        """Convert a hex hash to the compact form stored in the index."""
+        try:
+            return bytes.fromhex(task_reexecution_hash)
+        except (TypeError, ValueError):
+            # not something TaskGraph wrote, but don't lose it
+            return task_reexecution_hash
+
+    def load(self, cache_backend):
+        """Add the hash of every record in ``cache_backend`` to the index.
+
+        Args:
+            cache_backend (_CacheBackend): the TaskGraph cache backend.
+
+        Returns:
+            None.
+
+        """
+        self._digest_set.update(
+            self._key(task_reexecution_hash)
+            for task_reexecution_hash in cache_backend.keys())
+
+    def add(self, task_reexecution_hash):
+        """Record that ``task_reexecution_hash`` has a completion record."""
+        self._digest_set.add(self._key(task_reexecution_hash))
+
+    def discard(self, task_reexecution_hash):
+        """Remove ``task_reexecution_hash`` from the index if present."""
+        self._digest_set.discard(self._key(task_reexecution_hash))
+
+    def __contains__(self, task_reexecution_hash):
+        """Return True if ``task_reexecution_hash`` is in the index."""
+        return self._key(task_reexecution_hash) in self._digest_set
+
+    def __len__(self):
+        """Return the number of hashes in the index."""
+        return len(self._digest_set)
+
+
+class _AccessTimeBuffer(object):
+    """Last access times of records waiting to be put in a cache backend.
+
+    Used when there's no ``_CompletionRecordWriter`` so that finding a Task
+    precalculated doesn't cost a write transaction of its own.
+
+    """
+
+    def __init__(self, cache_backend):
+        """Create an empty buffer.
+
+        Args:
+            cache_backend (_CacheBackend): backend the access times are put
+                in on ``flush``.
+
+        """
+        self._cache_backend = cache_backend
+        # maps task reexecution hashes to their last access time
+        self._access_time_map = {}
+        self._lock = threading.Lock()
+
+    def touch(self, task_reexecution_hash):
+        """Set the last access time of a record to now."""
+        with self._lock:
+            self._access_time_map[task_reexecution_hash] = time.time()
+
+    def flush(self):
+        """Put every waiting access time in the cache backend at once."""
+        with self._lock:
+            access_time_map = self._access_time_map
+            self._access_time_map = {}
+        if access_time_map:
+            self._cache_backend.put_many([], [
+                (last_access_time, task_reexecution_hash)
+                for task_reexecution_hash, last_access_time in (
+                    access_time_map.items())])
+
+
+class _CompletionRecordWriter(object):
+    """Background thread that group commits Task completion records.
+
+    Executors ``submit`` records and ``touch`` records they reused rather
+    than writing to the cache backend themselves. The writer thread commits
+    them in a single ``put_many`` once ``batch_size`` are waiting or
+    ``batch_interval`` seconds have passed since the first of the batch
+    arrived, whichever comes first. Records that are submitted but not yet
+    committed are still visible through ``get_pending``.
+
+    """
+
+    # placed on the record queue to commit the current batch immediately
+    _FLUSH = object()
+    # placed on the record queue to commit and stop the writer thread
+    _STOP = object()
+
+    def __init__(self, cache_backend, batch_size, batch_interval):
+        """Create and start a completion record writer.
+
+        Args:
+            cache_backend (_CacheBackend): backend the records are put in.
+            batch_size (int): commit as soon as this many records are
+                waiting.
+            batch_interval (float): maximum number of seconds a record waits
+                before its batch is committed.
+
+        """
+        self._cache_backend = cache_backend
+        self._batch_size = batch_size
+        self._batch_interval = batch_interval
+        self._record_queue = queue.Queue()
+        # maps task reexecution hashes to records that are not committed yet
+        self._pending_record_map = {}
+        self._pending_lock = threading.Lock()
+        # an exception raised while committing, re-raised on ``flush``
+        self._write_exception = None
+        # guards ``_stopped`` so nothing is queued after the stop marker
+        self._stop_lock = threading.Lock()
+        self._stopped = False
+        self._writer_thread = threading.Thread(
+            target=self._write_records, name='_completion_record_writer')
+        self._writer_thread.daemon = True
+        self._writer_thread.start()
+
+    def submit(
+            self, task_reexecution_hash, target_path_stats, result,
+            record_size):
+        """Queue a completion record to be put in the cache backend.
+
+        Args:
+            task_reexecution_hash (str): key of the record.
+            target_path_stats (bytes): pickled target path stats.
+            result (bytes): pickled result of the Task.
+            record_size (int): number of bytes the record takes in the
+                cache.
+
+        Returns:
+            None.
+
+        """
+        record = (
+            task_reexecution_hash, target_path_stats, result, record_size)
+        with self._stop_lock:
+            if not self._stopped:
+                with self._pending_lock:
+                    self._pending_record_map[task_reexecution_hash] = record
+                self._record_queue.put(record)
+                return
+        # a Task can still finish after the writer is stopped during a
+        # termination, there's no batch to join so write it directly
+        self._commit([record])
+
+    def touch(self, task_reexecution_hash):
+        """Queue an update of the last access time of a record to now."""
+        access = (time.time(), task_reexecution_hash)
+        with self._stop_lock:
+            if not self._stopped:
+                self._record_queue.put(access)
+                return
+        self._commit([access])
+
+    def get_pending(self, task_reexecution_hash):
+        """Return the uncommitted record for a hash or None if there is none.
+
+        The record is a ``(target_path_stats, result)`` list in the same
+        form as the fields of a record in the cache backend.
+
+        """
+        with self._pending_lock:
+            record = self._pending_record_map.get(task_reexecution_hash)
+        if record is None:
+            return None
+        return list(record[1:3])
+
+    def flush(self):
+        """Block until every submitted record is committed.
+
+        Raises:
+            the exception that caused a batch to fail to commit, if any.
+
+        """
+        with self._stop_lock:
+            if not self._stopped:
+                self._record_queue.put(_CompletionRecordWriter._FLUSH)
+        # a stop queued after the flush commits everything before it too
+        self._record_queue.join()
+        if self._write_exception is not None:
+            raise self._write_exception
+
+    def stop(self):
+        """Commit any waiting records and stop the writer thread.
+
+        Blocks until the writer thread is finished even if another thread
+        already stopped it.
+
+        """
+        with self._stop_lock:
+            if not self._stopped:
+                self._stopped = True
+                self._record_queue.put(_CompletionRecordWriter._STOP)
+        self._writer_thread.join()
+
+    def _write_records(self):
+        """Collect submitted records into batches and commit them."""
+        LOGGER.debug('starting completion record writer')
+        running = True
+        while running:
+            batch = []
+            # count of queue items taken, including the control markers
+            n_items = 0
+            item = self._record_queue.get()
+            n_items += 1
+            deadline = time.time() + self._batch_interval
+            while True:
+                if item is _CompletionRecordWriter._STOP:
+                    running = False
+                    break
+                if item is _CompletionRecordWriter._FLUSH:
+                    break
+                batch.append(item)
+                if len(batch) >= self._batch_size:
+                    break
+                try:
+                    item = self._record_queue.get(
+                        timeout=max(0, deadline - time.time()))
+                    n_items += 1
+                except queue.Empty:
+                    break
+            if batch:
+                self._commit(batch)
+            for _ in range(n_items):
+                self._record_queue.task_done()
+        LOGGER.debug('completion record writer shutting down')
+
+    def _commit(self, batch):
+        """Write ``batch`` in one transaction and clear it from pending."""
+        # completion records have four fields, accesses have two
+        record_list = [item for item in batch if len(item) == 4]
+        access_list = [item for item in batch if len(item) == 2]
+        try:
+            self._cache_backend.put_many(record_list, access_list)
+        except Exception as e:
+            LOGGER.exception(
+                'failed to record %d completed tasks', len(record_list))
+            self._write_exception = e
+        with self._pending_lock:
+            for record in record_list:
+                # only clear if a newer record didn't replace this one
+                if self._pending_record_map.get(record[0]) is record:
+                    del self._pending_record_map[record[0]]
+
+
+def _task_record_command_list(record_list, access_list):
+    """Build the SQLite commands that store completion records.
+
+    Args:
+        record_list (list): list of ``(task_reexecution_hash,
+            target_path_stats, result, record_size)`` tuples to insert or
+            replace in ``taskgraph_data``. Their last access time is now.
+        access_list (list): list of ``(last_access_time,
+            task_reexecution_hash)`` tuples of existing records to update.
+
+    Returns:
+        list of ``(sqlite_command, argument_list, execute)`` tuples for
+        ``_execute_sqlite_transaction``.
+
+    """
+    command_list = []
+    if record_list:
+        now = time.time()
+        command_list.append((
+            'INSERT OR REPLACE INTO taskgraph_data VALUES (?, ?, ?)',
+            [record[:3] for record in record_list], 'many'))
+        command_list.append((
+            'INSERT OR REPLACE INTO taskgraph_data_access VALUES (?, ?, ?)',
+            [(record[0], now, record[3]) for record in record_list],
+            'many'))
+    if access_list:
+        command_list.append((
+            '''
+            UPDATE taskgraph_data_access SET last_access_time = ?
+            WHERE task_reexecution_hash = ?
+            ''', access_list, 'many'))
+    return command_list
+
+
+@retrying.retry(
     wait_exponential_multiplier=500, wait_exponential_max=3200,
-    stop_max_attempt_number=100)
+    stop_max_attempt_number=100,
+    retry_on_exception=_is_sqlite_locked_error)
 def _execute_sqlite(
         sqlite_command, database_path, argument_list=None,
-        mode='read_only', execute='execute', fetch=None):
-    """Execute SQLite command and attempt retries on a failure.
+        mode='read_only', execute='execute', fetch=None,
+        connection_pool=None):
+    """Execute SQLite command and retry while the database is locked.
 
     Args:
         sqlite_command (str): a well formatted SQLite command.
         database_path (str): path to the SQLite database to operate on.
         argument_list (list): ``execute == 'execute'`` then this list is passed
-            to the internal sqlite3 ``execute`` call.
+            to the internal sqlite3 ``execute`` call. If
+            ``execute == 'many'`` this is a list of argument tuples passed to
+            ``executemany``.
         mode (str): must be either 'read_only' or 'modify'.
-        execute (str): must be either 'execute' or 'script'.
+        execute (str): must be either 'execute', 'many', or 'script'.
         fetch (str): if not ``None`` can be either 'all' or 'one'.
             If not None the result of a fetch will be returned by this
             function.
+        connection_pool (_SQLiteConnectionPool): if not None, a connection
+            is borrowed from this pool rather than opening and closing a new
+            connection to ``database_path`` for this one command.
 
     Returns:
         result of fetch if ``fetch`` is not None.
 
     """
+    if connection_pool is not None:
+        return _execute_pooled_sqlite(
+            sqlite_command, connection_pool, argument_list, mode, execute,
+            fetch)
     cursor = None
     connection = None
     try:
-        if mode == 'read_only':
-            ro_uri = r'%s?mode=ro' % pathlib.Path(
-                os.path.abspath(database_path)).as_uri()
-            LOGGER.debug(
-                '%s exists: %s', ro_uri, os.path.exists(os.path.abspath(
-                    database_path)))
-            connection = sqlite3.connect(ro_uri, uri=True)
-        elif mode == 'modify':
-            connection = sqlite3.connect(database_path)
-        else:
-            raise ValueError('Unknown mode: %s' % mode)
+        connection = _connect_sqlite(database_path, mode)
 
-        if execute == 'execute':
-            if argument_list is None:
-                cursor = connection.execute(sqlite_command)
-            else:
-                cursor = connection.execute(sqlite_command, argument_list)
-        elif execute == 'script':
-            cursor = connection.executescript(sqlite_command)
-        else:
-            raise ValueError('Unknown execute mode: %s' % execute)
+        cursor = _execute_on_connection(
+            connection, sqlite_command, argument_list, execute)
 
         result = None
         payload = None
@@ -1585,3 +5144,128 @@ def _execute_sqlite(
         if connection is not None:
             connection.commit()
             connection.close()
+
+
+@retrying.retry(
+    wait_exponential_multiplier=500, wait_exponential_max=3200,
+    stop_max_attempt_number=100,
+    retry_on_exception=_is_sqlite_locked_error)
+def _execute_sqlite_transaction(command_list, connection_pool):
+    """Execute several SQLite commands in one transaction.
+
+    The transaction is retried while the database is locked.
+
+    Args:
+        command_list (list): list of ``(sqlite_command, argument_list,
+            execute)`` tuples where the values are as described in
+            ``_execute_sqlite``. The commands are executed in order and
+            either all of them or none are committed.
+        connection_pool (_SQLiteConnectionPool): pool whose writer
+            connection is used.
+
+    Returns:
+        None.
+
+    """
+    connection = connection_pool.acquire('modify')
+    discard = False
+    try:
+        for sqlite_command, argument_list, execute in command_list:
+            _execute_on_connection(
+                connection, sqlite_command, argument_list, execute).close()
+        connection.commit()
+    except sqlite3.OperationalError:
+        LOGGER.warning(
+            'TaskGraph database is locked because another process is using '
+            'it, waiting for a bit of time to try again')
+        discard = not _rollback_sqlite(connection)
+        raise
+    except Exception:
+        LOGGER.exception(
+            'Exception on _execute_sqlite_transaction: %s',
+            [command[0] for command in command_list])
+        discard = not _rollback_sqlite(connection)
+        raise
+    finally:
+        connection_pool.release(connection, 'modify', discard=discard)
+
+
+def _execute_on_connection(
+        connection, sqlite_command, argument_list, execute):
+    """Run ``sqlite_command`` on ``connection`` as described by ``execute``.
+
+    Returns:
+        the ``sqlite3.Cursor`` of the command.
+
+    """
+    if execute == 'execute':
+        if argument_list is None:
+            return connection.execute(sqlite_command)
+        return connection.execute(sqlite_command, argument_list)
+    elif execute == 'many':
+        return connection.executemany(sqlite_command, argument_list)
+    elif execute == 'script':
+        return connection.executescript(sqlite_command)
+    raise ValueError('Unknown execute mode: %s' % execute)
+
+
+def _execute_pooled_sqlite(
+        sqlite_command, connection_pool, argument_list, mode, execute,
+        fetch):
+    """Execute SQLite command on a connection borrowed from a pool.
+
+    This is the body of ``_execute_sqlite`` when a ``connection_pool`` is
+    provided and takes the same arguments. Retries are handled by the
+    caller.
+
+    Returns:
+        result of fetch if ``fetch`` is not None.
+
+    """
+    connection = connection_pool.acquire(mode)
+    discard = False
+    try:
+        cursor = _execute_on_connection(
+            connection, sqlite_command, argument_list, execute)
+        try:
+            if fetch == 'all':
+                payload = cursor.fetchall()
+            elif fetch == 'one':
+                payload = cursor.fetchone()
+            elif fetch is None:
+                payload = None
+            else:
+                raise ValueError('Unknown fetch mode: %s' % fetch)
+        finally:
+            cursor.close()
+        connection.commit()
+        if payload is not None:
+            return list(payload)
+        return None
+    except sqlite3.OperationalError:
+        LOGGER.warning(
+            'TaskGraph database is locked because another process is using '
+            'it, waiting for a bit of time to try again')
+        discard = not _rollback_sqlite(connection)
+        raise
+    except Exception:
+        LOGGER.exception('Exception on _execute_sqlite: %s', sqlite_command)
+        discard = not _rollback_sqlite(connection)
+        raise
+    finally:
+        connection_pool.release(connection, mode, discard=discard)
+
+
+def _rollback_sqlite(connection):
+    """Roll back any open transaction on ``connection``.
+
+    Returns:
+        True if the connection is still usable, False otherwise.
+
+    """
+    try:
+        connection.rollback()
+        return True
+    except sqlite3.Error:
+        LOGGER.exception('could not roll back sqlite connection')
+        return False
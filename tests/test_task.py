@@ -1,4 +1,6 @@
 """Tests for taskgraph."""
+import collections
+import enum
 import hashlib
 import logging
 import logging.handlers
@@ -11,8 +13,10 @@ import rstcheck
 import shutil
 import sqlite3
 import tempfile
+import threading
 import time
 import unittest
+import unittest.mock
 
 import retrying
 import taskgraph
@@ -36,6 +40,11 @@ def _noop_function(**kwargs):
     pass
 
 
+def _return_list(value, length):
+    """Return a list of ``value`` repeated ``length`` times."""
+    return [value] * length
+
+
 def _long_running_function(delay):
     """Wait for ``delay`` seconds."""
     time.sleep(delay)
@@ -123,6 +132,33 @@ def _copy_two_files_once(base_path, target_a_path, target_b_path):
     shutil.copyfile(base_path, target_b_path)
 
 
+# names passed to ``_record_execution`` in the order it was called
+_EXECUTION_ORDER_LIST = []
+# set by ``_wait_for_gate`` once it's called, it returns once
+# ``_GATE_OPEN_EVENT`` is set
+_GATE_ENTERED_EVENT = threading.Event()
+_GATE_OPEN_EVENT = threading.Event()
+
+
+def _record_execution(name, delay=0):
+    """Append ``name`` to ``_EXECUTION_ORDER_LIST`` then sleep ``delay``."""
+    _EXECUTION_ORDER_LIST.append(name)
+    time.sleep(delay)
+
+
+def _get_run_interval(delay):
+    """Sleep ``delay`` seconds, return the start and end ``time.time``."""
+    start_time = time.time()
+    time.sleep(delay)
+    return start_time, time.time()
+
+
+def _wait_for_gate():
+    """Signal the gate was entered then wait until it's opened."""
+    _GATE_ENTERED_EVENT.set()
+    _GATE_OPEN_EVENT.wait()
+
+
 def _log_from_another_process(logger_name, log_message):
     """Write a log message to a given logger.
 
@@ -1434,6 +1470,1272 @@ class TaskGraphTests(unittest.TestCase):
         self.assertEqual(
             list(rstcheck.check(open('HISTORY.rst', 'r').read())), [])
 
+    def test_database_connection_pool(self):
+        """TaskGraph: test tasks share pooled connections to the database."""
+        task_graph = taskgraph.TaskGraph(self.workspace_dir, 4)
+        n_tasks = 20
+        for task_index in range(n_tasks):
+            target_path = os.path.join(
+                self.workspace_dir, f'{task_index}.txt')
+            task_graph.add_task(
+                func=_create_file,
+                args=(target_path, str(task_index)),
+                target_path_list=[target_path],
+                task_name=f'create {task_index}')
+        task_graph.close()
+        task_graph.join()
+        task_graph = None
+
+        database_path = os.path.join(
+            self.workspace_dir, taskgraph._TASKGRAPH_DATABASE_FILENAME)
+        with sqlite3.connect(database_path) as conn:
+            cursor = conn.cursor()
+            cursor.execute('PRAGMA journal_mode')
+            journal_mode = cursor.fetchone()[0]
+            cursor.execute('SELECT * FROM taskgraph_data')
+            result = cursor.fetchall()
+        self.assertEqual(journal_mode.lower(), 'wal')
+        self.assertEqual(len(result), n_tasks)
+
+        # a second run should find every task precalculated
+        task_graph = taskgraph.TaskGraph(self.workspace_dir, 4)
+        for task_index in range(n_tasks):
+            target_path = os.path.join(
+                self.workspace_dir, f'{task_index}.txt')
+            task = task_graph.add_task(
+                func=_create_file,
+                args=(target_path, str(task_index)),
+                target_path_list=[target_path],
+                task_name=f'create {task_index}')
+            self.assertTrue(task.is_precalculated())
+        task_graph.close()
+        task_graph.join()
+
+    def test_completion_records_flushed_on_join(self):
+        """TaskGraph: test batched completion records are written on join."""
+        task_graph = taskgraph.TaskGraph(self.workspace_dir, 2)
+        n_tasks = 50
+        for task_index in range(n_tasks):
+            task_graph.add_task(
+                func=_noop_function,
+                kwargs={'index': task_index},
+                store_result=True,
+                task_name=f'noop {task_index}')
+        # join without closing, the records should still be committed
+        task_graph.join()
+
+        database_path = os.path.join(
+            self.workspace_dir, taskgraph._TASKGRAPH_DATABASE_FILENAME)
+        with sqlite3.connect(database_path) as conn:
+            cursor = conn.cursor()
+            cursor.execute('SELECT * FROM taskgraph_data')
+            result = cursor.fetchall()
+        self.assertEqual(len(result), n_tasks)
+        task_graph.close()
+        task_graph.join()
+
+    def test_reexecution_hash_index(self):
+        """TaskGraph: test known task hashes are loaded on startup."""
+        target_path = os.path.join(self.workspace_dir, 'target.txt')
+        task_graph = taskgraph.TaskGraph(self.workspace_dir, -1)
+        task = task_graph.add_task(
+            func=_create_file,
+            args=(target_path, 'content'),
+            target_path_list=[target_path])
+        self.assertTrue(
+            task._task_reexecution_hash in task_graph._reexecution_hash_index)
+        task_graph.close()
+        task_graph.join()
+        task_graph = None
+
+        task_graph = taskgraph.TaskGraph(self.workspace_dir, -1)
+        self.assertEqual(len(task_graph._reexecution_hash_index), 1)
+        self.assertTrue(
+            task._task_reexecution_hash in task_graph._reexecution_hash_index)
+        self.assertFalse('0' * 40 in task_graph._reexecution_hash_index)
+        task_graph.close()
+        task_graph.join()
+
+    def test_lazy_stored_result(self):
+        """TaskGraph: test a precalculated result loads only on ``get``."""
+        if hasattr(_return_value_once, 'executed'):
+            del _return_value_once.executed
+        task_graph = taskgraph.TaskGraph(self.workspace_dir, -1)
+        value_task = task_graph.add_task(
+            func=_return_value_once,
+            args=('stored value',),
+            store_result=True)
+        self.assertEqual(value_task.get(), 'stored value')
+        task_graph.close()
+        task_graph.join()
+        task_graph = None
+
+        task_graph = taskgraph.TaskGraph(self.workspace_dir, -1)
+        value_task = task_graph.add_task(
+            func=_return_value_once,
+            args=('stored value',),
+            store_result=True)
+        # precalculated, but nothing has asked for the result yet
+        self.assertTrue(value_task._result_needs_load)
+        self.assertEqual(value_task._result, None)
+        self.assertEqual(value_task.get(), 'stored value')
+        self.assertFalse(value_task._result_needs_load)
+        task_graph.close()
+        task_graph.join()
+        del _return_value_once.executed
+
+    def test_compressed_result(self):
+        """TaskGraph: test stored results can be compressed."""
+        from taskgraph.Task import _RESULT_FORMAT_MARKER
+        database_path = os.path.join(
+            self.workspace_dir, taskgraph._TASKGRAPH_DATABASE_FILENAME)
+        expected_result = ['a value'] * 1000
+
+        # stored uncompressed first so it's an "old" record
+        task_graph = taskgraph.TaskGraph(
+            self.workspace_dir, -1, result_compression_threshold=0)
+        uncompressed_task = task_graph.add_task(
+            func=_return_list, args=('a value', 1000), store_result=True)
+        self.assertEqual(uncompressed_task.get(), expected_result)
+        for compression in ['zlib', 'lzma', 'bz2']:
+            compressed_task = task_graph.add_task(
+                func=_return_list, args=(compression, 1000),
+                store_result=True, result_compression=compression)
+            self.assertEqual(
+                compressed_task.get(), [compression] * 1000)
+        task_graph.close()
+        task_graph.join()
+        task_graph = None
+
+        with sqlite3.connect(database_path) as conn:
+            cursor = conn.cursor()
+            cursor.execute('SELECT result FROM taskgraph_data')
+            result_list = [row[0] for row in cursor.fetchall()]
+        self.assertEqual(
+            len([result for result in result_list
+                 if result.startswith(_RESULT_FORMAT_MARKER)]), 3)
+
+        # every record is readable by a TaskGraph that compresses results
+        task_graph = taskgraph.TaskGraph(
+            self.workspace_dir, -1, result_compression='zlib',
+            result_compression_threshold=0)
+        uncompressed_task = task_graph.add_task(
+            func=_return_list, args=('a value', 1000), store_result=True)
+        self.assertEqual(uncompressed_task.get(), expected_result)
+        for compression in ['zlib', 'lzma', 'bz2']:
+            compressed_task = task_graph.add_task(
+                func=_return_list, args=(compression, 1000),
+                store_result=True, result_compression='none')
+            self.assertEqual(
+                compressed_task.get(), [compression] * 1000)
+        task_graph.close()
+        task_graph.join()
+
+        with self.assertRaises(ValueError):
+            taskgraph.TaskGraph(
+                self.workspace_dir, -1, result_compression='not a method')
+
+    def test_spilled_result(self):
+        """TaskGraph: test large stored results are spilled to files."""
+        from taskgraph.Task import _RESULT_SPILL_DIRNAME
+        from taskgraph.Task import _TASKGRAPH_DATABASE_FILENAME
+        task_graph = taskgraph.TaskGraph(
+            self.workspace_dir, -1, result_spill_threshold=1024)
+        small_task = task_graph.add_task(
+            func=_return_list, args=('small', 1), store_result=True)
+        large_task = task_graph.add_task(
+            func=_return_list, args=(bytearray(b'large' * 1000), 2),
+            store_result=True)
+        task_graph.close()
+        task_graph.join()
+        task_graph = None
+
+        spill_dir_path = os.path.join(
+            self.workspace_dir, _RESULT_SPILL_DIRNAME)
+        self.assertEqual(
+            os.listdir(spill_dir_path),
+            [f'{large_task._task_reexecution_hash}.pickle'])
+
+        task_graph = taskgraph.TaskGraph(
+            self.workspace_dir, -1, result_spill_threshold=1024)
+        small_task = task_graph.add_task(
+            func=_return_list, args=('small', 1), store_result=True)
+        large_task = task_graph.add_task(
+            func=_return_list, args=(bytearray(b'large' * 1000), 2),
+            store_result=True)
+        self.assertEqual(small_task.get(), ['small'])
+        self.assertEqual(large_task.get(), [bytearray(b'large' * 1000)] * 2)
+        task_graph.close()
+        task_graph.join()
+        task_graph = None
+
+        # on Windows a spill file that's memory mapped can't be replaced,
+        # the result goes to a file of its own instead
+        real_replace = os.replace
+
+        def _replace_unless_exists(src, dst):
+            if os.path.exists(dst):
+                raise PermissionError(f'{dst} is in use')
+            return real_replace(src, dst)
+
+        # forget the record so the Task executes again
+        os.remove(os.path.join(
+            self.workspace_dir, _TASKGRAPH_DATABASE_FILENAME))
+        for spill_filename in os.listdir(spill_dir_path):
+            os.remove(os.path.join(spill_dir_path, spill_filename))
+        with open(os.path.join(
+                spill_dir_path,
+                f'{large_task._task_reexecution_hash}.pickle'), 'wb') as (
+                    spill_file):
+            spill_file.write(b'in use')
+        with unittest.mock.patch.object(
+                os, 'replace', side_effect=_replace_unless_exists):
+            task_graph = taskgraph.TaskGraph(
+                self.workspace_dir, -1, result_spill_threshold=1024)
+            large_task = task_graph.add_task(
+                func=_return_list, args=(bytearray(b'large' * 1000), 2),
+                store_result=True)
+            task_graph.close()
+            task_graph.join()
+            task_graph = None
+        self.assertEqual(len(os.listdir(spill_dir_path)), 2)
+
+        task_graph = taskgraph.TaskGraph(
+            self.workspace_dir, -1, result_spill_threshold=1024)
+        large_task = task_graph.add_task(
+            func=_return_list, args=(bytearray(b'large' * 1000), 2),
+            store_result=True)
+        self.assertEqual(large_task.get(), [bytearray(b'large' * 1000)] * 2)
+        task_graph.close()
+        task_graph.join()
+        task_graph = None
+
+        # both files of the record are pruned with it
+        task_graph = taskgraph.TaskGraph(self.workspace_dir, -1)
+        self.assertEqual(task_graph.prune_cache(max_bytes=0), 1)
+        task_graph.close()
+        task_graph.join()
+        self.assertEqual(os.listdir(spill_dir_path), [])
+
+    def test_prune_cache(self):
+        """TaskGraph: test least recently used records are pruned."""
+        from taskgraph.Task import _RESULT_SPILL_DIRNAME
+        task_graph = taskgraph.TaskGraph(
+            self.workspace_dir, -1, result_spill_threshold=1024)
+        task_list = []
+        for task_index in range(4):
+            task_list.append(task_graph.add_task(
+                func=_return_list, args=(task_index, 1000),
+                store_result=True, task_name=f'list {task_index}'))
+            # make sure every record has a distinct access time
+            time.sleep(0.01)
+        task_graph.close()
+        task_graph.join()
+        task_graph = None
+        spill_dir_path = os.path.join(
+            self.workspace_dir, _RESULT_SPILL_DIRNAME)
+        self.assertEqual(len(os.listdir(spill_dir_path)), 4)
+
+        # reuse the first record so the second is now least recently used
+        task_graph = taskgraph.TaskGraph(self.workspace_dir, -1)
+        access_list = task_graph._cache_backend.get_access_list()
+        task_graph.add_task(
+            func=_return_list, args=(0, 1000), store_result=True)
+        # the access time is kept in memory until the TaskGraph is joined
+        self.assertEqual(
+            task_graph._cache_backend.get_access_list(), access_list)
+        task_graph.close()
+        task_graph.join()
+        self.assertEqual(
+            task_graph._cache_backend.get_access_list()[-1][0],
+            task_list[0]._task_reexecution_hash)
+        task_graph = None
+
+        task_graph = taskgraph.TaskGraph(self.workspace_dir, -1)
+        self.assertEqual(task_graph.prune_cache(), 0)
+        self.assertEqual(task_graph.prune_cache(max_age=60), 0)
+        # a single record is larger than this so only one can remain
+        self.assertEqual(task_graph.prune_cache(max_bytes=3000), 3)
+        self.assertEqual(len(task_graph._reexecution_hash_index), 1)
+        self.assertEqual(
+            os.listdir(spill_dir_path),
+            [f'{task_list[0]._task_reexecution_hash}.pickle'])
+        task_graph.close()
+        task_graph.join()
+        task_graph = None
+
+        # the pruned records are gone for a new TaskGraph too
+        task_graph = taskgraph.TaskGraph(
+            self.workspace_dir, -1, cache_max_age=0)
+        self.assertTrue(
+            task_list[0]._task_reexecution_hash in
+            task_graph._reexecution_hash_index)
+        self.assertFalse(
+            task_list[1]._task_reexecution_hash in
+            task_graph._reexecution_hash_index)
+        # cache_max_age=0 prunes everything not in this TaskGraph on close
+        task_graph.close()
+        self.assertEqual(len(task_graph._reexecution_hash_index), 0)
+        task_graph.join()
+
+        # only a locked database is retried, other errors are raised
+        # right away
+        from taskgraph.Task import _execute_sqlite
+        from taskgraph.Task import _execute_sqlite_transaction
+        connection_pool = task_graph._cache_backend._connection_pool
+        start_time = time.time()
+        with self.assertRaises(sqlite3.OperationalError):
+            _execute_sqlite(
+                'SELECT * FROM missing_table',
+                connection_pool.database_path, fetch='all')
+        with self.assertRaises(sqlite3.OperationalError):
+            _execute_sqlite_transaction(
+                [('DELETE FROM missing_table', None, 'execute')],
+                connection_pool)
+        self.assertLess(time.time() - start_time, 5)
+
+    def test_database_schema_migration(self):
+        """TaskGraph: test an unversioned database is upgraded in place."""
+        from taskgraph.Task import _TASKGRAPH_DATABASE_FILENAME
+        from taskgraph.Task import _TASKGRAPH_DATABASE_SCHEMA_VERSION
+        from taskgraph.Task import _TASKGRAPH_DATABASE_V1_SCRIPT
+        target_path = os.path.join(self.workspace_dir, 'a.dat')
+        task_graph = taskgraph.TaskGraph(self.workspace_dir, -1)
+        task = task_graph.add_task(
+            func=_create_list_on_disk, args=(5, 10, target_path),
+            target_path_list=[target_path])
+        task_graph.close()
+        task_graph.join()
+        task_graph = None
+
+        # rebuild the database the way earlier versions of TaskGraph did
+        database_path = os.path.join(
+            self.workspace_dir, _TASKGRAPH_DATABASE_FILENAME)
+        with sqlite3.connect(database_path) as conn:
+            record_list = conn.execute(
+                'SELECT task_reexecution_hash, target_path_stats, result '
+                'FROM taskgraph_data').fetchall()
+        conn.close()
+        os.remove(database_path)
+        with sqlite3.connect(database_path) as conn:
+            conn.executescript(_TASKGRAPH_DATABASE_V1_SCRIPT)
+            conn.executemany(
+                'INSERT INTO taskgraph_data VALUES (?, ?, ?)', record_list)
+        conn.close()
+
+        task_graph = taskgraph.TaskGraph(self.workspace_dir, -1)
+        self.assertIn(
+            task._task_reexecution_hash, task_graph._reexecution_hash_index)
+        task_graph.close()
+        task_graph.join()
+        task_graph = None
+        with sqlite3.connect(database_path) as conn:
+            self.assertEqual(
+                conn.execute('PRAGMA user_version').fetchone()[0],
+                _TASKGRAPH_DATABASE_SCHEMA_VERSION)
+            self.assertEqual(
+                conn.execute(
+                    'SELECT count(*) FROM taskgraph_data').fetchone()[0], 1)
+        conn.close()
+
+        # a database TaskGraph doesn't recognize is recreated
+        os.remove(database_path)
+        with sqlite3.connect(database_path) as conn:
+            conn.execute('CREATE TABLE unrelated (value TEXT)')
+        conn.close()
+        task_graph = taskgraph.TaskGraph(self.workspace_dir, -1)
+        self.assertEqual(len(task_graph._reexecution_hash_index), 0)
+        task_graph.close()
+        task_graph.join()
+        task_graph = None
+
+        # an error that isn't lock contention is not retried, the database
+        # is recreated right away
+        os.remove(database_path)
+        with sqlite3.connect(database_path) as conn:
+            conn.execute('PRAGMA user_version = 1')
+        conn.close()
+        start_time = time.time()
+        task_graph = taskgraph.TaskGraph(self.workspace_dir, -1)
+        self.assertLess(time.time() - start_time, 5)
+        task_graph.close()
+        task_graph.join()
+        task_graph = None
+        with sqlite3.connect(database_path) as conn:
+            self.assertEqual(
+                conn.execute('PRAGMA user_version').fetchone()[0],
+                _TASKGRAPH_DATABASE_SCHEMA_VERSION)
+        conn.close()
+
+    def test_cache_backends(self):
+        """TaskGraph: test completion records in each cache backend."""
+        from taskgraph.Task import _CACHE_BACKEND_MAP
+        for cache_backend in sorted(_CACHE_BACKEND_MAP):
+            workspace_dir = os.path.join(self.workspace_dir, cache_backend)
+            target_path = os.path.join(workspace_dir, 'a.dat')
+            for run_index in range(2):
+                task_graph = taskgraph.TaskGraph(
+                    workspace_dir, 0, cache_backend=cache_backend)
+                task_graph.add_task(
+                    func=_create_list_on_disk, args=(5, 10, target_path),
+                    target_path_list=[target_path])
+                result_task = task_graph.add_task(
+                    func=_return_list, args=(3, 100), store_result=True)
+                task_graph.close()
+                task_graph.join()
+                task_graph = None
+                # the memory backend forgets every record once its
+                # TaskGraph is gone
+                self.assertEqual(
+                    result_task._result_needs_load,
+                    run_index == 1 and cache_backend != 'memory')
+                self.assertEqual(result_task.get(), [3] * 100)
+
+            backend_dir = os.path.join(workspace_dir, 'backend')
+            os.makedirs(backend_dir)
+            backend = _CACHE_BACKEND_MAP[cache_backend](backend_dir, 1)
+            backend.put_many([
+                ('a' * 40, b'stats a', b'result a', 100),
+                ('b' * 40, b'stats b', b'result b', 200)])
+            backend.touch('a' * 40)
+            self.assertEqual(
+                backend.lookup('a' * 40, 'target_path_stats'), b'stats a')
+            self.assertEqual(
+                backend.lookup_many(['a' * 40, 'b' * 40, 'c' * 40], 'result'),
+                {'a' * 40: b'result a', 'b' * 40: b'result b'})
+            self.assertIsNone(backend.lookup('c' * 40, 'result'))
+            with self.assertRaises(ValueError):
+                backend.lookup('a' * 40, 'unknown')
+            pruned_hash_list, _ = backend.prune(
+                max_bytes=200, protected_hash_set={'b' * 40})
+            self.assertEqual(pruned_hash_list, ['a' * 40])
+            self.assertNotIn('a' * 40, backend.keys())
+            self.assertIn('b' * 40, backend.keys())
+            backend.close()
+
+        with self.assertRaises(ValueError):
+            taskgraph.TaskGraph(self.workspace_dir, -1, cache_backend='x')
+
+        # a backend missing part of the interface can't be created
+        from taskgraph.Task import _CacheBackend
+
+        class _IncompleteCacheBackend(_CacheBackend):
+            def keys(self):
+                return []
+
+        with self.assertRaises(TypeError):
+            _IncompleteCacheBackend()
+
+    def test_sharded_cache(self):
+        """TaskGraph: test completion records spread across database shards."""
+        from taskgraph.Task import _TASKGRAPH_DATABASE_SHARD_FILENAME
+        task_list = []
+        for run_index in range(2):
+            task_graph = taskgraph.TaskGraph(
+                self.workspace_dir, 0, cache_shard_count=4)
+            task_list = [
+                task_graph.add_task(
+                    func=_return_list, args=(value, 10), store_result=True)
+                for value in range(32)]
+            task_graph.close()
+            task_graph.join()
+            task_graph = None
+            self.assertEqual(
+                [task._result_needs_load for task in task_list],
+                [run_index == 1] * len(task_list))
+            self.assertEqual(
+                [task.get() for task in task_list],
+                [[value] * 10 for value in range(32)])
+
+        self.assertFalse(os.path.exists(os.path.join(
+            self.workspace_dir, taskgraph._TASKGRAPH_DATABASE_FILENAME)))
+        shard_record_count_list = []
+        for shard_index in range(4):
+            with sqlite3.connect(os.path.join(
+                    self.workspace_dir,
+                    _TASKGRAPH_DATABASE_SHARD_FILENAME.format(
+                        shard_index=shard_index, shard_count=4))) as conn:
+                shard_record_count_list.append(conn.execute(
+                    'SELECT count(*) FROM taskgraph_data').fetchone()[0])
+            conn.close()
+        self.assertEqual(sum(shard_record_count_list), 32)
+        self.assertTrue(all(shard_record_count_list))
+
+        with self.assertRaises(ValueError):
+            taskgraph.TaskGraph(
+                self.workspace_dir, -1, cache_backend='memory',
+                cache_shard_count=4)
+
+    def test_file_fingerprint_cache(self):
+        """TaskGraph: test file digests are reused until the file changes."""
+        from taskgraph.Task import _FILE_FINGERPRINT_DATABASE_FILENAME
+        base_path = os.path.join(self.workspace_dir, 'base.txt')
+        target_path = os.path.join(self.workspace_dir, 'target.txt')
+
+        def _run_copy():
+            task_graph = taskgraph.TaskGraph(self.workspace_dir, -1)
+            task_graph.add_task(
+                func=shutil.copyfile, args=(base_path, target_path),
+                target_path_list=[target_path], hash_algorithm='sha256')
+            task_graph.close()
+            task_graph.join()
+
+        with open(base_path, 'w') as base_file:
+            base_file.write('original')
+        # a file modified just now isn't cached so make it look old
+        base_mtime_ns = int((time.time() - 60) * 1e9)
+        os.utime(base_path, ns=(base_mtime_ns, base_mtime_ns))
+        _run_copy()
+        with sqlite3.connect(os.path.join(
+                self.workspace_dir,
+                _FILE_FINGERPRINT_DATABASE_FILENAME)) as conn:
+            self.assertEqual(
+                conn.execute(
+                    'SELECT path, hash_algorithm FROM file_fingerprint'
+                    ).fetchall(),
+                [(os.path.normpath(base_path), 'sha256')])
+        conn.close()
+
+        # the contents change but the stats are identical, so the cached
+        # digest is trusted and the copy isn't made again
+        with open(base_path, 'w') as base_file:
+            base_file.write('modified')
+        os.utime(base_path, ns=(base_mtime_ns, base_mtime_ns))
+        _run_copy()
+        with open(target_path, 'r') as target_file:
+            self.assertEqual(target_file.read(), 'original')
+
+        # once the size or mtime changes the file is hashed again
+        with open(base_path, 'w') as base_file:
+            base_file.write('modified again')
+        _run_copy()
+        with open(target_path, 'r') as target_file:
+            self.assertEqual(target_file.read(), 'modified again')
+
+        # digests of files that changed or are gone are pruned
+        fingerprint_database_path = os.path.join(
+            self.workspace_dir, _FILE_FINGERPRINT_DATABASE_FILENAME)
+        os.remove(base_path)
+        task_graph = taskgraph.TaskGraph(self.workspace_dir, -1)
+        task_graph.prune_cache()
+        task_graph.close()
+        task_graph.join()
+        with sqlite3.connect(fingerprint_database_path) as conn:
+            self.assertEqual(
+                conn.execute(
+                    'SELECT count(*) FROM file_fingerprint').fetchone()[0],
+                0)
+        conn.close()
+
+        # with the memory cache backend nothing is written to disk
+        os.remove(fingerprint_database_path)
+        with open(base_path, 'w') as base_file:
+            base_file.write('original')
+        os.utime(base_path, ns=(base_mtime_ns, base_mtime_ns))
+        task_graph = taskgraph.TaskGraph(
+            self.workspace_dir, -1, cache_backend='memory')
+        task_graph.add_task(
+            func=shutil.copyfile, args=(base_path, target_path),
+            target_path_list=[target_path], hash_algorithm='sha256')
+        task_graph.close()
+        task_graph.join()
+        self.assertFalse(os.path.exists(fingerprint_database_path))
+
+    def test_get_file_stats_order(self):
+        """TaskGraph: test concurrently digested file stats keep order."""
+        from taskgraph.Task import _get_file_stats
+        from taskgraph.Task import _hash_file
+        path_list = []
+        for index in range(20):
+            path = os.path.join(self.workspace_dir, f'{index}.txt')
+            with open(path, 'w') as test_file:
+                test_file.write(str(index) * (index + 1))
+            path_list.append(path)
+        missing_path = os.path.join(self.workspace_dir, 'missing.txt')
+        base_value = [
+            path_list[:5], {'b': path_list[10:], 'a': missing_path},
+            (path_list[5:10], self.workspace_dir)]
+        expected_path_list = path_list[:5] + path_list[10:] + path_list[5:10]
+        for hash_algorithm in ['md5', 'sizetimestamp', 'exists']:
+            if hash_algorithm == 'exists':
+                expected_stats = [
+                    (path, 'exists') for path in expected_path_list]
+            else:
+                expected_stats = [
+                    (path, _hash_file(path, hash_algorithm))
+                    for path in expected_path_list]
+            self.assertEqual(
+                list(_get_file_stats(base_value, hash_algorithm, [], True)),
+                expected_stats)
+
+    def test_fast_hash_algorithms(self):
+        """TaskGraph: test fast content hash algorithms."""
+        from taskgraph.Task import _FAST_HASH_ALGORITHM_MAP
+        from taskgraph.Task import _hash_file
+        test_path = os.path.join(self.workspace_dir, 'test.bin')
+        content = os.urandom(1000)
+        with open(test_path, 'wb') as test_file:
+            test_file.write(content)
+        expected_digest_map = {
+            'md5': hashlib.md5(content).hexdigest(),
+            'blake2b_128': hashlib.blake2b(
+                content, digest_size=16).hexdigest(),
+        }
+        if 'xxh3_128' in _FAST_HASH_ALGORITHM_MAP:
+            import xxhash
+            expected_digest_map['xxh3_128'] = xxhash.xxh3_128(
+                content).hexdigest()
+        for hash_algorithm, expected_digest in expected_digest_map.items():
+            # a buffer that doesn't divide the file evenly
+            self.assertEqual(
+                _hash_file(test_path, hash_algorithm, buf_size=7),
+                expected_digest)
+            self.assertEqual(
+                _hash_file(test_path, hash_algorithm), expected_digest)
+
+        target_path = os.path.join(self.workspace_dir, 'target.bin')
+        for _ in range(2):
+            task_graph = taskgraph.TaskGraph(self.workspace_dir, -1)
+            task = task_graph.add_task(
+                func=shutil.copyfile, args=(test_path, target_path),
+                target_path_list=[target_path], hash_algorithm='blake2b_128')
+            task_graph.close()
+            task_graph.join()
+            task_graph = None
+        self.assertTrue(task.is_precalculated())
+
+        task_graph = taskgraph.TaskGraph(self.workspace_dir, -1)
+        with self.assertRaises(ValueError):
+            task_graph.add_task(
+                func=shutil.copyfile, args=(test_path, target_path),
+                target_path_list=[target_path], hash_algorithm='not_a_hash')
+
+    def test_headtail_hash_algorithm(self):
+        """TaskGraph: test the sampled 'headtail' hash algorithm."""
+        from taskgraph.Task import _hash_file
+        from taskgraph.Task import _hash_file_samples
+        base_path = os.path.join(self.workspace_dir, 'base.bin')
+        content = bytearray(os.urandom(1000))
+        with open(base_path, 'wb') as base_file:
+            base_file.write(content)
+        copy_path = os.path.join(self.workspace_dir, 'copy.bin')
+        shutil.copyfile(base_path, copy_path)
+        # a copy has a new timestamp but the same digest
+        self.assertEqual(
+            _hash_file(base_path, 'headtail'),
+            _hash_file(copy_path, 'headtail'))
+        base_digest = _hash_file_samples(base_path, 4, 10)
+
+        # samples of 10 bytes are at offsets 0, 330, 660, and 990
+        for offset, detected in [(0, True), (335, True), (999, True),
+                                 (500, False)]:
+            changed_content = bytearray(content)
+            changed_content[offset] ^= 0xff
+            with open(copy_path, 'wb') as copy_file:
+                copy_file.write(changed_content)
+            self.assertEqual(
+                _hash_file_samples(copy_path, 4, 10) != base_digest,
+                detected)
+        # a file no larger than the samples is digested in full
+        self.assertNotEqual(
+            _hash_file_samples(copy_path, 4, 250), base_digest)
+        with open(copy_path, 'ab') as copy_file:
+            copy_file.write(b'\x00')
+        self.assertNotEqual(
+            _hash_file_samples(copy_path, 4, 10), base_digest)
+
+        target_path = os.path.join(self.workspace_dir, 'target.bin')
+        for _ in range(2):
+            task_graph = taskgraph.TaskGraph(self.workspace_dir, -1)
+            task = task_graph.add_task(
+                func=shutil.copyfile, args=(base_path, target_path),
+                target_path_list=[target_path], hash_algorithm='headtail')
+            task_graph.close()
+            task_graph.join()
+            task_graph = None
+        self.assertTrue(task.is_precalculated())
+
+    def test_stat_memo(self):
+        """TaskGraph: test each path is stat'd once and exact mtime checks."""
+        from taskgraph.Task import _StatMemo
+        base_path = os.path.join(self.workspace_dir, 'base.txt')
+        with open(base_path, 'w') as base_file:
+            base_file.write('base')
+        stat_memo = _StatMemo(max_age=60)
+        base_stat = stat_memo.stat(base_path)
+        self.assertIsNone(stat_memo.stat(base_path + '.missing'))
+        os.utime(base_path, ns=(
+            base_stat.st_atime_ns, base_stat.st_mtime_ns + 10**9))
+        self.assertEqual(stat_memo.stat(base_path), base_stat)
+        stat_memo.invalidate([base_path])
+        self.assertNotEqual(stat_memo.stat(base_path), base_stat)
+        # an expired stat is refreshed
+        stat_memo = _StatMemo(max_age=0)
+        base_stat = stat_memo.stat(base_path)
+        os.utime(base_path, ns=(
+            base_stat.st_atime_ns, base_stat.st_mtime_ns + 10**9))
+        time.sleep(0.01)
+        self.assertNotEqual(stat_memo.stat(base_path), base_stat)
+
+        # a target that's one second newer but the same size is stale
+        target_path = os.path.join(self.workspace_dir, 'target.txt')
+        for stat_memo_max_age in [None, 60]:
+            task_graph = taskgraph.TaskGraph(
+                self.workspace_dir, -1, stat_memo_max_age=stat_memo_max_age)
+            task = task_graph.add_task(
+                func=shutil.copyfile, args=(base_path, target_path),
+                target_path_list=[target_path],
+                hash_algorithm='sizetimestamp')
+            task_graph.close()
+            task_graph.join()
+            self.assertTrue(task.is_precalculated())
+            target_stat = os.stat(target_path)
+            os.utime(target_path, ns=(
+                target_stat.st_atime_ns, target_stat.st_mtime_ns + 10**9))
+            if stat_memo_max_age is not None:
+                # the shared memo still holds the stat from the last run
+                self.assertTrue(task.is_precalculated())
+                task_graph._stat_memo.invalidate([target_path])
+            self.assertFalse(task.is_precalculated())
+            task_graph = None
+
+    def test_targets_fingerprinted_in_worker(self):
+        """TaskGraph: test targets are fingerprinted by the worker."""
+        from taskgraph.Task import _call_and_fingerprint_targets
+        from taskgraph.Task import _hash_file
+        target_a_path = os.path.join(self.workspace_dir, 'a.txt')
+        target_b_path = os.path.join(self.workspace_dir, 'b.txt')
+        payload, target_stat_list, _ = _call_and_fingerprint_targets(
+            _create_two_files_on_disk, ('value', target_a_path),
+            {'target_b_path': target_b_path},
+            [target_a_path, target_b_path], 'md5')
+        self.assertIsNone(payload)
+        self.assertEqual(
+            target_stat_list,
+            [(target_a_path, _hash_file(target_a_path, 'md5')),
+             (target_b_path, _hash_file(target_b_path, 'md5'))])
+
+        # workers forked after the file hash threads started still hash
+        for n_workers in [-1, 2]:
+            task_graph = taskgraph.TaskGraph(
+                os.path.join(self.workspace_dir, str(n_workers)), n_workers)
+            task = task_graph.add_task(
+                func=_create_two_files_on_disk,
+                args=(str(n_workers), target_a_path, target_b_path),
+                target_path_list=[target_a_path, target_b_path],
+                hash_algorithm='md5')
+            task_graph.close()
+            task_graph.join()
+            self.assertTrue(task.is_precalculated())
+            task_graph = None
+
+    def test_canonical_argument_hash(self):
+        """TaskGraph: test arguments are hashed canonically by type."""
+        from taskgraph.Task import _get_value_digest
+        distinct_value_list = [
+            None, True, False, 1, 1.0, '1', b'1', [1], (1,), {1}, {1: 1},
+            [1, [2]], [[1], 2], ['a', 'b'], ['ab'], {'a': 'b'}, {'a': 'c'},
+            [1, {2}], {'a': [1, {2}]}, {'a': [1, 2]}, {'a': [1, (2,)]},
+            pathlib.PurePosixPath('1')]
+        digest_set = set(
+            _get_value_digest(value) for value in distinct_value_list)
+        self.assertEqual(len(digest_set), len(distinct_value_list))
+        # sets hash the same regardless of insertion order
+        self.assertEqual(
+            _get_value_digest({'a': {2, 'c', (3,)}}),
+            _get_value_digest({'a': {(3,), 'c', 2}}))
+        # long containers are encoded in chunks
+        long_list = list(range(5000))
+        changed_list = list(long_list)
+        changed_list[-1] = -1
+        self.assertNotEqual(
+            _get_value_digest(long_list), _get_value_digest(changed_list))
+        self.assertNotEqual(
+            _get_value_digest(dict.fromkeys(long_list)),
+            _get_value_digest(dict.fromkeys(changed_list)))
+        self.assertNotEqual(
+            _get_value_digest(long_list),
+            _get_value_digest(tuple(long_list)))
+        # subclasses don't hash the same as their base type
+        point_type = collections.namedtuple('Point', ['x', 'y'])
+
+        class _Color(enum.IntEnum):
+            RED = 1
+
+        self.assertNotEqual(
+            _get_value_digest(point_type(1, 2)), _get_value_digest((1, 2)))
+        self.assertNotEqual(
+            _get_value_digest([_Color.RED]), _get_value_digest([1]))
+        self.assertEqual(
+            _get_value_digest({'a': point_type(1, 2)}),
+            _get_value_digest({'a': point_type(1, 2)}))
+
+        task_id_hash_list = []
+        # keyword arguments hash the same in any order
+        for kwargs in [{'b': 2, 'a': 1}, {'a': 1, 'b': 2}, {'a': 1, 'b': 3}]:
+            task_graph = taskgraph.TaskGraph(self.workspace_dir, -1)
+            task = task_graph.add_task(func=_noop_function, kwargs=kwargs)
+            task_graph.close()
+            task_graph.join()
+            task_graph = None
+            task_id_hash_list.append(task._task_id_hash)
+        self.assertEqual(task_id_hash_list[0], task_id_hash_list[1])
+        self.assertNotEqual(task_id_hash_list[0], task_id_hash_list[2])
+
+    def test_normalize_path_memo(self):
+        """TaskGraph: test memoized path normalization and pre-filter."""
+        from taskgraph.Task import _normalize_path
+        from taskgraph.Task import _normalize_path_in_dir
+        from taskgraph.Task import _scrub_task_args
+        subdir_path = os.path.join(self.workspace_dir, 'subdir')
+        os.makedirs(subdir_path)
+        original_dir = os.getcwd()
+        try:
+            os.chdir(self.workspace_dir)
+            workspace_path = _normalize_path('file.txt')
+            os.chdir(subdir_path)
+            subdir_file_path = _normalize_path('file.txt')
+        finally:
+            os.chdir(original_dir)
+        self.assertEqual(
+            workspace_path, os.path.normcase(
+                os.path.abspath(os.path.join(self.workspace_dir, 'file.txt'))))
+        self.assertEqual(
+            subdir_file_path, os.path.normcase(
+                os.path.abspath(os.path.join(subdir_path, 'file.txt'))))
+
+        # strings that can't be paths are normalized like any other so
+        # Task hashes don't change, but they aren't memoized
+        not_path_list = ['', 'a\x00b', 'x' * 40000]
+        cache_size = _normalize_path_in_dir.cache_info().currsize
+        self.assertEqual(
+            _scrub_task_args(not_path_list, []), [
+                os.path.normcase(os.path.abspath(path))
+                for path in not_path_list])
+        self.assertLessEqual(
+            _normalize_path_in_dir.cache_info().currsize, cache_size + 1)
+
+        target_path = os.path.join(self.workspace_dir, 'target.txt')
+        for _ in range(2):
+            task_graph = taskgraph.TaskGraph(self.workspace_dir, -1)
+            task = task_graph.add_task(
+                func=_create_file, args=(target_path, 'x' * 40000),
+                target_path_list=[target_path])
+            task_graph.close()
+            task_graph.join()
+            task_graph = None
+        self.assertTrue(task.is_precalculated())
+
+    def test_function_fingerprint(self):
+        """TaskGraph: test functions are fingerprinted from their code."""
+        from taskgraph.Task import _get_function_fingerprint
+
+        def _define(source):
+            namespace = {'__name__': 'generated_module'}
+            exec(source, namespace)
+            return namespace['task_func']
+
+        base_source = (
+            'def helper(x):\n    return x + 1\n\n'
+            'def task_func(x):\n    return helper(x) * 2\n')
+        base_func = _define(base_source)
+        # exec'd code has no source but is still fingerprinted by its code
+        for hash_callees in [False, True]:
+            self.assertEqual(
+                _get_function_fingerprint(base_func, hash_callees),
+                _get_function_fingerprint(_define(
+                    '# a comment\n' + base_source.replace(
+                        'x + 1', 'x  +  1  # comment')), hash_callees))
+            self.assertNotEqual(
+                _get_function_fingerprint(base_func, hash_callees),
+                _get_function_fingerprint(_define(base_source.replace(
+                    '* 2', '* 3')), hash_callees))
+        # a change in a helper only counts if callees are hashed
+        helper_changed_func = _define(base_source.replace('x + 1', 'x + 2'))
+        self.assertEqual(
+            _get_function_fingerprint(base_func, False),
+            _get_function_fingerprint(helper_changed_func, False))
+        self.assertNotEqual(
+            _get_function_fingerprint(base_func, True),
+            _get_function_fingerprint(helper_changed_func, True))
+
+        def _make_closure(value):
+            def closure():
+                return value
+            return closure
+        self.assertNotEqual(
+            _get_function_fingerprint(_make_closure(1), True),
+            _get_function_fingerprint(_make_closure(2), True))
+
+        # an instance of a local class can't be pickled, only its type is
+        # fingerprinted and the Task still executes
+        class _LocalValue(object):
+            pass
+        local_closure = _make_closure(_LocalValue())
+        self.assertEqual(
+            _get_function_fingerprint(local_closure, True),
+            _get_function_fingerprint(_make_closure(_LocalValue()), True))
+        task_graph = taskgraph.TaskGraph(self.workspace_dir, -1)
+        local_task = task_graph.add_task(
+            func=local_closure, store_result=True, transient_run=True)
+        task_graph.close()
+        task_graph.join()
+        self.assertIsInstance(local_task.get(), _LocalValue)
+        # recursive functions terminate
+        recursive_func = _define(
+            'def task_func(x):\n    return task_func(x - 1) if x else 0\n')
+        _get_function_fingerprint(recursive_func, True)
+
+        # only the most recently used code objects are remembered
+        from taskgraph.Task import _CODE_CACHE_SIZE
+        from taskgraph.Task import _get_code_digest
+        for index in range(_CODE_CACHE_SIZE + 8):
+            _get_function_fingerprint(_define(
+                'def task_func(x):\n    return x + %d\n' % index), True)
+        self.assertEqual(
+            _get_code_digest.cache_info().currsize, _CODE_CACHE_SIZE)
+
+    def test_hash_directories(self):
+        """TaskGraph: test directory arguments fingerprinted as a tree."""
+        tile_dir = os.path.join(self.workspace_dir, 'tiles')
+        deep_dir = os.path.join(tile_dir, 'a', 'b')
+        os.makedirs(deep_dir)
+        deep_path = os.path.join(deep_dir, 'tile.txt')
+        _create_file(deep_path, 'tile')
+        _create_file(os.path.join(tile_dir, 'index.txt'), 'index')
+
+        log_path = os.path.join(self.workspace_dir, 'log.txt')
+
+        def _executed():
+            """Return True if the task executed rather than was skipped."""
+            _create_file(log_path, '')
+            task_graph = taskgraph.TaskGraph(self.workspace_dir, -1)
+            task_graph.add_task(
+                func=_append_val, args=(log_path, 'x', tile_dir),
+                ignore_path_list=[log_path], hash_algorithm='md5',
+                hash_directories=True)
+            task_graph.close()
+            task_graph.join()
+            with open(log_path, 'r') as log_file:
+                return log_file.read() != ''
+
+        self.assertTrue(_executed())
+        self.assertFalse(_executed())
+        # a file changed deep in the tree but its directory didn't
+        _create_file(deep_path, 'elit')
+        self.assertTrue(_executed())
+        self.assertFalse(_executed())
+        # a file added to a subdirectory
+        _create_file(os.path.join(deep_dir, 'new.txt'), 'new')
+        self.assertTrue(_executed())
+        self.assertFalse(_executed())
+        # a file removed from the top of the tree
+        os.remove(os.path.join(tile_dir, 'index.txt'))
+        self.assertTrue(_executed())
+
+        # listings are reused until the directory changes and only the most
+        # recently used are kept
+        from taskgraph.Task import _DirectoryListingCache
+        listing_cache = _DirectoryListingCache(2)
+        old_mtime_ns = int((time.time() - 60) * 1e9)
+        dir_path_list = []
+        for dir_name in ['x', 'y', 'z']:
+            dir_path = os.path.join(self.workspace_dir, 'listing', dir_name)
+            os.makedirs(dir_path)
+            _create_file(os.path.join(dir_path, 'a.txt'), '')
+            os.utime(dir_path, ns=(old_mtime_ns, old_mtime_ns))
+            dir_path_list.append(dir_path)
+            self.assertEqual(
+                listing_cache.get_entry_list(dir_path),
+                [('a.txt', False, True)])
+        self.assertEqual(
+            list(listing_cache._listing_map), dir_path_list[1:])
+        _create_file(os.path.join(dir_path_list[2], 'b.txt'), '')
+        self.assertEqual(
+            listing_cache.get_entry_list(dir_path_list[2]),
+            [('a.txt', False, True), ('b.txt', False, True)])
+
+    def test_dependency_completes_while_adding(self):
+        """TaskGraph: test a chain added while its tasks execute completes."""
+        task_graph = taskgraph.TaskGraph(self.workspace_dir, 0)
+        task_list = []
+        for index in range(2000):
+            # each task's dependency is likely to complete while it's added
+            task_list = [task_graph.add_task(
+                func=_noop_function, kwargs={'index': index},
+                dependent_task_list=task_list, task_name='chain %d' % index,
+                transient_run=True)]
+        task_graph.close()
+        self.assertTrue(task_graph.join(timeout=60.0))
+
+    def test_critical_path_priority(self):
+        """TaskGraph: test critical_path mode runs the longest chain first."""
+        with self.assertRaises(ValueError):
+            taskgraph.TaskGraph(self.workspace_dir, 0, priority_mode='depth')
+        for priority_mode, expected_order_list in [
+                ('user', ['b1', 'c1', 'c2', 'c3']),
+                ('critical_path', ['c1', 'c2', 'b1', 'c3'])]:
+            _EXECUTION_ORDER_LIST.clear()
+            _GATE_ENTERED_EVENT.clear()
+            _GATE_OPEN_EVENT.clear()
+            task_graph = taskgraph.TaskGraph(
+                self.workspace_dir, 0, priority_mode=priority_mode)
+            # the only executor waits here while the other tasks are added
+            task_graph.add_task(func=_wait_for_gate, transient_run=True)
+            _GATE_ENTERED_EVENT.wait()
+            task_list = []
+            for task_name in ['b1', 'c1', 'c2', 'c3']:
+                # b1 and c1 are ready right away, c1 becomes the start of
+                # the longest chain once c2 and c3 are added
+                dependent_task_list = task_list[-1:] if (
+                    task_name in ('c2', 'c3')) else []
+                task_list.append(task_graph.add_task(
+                    func=_record_execution, args=(task_name,),
+                    task_name=task_name,
+                    dependent_task_list=dependent_task_list,
+                    transient_run=True))
+            _GATE_OPEN_EVENT.set()
+            task_graph.close()
+            task_graph.join()
+            self.assertEqual(_EXECUTION_ORDER_LIST, expected_order_list)
+
+    def test_runtime_history(self):
+        """TaskGraph: test runtimes are recorded and used for priority."""
+        with self.assertRaises(ValueError):
+            taskgraph.TaskGraph(
+                self.workspace_dir, 0, priority_mode='runtime',
+                record_runtime_history=False)
+        # by default it's only recorded when something uses it
+        task_graph = taskgraph.TaskGraph(self.workspace_dir, -1)
+        task = task_graph.add_task(func=_noop_function, transient_run=True)
+        with self.assertRaises(ValueError):
+            task_graph.get_runtime_stats(task)
+        task_graph.close()
+        task_graph.join()
+        self.assertNotIn(
+            'taskgraph_runtime_history.db', os.listdir(self.workspace_dir))
+
+        for _ in range(2):
+            _EXECUTION_ORDER_LIST.clear()
+            task_graph = taskgraph.TaskGraph(
+                self.workspace_dir, 0, record_runtime_history=True)
+            fast_task = task_graph.add_task(
+                func=_record_execution, args=('fast',), transient_run=True)
+            slow_task = task_graph.add_task(
+                func=_record_execution, args=('slow', 0.1),
+                transient_run=True)
+            task_graph.close()
+            task_graph.join()
+            self.assertEqual(_EXECUTION_ORDER_LIST, ['fast', 'slow'])
+
+        # the statistics were written by the first TaskGraph and read by
+        # the second
+        slow_stats = task_graph.get_runtime_stats(slow_task)
+        self.assertEqual(slow_stats['task']['run_count'], 2)
+        self.assertGreaterEqual(slow_stats['task']['mean_runtime'], 0.1)
+        self.assertGreaterEqual(
+            slow_stats['task']['p95_runtime'],
+            slow_stats['task']['mean_runtime'])
+        if slow_stats['task']['peak_memory'] is not None:
+            self.assertGreater(slow_stats['task']['peak_memory'], 0)
+        fast_stats = task_graph.get_runtime_stats(fast_task)
+        self.assertEqual(fast_stats['function']['run_count'], 4)
+        self.assertLess(
+            fast_stats['task']['mean_runtime'],
+            fast_stats['function']['mean_runtime'])
+
+        # the task expected to take longer executes first
+        _EXECUTION_ORDER_LIST.clear()
+        _GATE_ENTERED_EVENT.clear()
+        _GATE_OPEN_EVENT.clear()
+        task_graph = taskgraph.TaskGraph(
+            self.workspace_dir, 0, priority_mode='runtime')
+        task_graph.add_task(func=_wait_for_gate, transient_run=True)
+        _GATE_ENTERED_EVENT.wait()
+        task_graph.add_task(
+            func=_record_execution, args=('fast',), transient_run=True)
+        task_graph.add_task(
+            func=_record_execution, args=('slow', 0.1), transient_run=True)
+        _GATE_OPEN_EVENT.set()
+        task_graph.close()
+        task_graph.join()
+        self.assertEqual(_EXECUTION_ORDER_LIST, ['slow', 'fast'])
+
+        # the peak memory of a call is only known if the call raised the
+        # high-water mark of the process it ran in
+        from taskgraph.Task import _call_and_fingerprint_targets
+        from taskgraph.Task import _get_peak_memory
+        process_peak_memory = _get_peak_memory()
+        if process_peak_memory is not None:
+            # a list of this many references takes 32 MiB more than that
+            list_length = process_peak_memory // 8 + 2**22
+            _, _, (_, peak_memory) = _call_and_fingerprint_targets(
+                _return_list, [0, list_length], {}, [], 'md5')
+            self.assertGreater(peak_memory, process_peak_memory)
+            _, _, (_, peak_memory) = _call_and_fingerprint_targets(
+                _noop_function, [], {}, [], 'md5')
+            self.assertIsNone(peak_memory)
+
+        # a memory cache backend doesn't write a runtime history
+        memory_dir = os.path.join(self.workspace_dir, 'memory')
+        task_graph = taskgraph.TaskGraph(
+            memory_dir, -1, cache_backend='memory',
+            record_runtime_history=True)
+        task = task_graph.add_task(func=_noop_function, transient_run=True)
+        task_graph.close()
+        task_graph.join()
+        self.assertEqual(
+            task_graph.get_runtime_stats(task)['task']['run_count'], 1)
+        self.assertNotIn(
+            'taskgraph_runtime_history.db', os.listdir(memory_dir))
+
+        # statistics expire with the rest of the cache
+        task_graph = taskgraph.TaskGraph(
+            self.workspace_dir, -1, record_runtime_history=True,
+            cache_max_age=0)
+        task_graph.close()
+        task_graph.join()
+        task_graph = taskgraph.TaskGraph(
+            self.workspace_dir, -1, record_runtime_history=True)
+        self.assertIsNone(task_graph.get_runtime_stats(slow_task)['task'])
+        task_graph.close()
+        task_graph.join()
+
+    def test_resource_capacity(self):
+        """TaskGraph: test Tasks only run when their resources are free."""
+        task_graph = taskgraph.TaskGraph(
+            self.workspace_dir, 4,
+            resource_capacity={'cpus': 4, 'memory_gb': 10})
+        task_list = []
+        for index in range(4):
+            # only two of these fit the cpus at once
+            task_list.append(task_graph.add_task(
+                func=_get_run_interval, args=(0.2 + 0.01 * index,),
+                resources={'cpus': 2, 'memory_gb': 1, 'gpus': 1},
+                store_result=True, transient_run=True))
+        task_graph.close()
+        task_graph.join()
+        interval_list = [task.get() for task in task_list]
+        max_overlap = max(
+            sum(1 for other_start, other_end in interval_list
+                if other_start <= start < other_end)
+            for start, _ in interval_list)
+        self.assertEqual(max_overlap, 2)
+
+        # the free cpu is reserved for the blocked higher priority Task
+        # instead of going to the smaller ones that would keep it waiting
+        task_graph = taskgraph.TaskGraph(
+            self.workspace_dir, 4, resource_capacity={'cpus': 2})
+        gate_task = task_graph.add_task(
+            func=_long_running_function, args=(0.2,), transient_run=True)
+        small_task = task_graph.add_task(
+            func=_get_run_interval, args=(0.3,), resources={'cpus': 1},
+            dependent_task_list=[gate_task], priority=3, store_result=True,
+            transient_run=True)
+        large_task = task_graph.add_task(
+            func=_get_run_interval, args=(0.1,), resources={'cpus': 2},
+            dependent_task_list=[gate_task], priority=2, store_result=True,
+            transient_run=True)
+        filler_task_list = [
+            task_graph.add_task(
+                func=_get_run_interval, args=(0.31 + 0.01 * index,),
+                resources={'cpus': 1}, dependent_task_list=[gate_task],
+                priority=1, store_result=True, transient_run=True)
+            for index in range(4)]
+        task_graph.close()
+        task_graph.join()
+        large_start, _ = large_task.get()
+        self.assertGreaterEqual(large_start, small_task.get()[1])
+        for filler_task in filler_task_list:
+            self.assertGreaterEqual(filler_task.get()[0], large_start)
+
+        for resources in [{'memory_gb': 11}, {'cpus': -1}]:
+            task_graph = taskgraph.TaskGraph(
+                self.workspace_dir, 0,
+                resource_capacity={'cpus': 4, 'memory_gb': 10})
+            with self.assertRaises(ValueError):
+                task_graph.add_task(
+                    func=_noop_function, resources=resources)
+            task_graph.join()
+
+    def test_task_batching(self):
+        """TaskGraph: test small ready Tasks execute in batches."""
+        task_graph = taskgraph.TaskGraph(
+            self.workspace_dir, 2, task_batch_size=8)
+        gate_task = task_graph.add_task(
+            func=_long_running_function, args=(0.2,), transient_run=True)
+        # these are all ready once the gate completes
+        with self.assertLogs('taskgraph.Task', level='DEBUG') as log_context:
+            task_list = [
+                task_graph.add_task(
+                    func=_return_list, args=(index, 2),
+                    dependent_task_list=[gate_task], store_result=True,
+                    batchable=True)
+                for index in range(32)]
+            task_graph.close()
+            task_graph.join()
+        self.assertEqual(
+            [task.get() for task in task_list],
+            [[index] * 2 for index in range(32)])
+        self.assertTrue(any(
+            'apply_async for a batch of' in message
+            for message in log_context.output))
+
+        # batched Tasks are precalculated like any other
+        task_graph = taskgraph.TaskGraph(
+            self.workspace_dir, 2, task_batch_size=8)
+        task_list = [
+            task_graph.add_task(
+                func=_return_list, args=(index, 2), store_result=True,
+                batchable=True)
+            for index in range(32)]
+        task_graph.close()
+        task_graph.join()
+        self.assertTrue(all(task.is_precalculated() for task in task_list))
+
+        # the Task that fails in a batch is the one that raises on join
+        task_graph = taskgraph.TaskGraph(
+            self.workspace_dir, 2, task_batch_size=8)
+        gate_task = task_graph.add_task(
+            func=_long_running_function, args=(0.2,), transient_run=True)
+        task_list = [
+            task_graph.add_task(
+                func=_return_list, args=(index, 2),
+                dependent_task_list=[gate_task], batchable=True,
+                transient_run=True)
+            for index in range(4)]
+        fail_task = task_graph.add_task(
+            func=_div_by_zero, dependent_task_list=[gate_task],
+            batchable=True)
+        task_graph.close()
+        with self.assertRaises(ZeroDivisionError):
+            task_graph.join()
+        self.assertIsInstance(fail_task.exception_object, ZeroDivisionError)
+
+        # Tasks the runtime history expects to be fast are batchable
+        task_graph = taskgraph.TaskGraph(
+            self.workspace_dir, -1, batch_runtime_threshold=1.0)
+        task_graph.add_task(
+            func=_return_list, args=(100, 2), transient_run=True)
+        task_graph.close()
+        task_graph.join()
+        task_graph = taskgraph.TaskGraph(
+            self.workspace_dir, 0, batch_runtime_threshold=1.0)
+        gate_task = task_graph.add_task(
+            func=_long_running_function, args=(0.2,), transient_run=True)
+        known_task = task_graph.add_task(
+            func=_return_list, args=(100, 2), transient_run=True,
+            dependent_task_list=[gate_task])
+        unknown_task = task_graph.add_task(
+            func=_noop_function, transient_run=True,
+            dependent_task_list=[gate_task])
+        self.assertIn(
+            known_task.task_name, task_graph._batchable_task_name_set)
+        self.assertNotIn(
+            unknown_task.task_name, task_graph._batchable_task_name_set)
+        task_graph.close()
+        task_graph.join()
+
 
 def Fail(n_tries, result_path):
     """Create a function that fails after ``n_tries``."""